@@ -0,0 +1,168 @@
+"""
+Compare the throughput and latency of ``serve --server waitress`` and
+``serve --server asgi`` for cached targets.
+
+For every server mode, a ``serve`` process is started on a temporary target
+dir, then ``--concurrency`` keep-alive connections request the same
+``/targets/`` path for ``--duration`` seconds.
+
+    pip install 'prometheus-http-sd[asgi]'
+    python benchmarks/serving.py --concurrency 500 --targets 5000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_root(root, targets):
+    groups = [
+        {
+            "targets": [f"10.0.{i // 250}.{i % 250}:9100"],
+            "labels": {"i": str(i)},
+        }
+        for i in range(targets)
+    ]
+    with open(os.path.join(root, "targets.json"), "w") as f:
+        json.dump(groups, f)
+
+
+def start_server(mode, port, root, cache_dir, threads):
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "prometheus_http_sd.cli",
+            "--log-level",
+            "40",
+            "serve",
+            "--server",
+            mode,
+            "--port",
+            str(port),
+            "--threads",
+            str(threads),
+            "--connection-limit",
+            "100000",
+            "--cache-dir",
+            cache_dir,
+            "--cache-refresh-interval",
+            "1",
+            root,
+        ]
+    )
+    url = f"http://127.0.0.1:{port}/targets/"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url) as response:
+                if response.status == 200:
+                    return process
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"{mode} server did not become ready")
+
+
+async def client(port, deadline, latencies, errors):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    request = b"GET /targets/ HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n"
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            writer.write(request)
+            status_line = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.partition(b":")
+                if name.strip().lower() == b"content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            if b" 200 " not in status_line:
+                errors.append(status_line)
+            latencies.append(time.perf_counter() - start)
+    except (ConnectionError, asyncio.IncompleteReadError) as e:
+        errors.append(e)
+    finally:
+        writer.close()
+
+
+async def load(port, concurrency, duration):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(
+        *(
+            client(port, deadline, latencies, errors)
+            for _ in range(concurrency)
+        )
+    )
+    return latencies, errors
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float("nan")
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p))
+    return sorted_values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--modes", default="waitress,asgi")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--targets", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=64)
+    args = parser.parse_args()
+
+    print(
+        f"concurrency={args.concurrency} duration={args.duration}s"
+        f" targets={args.targets}"
+    )
+    print(
+        f"{'mode':<10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}"
+    )
+    with tempfile.TemporaryDirectory() as root:
+        make_root(root, args.targets)
+        for mode in args.modes.split(","):
+            with tempfile.TemporaryDirectory() as cache_dir:
+                port = free_port()
+                process = start_server(
+                    mode, port, root, cache_dir, args.threads
+                )
+                try:
+                    latencies, errors = asyncio.run(
+                        load(port, args.concurrency, args.duration)
+                    )
+                finally:
+                    process.terminate()
+                    process.wait()
+            latencies.sort()
+            print(
+                f"{mode:<10}{len(latencies) / args.duration:>10.0f}"
+                f"{percentile(latencies, 0.5) * 1000:>10.1f}"
+                f"{percentile(latencies, 0.99) * 1000:>10.1f}"
+                f"{len(errors):>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
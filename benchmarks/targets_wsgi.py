@@ -0,0 +1,115 @@
+"""
+Compare the requests/sec of cached ``/targets`` requests through the flask
+app alone and through the ``TargetsFastPath`` in front of it.
+
+The WSGI app is called in-process from a single thread, so the numbers show
+the per-request overhead of the app on one core, without any HTTP server.
+
+    python benchmarks/targets_wsgi.py --requests 20000 --targets 100
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from prometheus_http_sd.app import create_app
+from prometheus_http_sd.config import config
+from prometheus_http_sd.dispather import Dispatcher
+from prometheus_http_sd.handler import cache_key
+from prometheus_http_sd.params import params_index
+
+
+def make_environ(path, query_string):
+    return {
+        "REQUEST_METHOD": "GET",
+        "SCRIPT_NAME": "",
+        "PATH_INFO": path,
+        "QUERY_STRING": query_string,
+        "SERVER_NAME": "127.0.0.1",
+        "SERVER_PORT": "8080",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+
+
+def run(app, requests, path, query_string):
+    statuses = []
+
+    def start_response(status, headers, exc_info=None):
+        statuses.append(status)
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        body = app(make_environ(path, query_string), start_response)
+        for _ in body:
+            pass
+        if hasattr(body, "close"):
+            body.close()
+    elapsed = time.perf_counter() - start
+
+    errors = sum(1 for s in statuses if not s.startswith("200"))
+    return requests / elapsed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--targets", type=int, default=100)
+    args = parser.parse_args()
+
+    # the slow path logs every request on info level
+    logging.basicConfig(level=logging.INFO, stream=io.StringIO())
+
+    targets = [
+        {"targets": [f"10.0.{i // 250}.{i % 250}:9100"], "labels": {}}
+        for i in range(args.targets)
+    ]
+    params = {"domain": "example.com", "env": "prod"}
+
+    print(f"requests={args.requests} targets={args.targets}")
+    print(f"{'app':<12}{'req/s':>10}{'errors':>8}")
+    with tempfile.TemporaryDirectory() as root:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # the dispatcher of the app refreshes the cache from here
+            config.root_dir = root
+            os.mkdir(os.path.join(root, "bench"))
+            with open(os.path.join(root, "bench", "targets.json"), "w") as f:
+                json.dump(targets, f)
+            Dispatcher(
+                interval=3600,
+                max_workers=1,
+                cache_location=cache_dir,
+                cache_expire_seconds=3600,
+            ).write_cache(
+                # a json generator declares no params, the requests are
+                # served from the key they resolve to
+                cache_key("bench", params_index.filter("bench", params)),
+                targets,
+            )
+
+            for name, fast_path in (("flask", False), ("fast-path", True)):
+                app = create_app(
+                    "/", cache_dir, 3600, 3600, 1, fast_path=fast_path
+                )
+                rate, errors = run(
+                    app,
+                    args.requests,
+                    "/targets/bench",
+                    "domain=example.com&env=prod",
+                )
+                print(f"{name:<12}{rate:>10.0f}{errors:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,89 @@
 import logging
-import os
 from pathlib import Path
-from datetime import datetime
-
-from flask import Flask, jsonify, render_template, request
-from prometheus_client import make_wsgi_app
+import threading
+
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    render_template,
+    request,
+    url_for,
+)
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from werkzeug.wsgi import wrap_file
 
-from prometheus_http_sd.dispather import (
-    CacheNotExist,
-    Dispatcher,
-    CacheExpired,
-)
+from prometheus_http_sd.dispather import Dispatcher
 
+from .cache_store import create_cache_store
 from .config import config
-from .sd import generate_perf, run_python
-from .metrics import (
-    path_last_generated_targets,
-    target_path_requests_total,
-    target_path_request_duration_seconds,
+from .fastpath import TargetsFastPath
+from .load_shedding import AIMDLimiter, LoadShedding
+from .metrics import make_metrics_wsgi_app
+from .refresh_interval import REFRESH_INTERVAL_HEADER, parse_refresh_interval
+from .watch import max_watchers
+from .handler import (
+    bulk_targets,
+    debug_job,
+    debug_targets,
+    lookup_scrape_configs,
+    parse_bulk_request,
+    serve_targets,
 )
 from .version import VERSION
 
 logger = logging.getLogger(__name__)
 
 
+def create_dispatcher(
+    cache_location,
+    cache_seconds,
+    cache_refresh_interval,
+    update_threads,
+    cache_store="file",
+    shared_cache=False,
+    tenant_weights=None,
+    partial_results=False,
+    task_queue=None,
+    tenant_concurrency=None,
+) -> Dispatcher:
+    """The dispatcher of ``serve``. With a ``task_queue``, this is one of
+    the serving processes of ``serve --processes``, the requested tasks are
+    forwarded to the scheduler process through it."""
+    cache_dir = Path(cache_location)
+    dispatcher = Dispatcher(
+        interval=cache_refresh_interval,
+        max_workers=update_threads,
+        cache_location=cache_dir,
+        cache_expire_seconds=cache_seconds,
+        cache_store=create_cache_store(cache_store, cache_dir),
+        shared_cache=shared_cache,
+        tenant_weights=tenant_weights,
+        partial_results=partial_results,
+        tenant_concurrency=tenant_concurrency,
+    )
+    if task_queue is None:
+        dispatcher.start_dispatcher()
+    else:
+        dispatcher.start_forwarder(task_queue)
+    return dispatcher
+
+
 def create_app(
     prefix,
     cache_location,
     cache_seconds,
     cache_refresh_interval,
     update_threads,
+    cache_store="file",
+    shared_cache=False,
+    tenant_weights=None,
+    partial_results=False,
+    fast_path=True,
+    shed_latency=0,
+    max_concurrency=64,
+    task_queue=None,
+    tenant_concurrency=None,
 ):
     app = Flask(
         __name__,
@@ -38,7 +91,7 @@ def create_app(
     )
 
     # Add prometheus wsgi middleware to route /metrics requests
-    prometheus_wsgi_app = make_wsgi_app()
+    prometheus_wsgi_app = make_metrics_wsgi_app()
     app.wsgi_app = DispatcherMiddleware(
         app.wsgi_app,
         {
@@ -47,23 +100,61 @@ def create_app(
         },
     )
 
-    cache_dir = Path(cache_location)
-    dispatcher = Dispatcher(
-        interval=cache_refresh_interval,
-        max_workers=update_threads,
-        cache_location=cache_dir,
-        cache_expire_seconds=cache_seconds,
+    dispatcher = create_dispatcher(
+        cache_location,
+        cache_seconds,
+        cache_refresh_interval,
+        update_threads,
+        cache_store=cache_store,
+        shared_cache=shared_cache,
+        tenant_weights=tenant_weights,
+        partial_results=partial_results,
+        task_queue=task_queue,
+        tenant_concurrency=tenant_concurrency,
     )
-    dispatcher.start_dispatcher()
 
-    # temp solution, return dynamic scape configs from python file.
+    # for the callers that set it up further, e.g. the reloader
+    app.extensions["dispatcher"] = dispatcher
+
+    if fast_path:
+        # cached targets are served before flask, see fastpath.py
+        app.wsgi_app = TargetsFastPath(app.wsgi_app, prefix, dispatcher)
+
+    # a ?watch= request holds a server thread while it waits, the waitress
+    # threads are max_concurrency
+    watchers = threading.BoundedSemaphore(max_watchers(max_concurrency))
+
+    if shed_latency:
+        # in front of everything, a shed request costs nearly nothing
+        app.wsgi_app = LoadShedding(
+            app.wsgi_app, prefix, AIMDLimiter(shed_latency, max_concurrency)
+        )
+
+    def send_entry(entry):
+        # the cached payload is already encoded, stream it to the client via
+        # wsgi.file_wrapper instead of decoding and encoding it again
+        response = Response(
+            wrap_file(request.environ, entry.stream),
+            content_type=entry.content_type,
+            direct_passthrough=True,
+        )
+        response.content_length = entry.size
+        response.set_etag(entry.etag)
+        if entry.version is not None:
+            response.headers["X-Targets-Version"] = str(entry.version)
+        return response
+
+    # return dynamic scape configs from python file, they are cached and
+    # refreshed in background like targets.
     # only support python file, not directory.
     @app.route(f"{prefix}/scrape_configs/<path:rest_path>")
     def get_scrape_configs(rest_path):
-        generated = run_python(
-            str(Path(config.root_dir) / (rest_path + ".py")), **request.args
+        result = lookup_scrape_configs(
+            dispatcher, rest_path, dict(request.args)
         )
-        return generated
+        if result.entry is None:
+            return jsonify(result.body), result.status
+        return send_entry(result.entry)
 
     @app.route(f"{prefix}/targets", defaults={"rest_path": ""})
     @app.route(f"{prefix}/targets/", defaults={"rest_path": ""})
@@ -72,115 +163,58 @@ def create_app(
     def get_targets(rest_path):
 
         if request.args.get("debug") == "true":
-            arg_list = dict(request.args)
-            del arg_list["debug"]
-            return generate_perf(config.root_dir, rest_path, **arg_list)
-
-        logger.info(
-            "request target path: {}, with parameters: {}".format(
-                rest_path,
-                request.args,
+            status, body = debug_targets(
+                dispatcher, rest_path, dict(request.args)
             )
+            if "job_id" in body:
+                body["result_url"] = url_for(
+                    "get_debug_job", job_id=body["job_id"]
+                )
+            return jsonify(body), status
+
+        result = serve_targets(
+            dispatcher,
+            rest_path,
+            dict(request.args),
+            parse_refresh_interval(
+                request.headers.get(REFRESH_INTERVAL_HEADER)
+            ),
+            watchers,
+        )
+        if result.status == 304:
+            response = Response(status=304)
+            response.set_etag(result.etag)
+            return response
+        if result.entry is None:
+            return jsonify(result.body), result.status
+        return send_entry(result.entry)
+
+    # the cached targets of many paths in one request, paths starting with
+    # "_" are never target paths, so this does not hide one
+    @app.route(f"{prefix}/targets/_bulk", methods=["POST"])
+    def get_targets_bulk():
+        try:
+            requests = parse_bulk_request(request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return Response(
+            bulk_targets(dispatcher, requests),
+            content_type="application/json",
         )
 
-        l1_dir = l2_dir = ""
-        path_splits = rest_path.split("/")
-        if len(path_splits) > 0:
-            l1_dir = path_splits[0]
-        if len(path_splits) > 1:
-            l2_dir = path_splits[1]
-
-        with target_path_request_duration_seconds.labels(
-            path=rest_path
-        ).time():
-            try:
-                full_path = request.full_path
-                targets = dispatcher.get_targets(
-                    rest_path, full_path, **request.args
-                )
-            except CacheNotExist:
-                target_path_requests_total.labels(
-                    path=rest_path,
-                    status="cache-not-exist",
-                    l1_dir=l1_dir,
-                    l2_dir=l2_dir,
-                ).inc()
-                logger.error("Cache miss, full_path=%s", request.full_path)
-                return jsonify({"error": "cache miss"}), 500
-            except CacheExpired as e:
-                target_path_requests_total.labels(
-                    path=rest_path,
-                    status="cache-expired",
-                    l1_dir=l1_dir,
-                    l2_dir=l2_dir,
-                ).inc()
-                updated_timestamp = e.updated_timestamp
-                cache_expire_seconds = e.cache_excepire_seconds
-                dt = datetime.fromtimestamp(updated_timestamp)
-
-                logger.error(
-                    "Cache expired, full_path=%s, updated_timestamp: %s, "
-                    "cache_expire_seconds: %s (%s)",
-                    request.full_path,
-                    updated_timestamp,
-                    cache_expire_seconds,
-                    dt,
-                )
-                return (
-                    jsonify(
-                        {
-                            "error": (
-                                "cache expired, you should try again later"
-                            ),
-                            "updated_timestamp": updated_timestamp,
-                            "updated_time": dt,
-                            "cache_expire_seconds": cache_expire_seconds,
-                        },
-                    ),
-                    500,
-                )
-            except:  # noqa: E722
-                target_path_requests_total.labels(
-                    path=rest_path, status="fail", l1_dir=l1_dir, l2_dir=l2_dir
-                ).inc()
-                raise
-            else:
-                target_path_requests_total.labels(
-                    path=rest_path,
-                    status="success",
-                    l1_dir=l1_dir,
-                    l2_dir=l2_dir,
-                ).inc()
-                if (
-                    isinstance(targets, list)
-                    and len(targets) > 0
-                    and isinstance(targets[0], dict)
-                ):
-                    path_last_generated_targets.labels(path=rest_path).set(
-                        sum(len(t.get("targets", []) or []) for t in targets)
-                    )
-
-                return jsonify(targets)
+    @app.route(f"{prefix}/debug/jobs/<job_id>")
+    def get_debug_job(job_id):
+        status, body = debug_job(dispatcher, job_id)
+        return jsonify(body), status
 
     @app.route(f"{prefix}/")
     def admin():
-        paths = []
-
-        for dirpath, _, _ in os.walk(config.root_dir):
-            should_ignore_underscore = any(
-                p.startswith("_")
-                for p in os.path.normpath(dirpath).split(os.sep)
-            )
-            if should_ignore_underscore:
-                continue
-
-            dirpath = dirpath.removeprefix(config.root_dir)
-            dirpath = dirpath.removeprefix("/")
-            paths.append(dirpath)
-
-        paths = sorted(list(set(paths)))
         return render_template(
-            "admin.html", prefix=prefix, paths=paths, version=VERSION
+            "admin.html",
+            prefix=prefix,
+            paths=dispatcher.index.paths(config.root_dir),
+            rows=dispatcher.index.rows(),
+            version=VERSION,
         )
 
     return app
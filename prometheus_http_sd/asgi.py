@@ -0,0 +1,347 @@
+"""ASGI version of the ``serve`` app, cached targets are served from an event
+loop, so thousands of concurrent (or slow) connections do not need one
+thread each. The blocking parts (cache lookup, admin page) run in the
+default executor of the loop, a ``?watch=`` request waits on the loop."""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+import logging
+from pathlib import Path
+import time
+
+import jinja2
+
+from .config import config
+from .handler import (
+    TargetsResult,
+    bulk_targets,
+    debug_job,
+    debug_targets,
+    lookup_scrape_configs,
+    not_served,
+    parse_bulk_request,
+    parse_query_args,
+    serve_targets,
+    targets_changed,
+    watched_key,
+)
+from .load_shedding import (
+    RETRY_AFTER_SECONDS,
+    SHED_BODY,
+    AIMDLimiter,
+    is_limited,
+)
+from .metrics import make_metrics_asgi_app
+from .mounts import is_served
+from .refresh_interval import REFRESH_INTERVAL_HEADER, parse_refresh_interval
+from .version import VERSION
+from .watch import WATCH_POLL_SECONDS, parse_watch_args
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+
+
+def _read_chunk(entry):
+    chunk = entry.stream.read(CHUNK_SIZE)
+    if len(chunk) < CHUNK_SIZE:
+        entry.close()
+    return chunk
+
+
+def response_headers(entry):
+    headers = [
+        (b"content-type", entry.content_type.encode()),
+        (b"content-length", str(entry.size).encode()),
+        (b"etag", f'"{entry.etag}"'.encode()),
+    ]
+    if entry.version is not None:
+        headers.append((b"x-targets-version", str(entry.version).encode()))
+    return headers
+
+
+class ASGIApp:
+    def __init__(
+        self, prefix, dispatcher, executor_threads=64, shed_latency=0
+    ) -> None:
+        self.prefix = prefix.rstrip("/")
+        self.dispatcher = dispatcher
+        self.executor_threads = executor_threads
+        self.limiter = None
+        if shed_latency:
+            self.limiter = AIMDLimiter(shed_latency, executor_threads)
+        self.metrics_app = make_metrics_asgi_app()
+        self.templates = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(
+                str(Path(__file__).parent / "templates")
+            ),
+            autoescape=True,
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        path = scope["path"]
+        targets_path = f"{self.prefix}/targets"
+        if self.limiter is not None and is_limited(
+            path, scope["query_string"].decode(), targets_path
+        ):
+            await self.limited(scope, receive, send)
+            return
+
+        await self.route(scope, receive, send)
+
+    async def limited(self, scope, receive, send):
+        if not self.limiter.acquire():
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 503,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"content-length", str(len(SHED_BODY)).encode()),
+                        (b"retry-after", str(RETRY_AFTER_SECONDS).encode()),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": SHED_BODY})
+            return
+        start = time.perf_counter()
+        try:
+            await self.route(scope, receive, send)
+        finally:
+            self.limiter.release(time.perf_counter() - start)
+
+    async def route(self, scope, receive, send):
+        path = scope["path"]
+        targets_path = f"{self.prefix}/targets"
+        scrape_configs_path = f"{self.prefix}/scrape_configs/"
+        debug_jobs_path = f"{self.prefix}/debug/jobs/"
+
+        if path in ("/metrics", f"{self.prefix}/metrics"):
+            await self.metrics_app(scope, receive, send)
+        elif path == f"{targets_path}/_bulk" and scope["method"] == "POST":
+            await self.get_targets_bulk(receive, send)
+        elif path == targets_path:
+            await self.get_targets(scope, send, "")
+        elif path.startswith(targets_path + "/"):
+            await self.get_targets(
+                scope, send, path.removeprefix(targets_path + "/")
+            )
+        elif path.startswith(scrape_configs_path):
+            await self.get_scrape_configs(
+                scope, send, path.removeprefix(scrape_configs_path)
+            )
+        elif path.startswith(debug_jobs_path):
+            await self.send_json(
+                send,
+                *debug_job(
+                    self.dispatcher, path.removeprefix(debug_jobs_path)
+                ),
+            )
+        elif path == f"{self.prefix}/":
+            await self.admin(send)
+        else:
+            await self.send_json(send, 404, {"error": "not found"})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                asyncio.get_running_loop().set_default_executor(
+                    ThreadPoolExecutor(max_workers=self.executor_threads)
+                )
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def run_blocking(self, func, *args, **kwargs):
+        return asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(func, *args, **kwargs)
+        )
+
+    async def send_response(self, send, status, content_type, body: bytes):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", content_type),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def send_json(self, send, status, data):
+        await self.send_response(
+            send, status, b"application/json", json.dumps(data).encode()
+        )
+
+    async def get_targets(self, scope, send, rest_path):
+        args = parse_query_args(scope["query_string"].decode())
+
+        if args.get("debug") == "true":
+            status, body = await self.run_blocking(
+                debug_targets, self.dispatcher, rest_path, args
+            )
+            if "job_id" in body:
+                body["result_url"] = (
+                    f"{self.prefix}/debug/jobs/{body['job_id']}"
+                )
+            await self.send_json(send, status, body)
+            return
+
+        refresh_interval = None
+        header = REFRESH_INTERVAL_HEADER.lower().encode()
+        for name, value in scope.get("headers", []):
+            if name == header:
+                refresh_interval = parse_refresh_interval(value.decode())
+
+        if not is_served(rest_path):
+            await self.send_result(send, not_served(rest_path))
+            return
+
+        if "watch" in args:
+            try:
+                args, etag, timeout = parse_watch_args(args)
+                full_path = await self.run_blocking(
+                    watched_key, self.dispatcher, rest_path, args
+                )
+            except ValueError as e:
+                await self.send_json(send, 400, {"error": str(e)})
+                return
+            if not await self.wait_changed(full_path, etag, timeout):
+                await self.send_result(send, TargetsResult(304, etag=etag))
+                return
+
+        result = await self.run_blocking(
+            serve_targets, self.dispatcher, rest_path, args, refresh_interval
+        )
+        await self.send_result(send, result)
+
+    async def wait_changed(self, full_path, etag, timeout) -> bool:
+        """Wait up to ``timeout`` seconds until the targets of ``full_path``
+        are different from ``etag``, on the loop, not in a thread."""
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+
+        def wake():
+            loop.call_soon_threadsafe(changed.set)
+
+        notifier = self.dispatcher.notifier
+        notifier.add_callback(full_path, wake)
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                # cleared before the check, a change after it is not missed
+                changed.clear()
+                if await self.run_blocking(
+                    targets_changed, self.dispatcher, full_path, etag
+                ):
+                    return True
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return False
+                try:
+                    await asyncio.wait_for(
+                        changed.wait(), min(remaining, WATCH_POLL_SECONDS)
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            notifier.remove_callback(full_path, wake)
+
+    async def get_targets_bulk(self, receive, send):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        try:
+            requests = parse_bulk_request(json.loads(body or b"null"))
+        except ValueError as e:
+            # json.JSONDecodeError is a ValueError too
+            await self.send_json(send, 400, {"error": str(e)})
+            return
+        body = await self.run_blocking(bulk_targets, self.dispatcher, requests)
+        await self.send_response(send, 200, b"application/json", body)
+
+    async def send_result(self, send, result):
+        if result.status == 304:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 304,
+                    "headers": [(b"etag", f'"{result.etag}"'.encode())],
+                }
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if result.entry is None:
+            await self.send_json(send, result.status, result.body)
+            return
+
+        entry = result.entry
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": response_headers(entry),
+                }
+            )
+            while True:
+                chunk = await self.run_blocking(_read_chunk, entry)
+                more_body = len(chunk) == CHUNK_SIZE
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": more_body,
+                    }
+                )
+                if not more_body:
+                    break
+        finally:
+            entry.close()
+
+    async def get_scrape_configs(self, scope, send, rest_path):
+        args = parse_query_args(scope["query_string"].decode())
+        result = await self.run_blocking(
+            lookup_scrape_configs, self.dispatcher, rest_path, args
+        )
+        await self.send_result(send, result)
+
+    async def admin(self, send):
+        index = self.dispatcher.index
+        # only the first call scans the root dir
+        paths = await self.run_blocking(index.paths, config.root_dir)
+        html = self.templates.get_template("admin.html").render(
+            prefix=self.prefix,
+            paths=paths,
+            rows=index.rows(),
+            version=VERSION,
+        )
+        await self.send_response(
+            send, 200, b"text/html; charset=utf-8", html.encode()
+        )
+
+
+def create_asgi_app(
+    prefix, dispatcher, executor_threads=64, shed_latency=0
+) -> ASGIApp:
+    return ASGIApp(
+        prefix,
+        dispatcher,
+        executor_threads=executor_threads,
+        shed_latency=shed_latency,
+    )
@@ -0,0 +1,355 @@
+import contextlib
+import fcntl
+import hashlib
+import io
+import json
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# The cache file starts with a one line json header, the header is small and
+# is the only part we need to parse to decide if the cache is fresh, the rest
+# of the file is the already encoded json payload which is sent to the client
+# as it is.
+MAX_HEADER_BYTES = 4096
+
+SQLITE_FILENAME = "cache.sqlite3"
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+# the lock of the leases of a FileCacheStore, in its cache_location
+LEASE_LOCK_FILENAME = "leases.lock"
+
+
+class CacheError(Exception):
+    """Cache is not valid"""
+
+
+class CacheNotValidJson(CacheError):
+    """Cache file is not a valid json"""
+
+
+class CacheNotExist(CacheError):
+    """Cache not exist"""
+
+
+class CacheExpired(CacheError):
+    def __init__(self, updated_timestamp, cache_excepire_seconds) -> None:
+        super().__init__("Cache file expired")
+        self.updated_timestamp = updated_timestamp
+        self.cache_excepire_seconds = cache_excepire_seconds
+
+
+class CacheEntry:
+    """An opened cache entry, the stream is positioned at the payload."""
+
+    def __init__(self, header: dict, stream) -> None:
+        self.header = header
+        self.stream = stream
+
+    @property
+    def updated_timestamp(self) -> float:
+        return self.header["updated_timestamp"]
+
+    @property
+    def size(self) -> int:
+        return self.header["size"]
+
+    @property
+    def target_count(self) -> int:
+        return self.header.get("target_count", 0)
+
+    @property
+    def etag(self) -> str:
+        # caches written before etags were added
+        return self.header.get("etag") or str(self.updated_timestamp)
+
+    @property
+    def version(self) -> Optional[int]:
+        return self.header.get("version")
+
+    @property
+    def content_type(self) -> str:
+        return self.header.get("content_type", "application/json")
+
+    def read(self) -> bytes:
+        try:
+            return self.stream.read()
+        finally:
+            self.stream.close()
+
+    def close(self):
+        self.stream.close()
+
+
+def _is_valid_header(header) -> bool:
+    return (
+        isinstance(header, dict)
+        and "updated_timestamp" in header
+        and "size" in header
+    )
+
+
+class FileCacheStore:
+    """One file per key under ``cache_location``."""
+
+    def __init__(self, cache_location: Path) -> None:
+        self.cache_location = Path(cache_location)
+
+    def _hash_key(self, key) -> str:
+        md5_hash = hashlib.md5(key.encode()).hexdigest()
+        return md5_hash
+
+    def location(self, key) -> Path:
+        return self.cache_location / self._hash_key(key)
+
+    def save(self, key: str, header: dict, payload: bytes):
+        flocation = self.location(key)
+        # write into a temp file then rename, so readers never see a half
+        # written file
+        tmp_location = flocation.with_name(
+            f"{flocation.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        with open(tmp_location, "wb") as f:
+            f.write(json.dumps(header).encode())
+            f.write(b"\n")
+            f.write(payload)
+        os.replace(tmp_location, flocation)
+
+    def open(self, key: str) -> CacheEntry:
+        cache_file = self.location(key)
+
+        try:
+            f = open(cache_file, "rb")
+        except FileNotFoundError:
+            raise CacheNotExist()
+
+        try:
+            header = json.loads(f.readline(MAX_HEADER_BYTES))
+            if not _is_valid_header(header):
+                raise ValueError("invalid cache header")
+            if os.fstat(f.fileno()).st_size - f.tell() != header["size"]:
+                raise ValueError("payload size mismatch")
+        except ValueError:
+            f.close()
+            logger.warning(
+                "Cache file %s is not a valid cache, delete it...",
+                cache_file,
+            )
+            cache_file.unlink(missing_ok=True)
+            raise CacheNotValidJson()
+
+        return CacheEntry(header, f)
+
+    def delete(self, key: str):
+        self.location(key).unlink(missing_ok=True)
+
+    def read_header(self, key: str) -> Optional[dict]:
+        try:
+            entry = self.open(key)
+        except CacheError:
+            return None
+        entry.close()
+        return entry.header
+
+    def _lease_location(self, key) -> Path:
+        return self.cache_location / f"{self._hash_key(key)}.lease"
+
+    def _read_lease(self, lease_file: Path) -> Optional[dict]:
+        try:
+            return json.loads(lease_file.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_lease(self, lease_file: Path, owner: str, ttl: float) -> Path:
+        """Write the lease into a temp file next to ``lease_file``, so that
+        it is put in place at once and is never read half written."""
+        tmp_location = lease_file.with_name(
+            f"{lease_file.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        tmp_location.write_text(
+            json.dumps({"owner": owner, "expires_at": time.time() + ttl})
+        )
+        return tmp_location
+
+    @contextlib.contextmanager
+    def _lease_lock(self):
+        """Only one replica at a time checks and changes the leases,
+        otherwise two could both see one free or expired and both take it.
+        The leases are small and short, one lock file for all of them."""
+        with open(self.cache_location / LEASE_LOCK_FILENAME, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _is_owner(self, lease_file: Path, owner: str) -> bool:
+        current = self._read_lease(lease_file)
+        return current is not None and current.get("owner") == owner
+
+    def acquire_lease(self, key: str, owner: str, ttl: float) -> bool:
+        """Create ``<key>.lease`` if it does not exist, a lease that is
+        expired (the owner died or hang) is taken over by replacing it."""
+        lease_file = self._lease_location(key)
+        tmp_location = self._write_lease(lease_file, owner, ttl)
+        try:
+            with self._lease_lock():
+                current = self._read_lease(lease_file)
+                if current is not None and (
+                    current.get("owner") != owner
+                    and current.get("expires_at", 0) > time.time()
+                ):
+                    return False
+                if current is not None:
+                    logger.info("Take over expired lease %s", lease_file)
+                os.replace(tmp_location, lease_file)
+                return True
+        finally:
+            tmp_location.unlink(missing_ok=True)
+
+    def renew_lease(self, key: str, owner: str, ttl: float) -> bool:
+        """Extend the lease of ``owner`` by ``ttl`` from now, return False
+        if it is not the owner any more."""
+        lease_file = self._lease_location(key)
+        with self._lease_lock():
+            if not self._is_owner(lease_file, owner):
+                return False
+            os.replace(self._write_lease(lease_file, owner, ttl), lease_file)
+            return True
+
+    def release_lease(self, key: str, owner: str):
+        lease_file = self._lease_location(key)
+        with self._lease_lock():
+            if self._is_owner(lease_file, owner):
+                lease_file.unlink(missing_ok=True)
+
+
+class SQLiteCacheStore:
+    """All keys in a single SQLite database in WAL mode.
+
+    WAL lets many readers (threads, or other ``serve`` processes on the same
+    host) read while one writer replaces an entry, and reading a key only
+    touches the row of that key.
+    """
+
+    def __init__(self, db_path: Path) -> None:
+        self.db_path = str(db_path)
+        self._local = threading.local()
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " header TEXT NOT NULL,"
+            " payload BLOB NOT NULL"
+            ")"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            " key TEXT PRIMARY KEY,"
+            " owner TEXT NOT NULL,"
+            " expires_at REAL NOT NULL"
+            ")"
+        )
+        logger.info("Using sqlite cache store at %s", self.db_path)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # sqlite connections can not be shared between threads
+            conn = sqlite3.connect(
+                self.db_path, timeout=30, isolation_level=None
+            )
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+            self._local.conn = conn
+        return conn
+
+    def save(self, key: str, header: dict, payload: bytes):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO cache (key, header, payload)"
+            " VALUES (?, ?, ?)",
+            (key, json.dumps(header), payload),
+        )
+
+    def open(self, key: str) -> CacheEntry:
+        row = (
+            self._connection()
+            .execute("SELECT header, payload FROM cache WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            raise CacheNotExist()
+
+        header, payload = row
+        try:
+            header = json.loads(header)
+        except ValueError:
+            header = None
+        if not _is_valid_header(header):
+            logger.warning("Cache of %s is not a valid cache, delete it", key)
+            self._connection().execute(
+                "DELETE FROM cache WHERE key = ?", (key,)
+            )
+            raise CacheNotValidJson()
+        return CacheEntry(header, io.BytesIO(payload))
+
+    def delete(self, key: str):
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def read_header(self, key: str) -> Optional[dict]:
+        row = (
+            self._connection()
+            .execute("SELECT header FROM cache WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        try:
+            header = json.loads(row[0])
+        except ValueError:
+            return None
+        if not _is_valid_header(header):
+            return None
+        return header
+
+    def acquire_lease(self, key: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(key) DO UPDATE SET"
+            " owner = excluded.owner, expires_at = excluded.expires_at"
+            " WHERE leases.expires_at < ? OR leases.owner = excluded.owner",
+            (key, owner, now + ttl, now),
+        )
+        return cursor.rowcount == 1
+
+    def renew_lease(self, key: str, owner: str, ttl: float) -> bool:
+        cursor = self._connection().execute(
+            "UPDATE leases SET expires_at = ? WHERE key = ? AND owner = ?",
+            (time.time() + ttl, key, owner),
+        )
+        return cursor.rowcount == 1
+
+    def release_lease(self, key: str, owner: str):
+        self._connection().execute(
+            "DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner)
+        )
+
+
+CACHE_STORES = ("file", "sqlite")
+
+
+def create_cache_store(store_type: str, cache_location: Path):
+    if store_type == "file":
+        return FileCacheStore(cache_location)
+    elif store_type == "sqlite":
+        return SQLiteCacheStore(Path(cache_location) / SQLITE_FILENAME)
+    raise ValueError(f"Unknown cache store: {store_type}")
@@ -1,12 +1,156 @@
 import logging
+import signal
 import sys
+import threading
 import click
-import waitress
 
+from .cache_store import CACHE_STORES
 from .mem_perf import start_tracing_thread
 from .config import config
+from . import load_shedding
+from .fair_queue import parse_concurrency, parse_weights
+from .metrics import PATH_LABEL_STRATEGIES, path_labeler
+from .mounts import parse_mounts
+from .prefork import (
+    Prefork,
+    create_socket,
+    create_task_queue,
+    enable_multiprocess_metrics,
+    serve_waitress,
+)
+from .params import UNDECLARED_PARAMS_POLICIES
+from .reload import Reloader, load_config_file
 from .validate import validate
-from .app import create_app
+from .app import create_app, create_dispatcher
+
+
+def tenant_weight_callback(ctx, param, value):
+    try:
+        return parse_weights(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def tenant_concurrency_callback(ctx, param, value):
+    try:
+        return parse_concurrency(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def mount_callback(ctx, param, value):
+    try:
+        return parse_mounts(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def config_file_callback(ctx, param, value):
+    if value:
+        try:
+            load_config_file(value)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+    return value
+
+
+def path_label_callback(ctx, param, value):
+    try:
+        path_labeler.configure(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    return value
+
+
+path_label_option = click.option(
+    "--metrics-path-label",
+    default="full",
+    callback=path_label_callback,
+    help=(
+        "How to label the request metrics by path, to bound the number of"
+        f" series: {', '.join(PATH_LABEL_STRATEGIES)}. full: the path as it"
+        " is; l1, l2, depth:<n>: only the first 1, 2 or n directories;"
+        " first:<n>: the first n paths requested since the start, others"
+        " are labeled other"
+    ),
+)
+
+partial_results_option = click.option(
+    "--partial-results",
+    is_flag=True,
+    help=(
+        "If a generator fails, use its last good result (or leave it out if"
+        " it never succeeded) instead of failing the whole path"
+    ),
+)
+
+undeclared_params_option = click.option(
+    "--undeclared-params",
+    type=click.Choice(UNDECLARED_PARAMS_POLICIES),
+    default="drop",
+    help=(
+        "What to do with the query parameters that no generator of the path"
+        " declares (by QUERY_PARAMS or the arguments of generate_targets):"
+        " drop them, so they do not make a new cache key; reject the request"
+        " with 400; or keep them and pass them to the generators"
+    ),
+)
+
+shed_latency_option = click.option(
+    "--shed-latency",
+    default=0.0,
+    help=(
+        "Limit the concurrent /targets requests adaptively (AIMD) to keep"
+        " their latency under this many seconds, requests beyond the limit"
+        " get a 503 with Retry-After. The limit is at most --threads. 0"
+        " disables it"
+    ),
+)
+
+
+def redis_pool_options(func):
+    """The options of the Redis connection pool shared by a process."""
+    options = (
+        click.option(
+            "--redis-max-connections",
+            type=int,
+            help=(
+                "The most connections to Redis of this process, shared by"
+                " the cache, the queue and all the workers. Default: 128, or"
+                " 2 per worker and 4 more if that is more"
+            ),
+        ),
+        click.option(
+            "--redis-socket-keepalive/--no-redis-socket-keepalive",
+            default=True,
+            help="Enable TCP keepalive on the Redis connections",
+        ),
+        click.option(
+            "--redis-health-check-interval",
+            default=30,
+            help=(
+                "Check that an idle Redis connection is alive with a PING"
+                " before using it, if it was idle this many seconds, 0"
+                " disables it"
+            ),
+        ),
+    )
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+tenant_weight_option = click.option(
+    "--tenant-weight",
+    "tenant_weights",
+    multiple=True,
+    callback=tenant_weight_callback,
+    help=(
+        "Refresh jobs are scheduled fairly between top level directories,"
+        " give a directory a bigger share by <dir>=<weight>, default weight"
+        " is 1. Can be used multiple times"
+    ),
+)
 
 
 def config_log(level):
@@ -43,6 +187,16 @@ def main(log_level):
     "--connection-limit", "-c", default=1000, help="Server connection limit"
 )
 @click.option("--threads", "-t", default=64, help="Server threads")
+@click.option(
+    "--server",
+    type=click.Choice(["waitress", "asgi"]),
+    default="waitress",
+    help=(
+        "waitress: WSGI server, one of --threads per request. asgi: serve"
+        " from an event loop with uvicorn (the asgi extra), --threads"
+        " is then the threads for blocking work like reading the cache"
+    ),
+)
 @click.option(
     "--url_prefix",
     "-r",
@@ -54,12 +208,44 @@ def main(log_level):
 )
 @click.argument(
     "root_dir",
+    required=False,
     type=click.Path(exists=True, file_okay=False, dir_okay=True),
 )
+@click.option(
+    "--mount",
+    "mounts",
+    multiple=True,
+    callback=mount_callback,
+    help=(
+        "Serve one more root dir under /targets/<name> by <name>=<dir>, as"
+        " the <name> directory of ROOT_DIR. All the dirs share the update"
+        " threads, the cache and the metrics. Can be used multiple times,"
+        " ROOT_DIR can be left out then"
+    ),
+)
 @click.option(
     "--cache-dir",
     type=click.Path(exists=True, file_okay=False, dir_okay=True),
 )
+@click.option(
+    "--cache-store",
+    type=click.Choice(CACHE_STORES),
+    default="file",
+    help=(
+        "How to store the cache under --cache-dir: file, one file per path;"
+        " sqlite, a single sqlite database in WAL mode that can be shared by"
+        " multiple serve processes on the same host"
+    ),
+)
+@click.option(
+    "--shared-cache",
+    is_flag=True,
+    help=(
+        "Multiple serve replicas share the same --cache-dir, coordinate via"
+        " leases so that every path is only refreshed by one replica per"
+        " --cache-refresh-interval"
+    ),
+)
 @click.option(
     "--cache-seconds", "-m", default=300, help="Cache expire seconds"
 )
@@ -71,6 +257,40 @@ def main(log_level):
     default=1024,
     help="Threads to execute user script in the background",
 )
+@tenant_weight_option
+@click.option(
+    "--tenant-concurrency",
+    multiple=True,
+    callback=tenant_concurrency_callback,
+    help=(
+        "Run at most <jobs> refresh jobs of a top level directory or mount"
+        " at the same time by <dir>=<jobs>, default is no limit but"
+        " --update-threads. Can be used multiple times"
+    ),
+)
+@partial_results_option
+@path_label_option
+@undeclared_params_option
+@shed_latency_option
+@click.option(
+    "--processes",
+    default=1,
+    help=(
+        "Serve from this many processes sharing the listening socket, so"
+        " requests use more than one core. The generators run in one more"
+        " process, the results are shared through --cache-dir"
+    ),
+)
+@click.option(
+    "--config",
+    "config_file",
+    type=click.Path(exists=True, dir_okay=False),
+    callback=config_file_callback,
+    help=(
+        "A yaml file of settings overriding the options, applied again on"
+        " SIGHUP, see reload.py"
+    ),
+)
 @click.option(
     "--enable-tracer",
     "-v",
@@ -90,15 +310,32 @@ def serve(
     port,
     connection_limit,
     threads,
+    server,
     url_prefix,
     root_dir,
+    mounts,
     cache_dir,
+    cache_store,
+    shared_cache,
     cache_seconds,
     cache_refresh_interval,
     update_threads,
+    tenant_weights,
+    tenant_concurrency,
+    partial_results,
+    metrics_path_label,
+    undeclared_params,
+    shed_latency,
+    processes,
+    config_file,
     enable_tracer,
     sentry_url,
 ):
+    if processes > 1:
+        # metrics of all processes are collected from a shared dir, this
+        # runs the command again if it is not set up yet
+        enable_multiprocess_metrics(sys.argv[1:])
+
     if sentry_url:
         try:
             import sentry_sdk
@@ -119,26 +356,136 @@ def serve(
             ],
         )
         print("sentry sdk initialized!")
-    config.root_dir = root_dir
-
-    app = create_app(
-        url_prefix,
-        cache_dir,
-        cache_seconds,
-        cache_refresh_interval,
-        update_threads,
+    if not root_dir and not mounts:
+        raise click.UsageError("ROOT_DIR or --mount is required")
+    config.root_dir = root_dir or ""
+    config.mounts = mounts
+    config.undeclared_params = undeclared_params
+
+    dispatcher_options = dict(
+        cache_store=cache_store,
+        shared_cache=shared_cache,
+        tenant_weights=tenant_weights,
+        tenant_concurrency=tenant_concurrency,
+        partial_results=partial_results,
     )
 
-    if enable_tracer:
-        start_tracing_thread()
+    if server == "asgi":
+        try:
+            import uvicorn
+        except ImportError:
+            print(
+                "import uvicorn failed, please install the asgi extra:"
+                " pip install 'prometheus-http-sd[asgi]'"
+            )
+            sys.exit(2)
+        from .asgi import create_asgi_app
+
+    def run_server(ready=None, task_queue=None, sock=None):
+        if server == "asgi":
+            dispatcher = create_dispatcher(
+                cache_dir,
+                cache_seconds,
+                cache_refresh_interval,
+                update_threads,
+                task_queue=task_queue,
+                **dispatcher_options,
+            )
+            app = create_asgi_app(
+                url_prefix,
+                dispatcher,
+                executor_threads=threads,
+                shed_latency=shed_latency,
+            )
+        else:
+            app = create_app(
+                url_prefix,
+                cache_dir,
+                cache_seconds,
+                cache_refresh_interval,
+                update_threads,
+                shed_latency=shed_latency,
+                max_concurrency=threads,
+                task_queue=task_queue,
+                **dispatcher_options,
+            )
+            dispatcher = app.extensions["dispatcher"]
+
+        reloader = Reloader(dispatcher, config_file)
+        reloader.load()
+        if ready is None:
+            signal.signal(signal.SIGHUP, reloader.handle_signal)
+        else:
+            # the parent replaces this process on reload
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        if enable_tracer:
+            start_tracing_thread()
+
+        if server == "asgi":
+            uvicorn_server = uvicorn.Server(
+                uvicorn.Config(
+                    app,
+                    host=host,
+                    port=port,
+                    limit_concurrency=connection_limit,
+                    access_log=False,
+                    log_config=None,
+                )
+            )
+            if ready:
+                ready()
+            # uvicorn finishes the requests in progress on SIGTERM itself
+            uvicorn_server.run(sockets=[sock] if sock else None)
+            return
+
+        if sock is None:
+            load_shedding.serve(
+                app,
+                host=host,
+                port=port,
+                connection_limit=connection_limit,
+                threads=threads,
+            )
+            return
+        serve_waitress(
+            load_shedding.create_server(
+                app,
+                sockets=[sock],
+                connection_limit=connection_limit,
+                threads=threads,
+            ),
+            ready,
+        )
 
-    waitress.serve(
-        app,
-        host=host,
-        port=port,
-        connection_limit=connection_limit,
-        threads=threads,
-    )
+    if processes <= 1:
+        run_server()
+        return
+
+    sock = create_socket(host, port)
+    task_queue = create_task_queue()
+
+    def run_scheduler(ready):
+        dispatcher = create_dispatcher(
+            cache_dir,
+            cache_seconds,
+            cache_refresh_interval,
+            update_threads,
+            **dispatcher_options,
+        )
+        reloader = Reloader(dispatcher, config_file)
+        reloader.load()
+        # reloads in place, the tasks are kept
+        signal.signal(signal.SIGHUP, reloader.handle_signal)
+        dispatcher.start_receiver(task_queue)
+        ready()
+        threading.Event().wait()
+
+    Prefork(
+        processes,
+        run_scheduler,
+        lambda ready: run_server(ready, task_queue, sock),
+    ).run()
 
 
 @main.command(help="Run and verify the generators under target directory.")
@@ -192,6 +539,27 @@ def check(root_dir, ignore_path):
     default=20,
     help="Python logging level (0-50)",
 )
+@path_label_option
+@undeclared_params_option
+@shed_latency_option
+@redis_pool_options
+@click.option(
+    "--local-cache-size",
+    default=1024,
+    help=(
+        "Keep the results of this many most recently read paths in memory,"
+        " dropped when a worker writes them, so reading them does not go"
+        " to Redis. 0 disables it"
+    ),
+)
+@click.option(
+    "--local-cache-bytes",
+    default=64 * 1024 * 1024,
+    help=(
+        "At most this many bytes of results are kept in memory, the least"
+        " recently read are dropped first"
+    ),
+)
 def server_only(
     host,
     port,
@@ -202,6 +570,14 @@ def server_only(
     cache_seconds,
     redis_url,
     log_level,
+    metrics_path_label,
+    undeclared_params,
+    shed_latency,
+    redis_max_connections,
+    redis_socket_keepalive,
+    redis_health_check_interval,
+    local_cache_size,
+    local_cache_bytes,
 ):
     # Configure logging
     config_log(log_level)
@@ -213,18 +589,27 @@ def server_only(
     config.__init__()
     config.root_dir = root_dir
     config.redis_url = redis_url
+    if redis_max_connections is not None:
+        config.redis_max_connections = redis_max_connections
+    config.redis_socket_keepalive = redis_socket_keepalive
+    config.redis_health_check_interval = redis_health_check_interval
     config.cache_expire_seconds = cache_seconds
+    config.undeclared_params = undeclared_params
 
     app = create_server_app(
         url_prefix,
         cache_seconds,
+        shed_latency=shed_latency,
+        max_concurrency=threads,
+        local_cache_size=local_cache_size,
+        local_cache_bytes=local_cache_bytes,
     )
 
     logger = logging.getLogger(__name__)
     logger.info(f"Starting server-only instance on {host}:{port}")
     logger.info("Workers must be started separately to process jobs.")
 
-    waitress.serve(
+    load_shedding.serve(
         app,
         host=host,
         port=port,
@@ -269,6 +654,10 @@ def server_only(
     default=8081,
     help="The port for worker metrics endpoint",
 )
+@tenant_weight_option
+@partial_results_option
+@path_label_option
+@redis_pool_options
 @click.argument(
     "root_dir",
     type=click.Path(exists=True, file_okay=False, dir_okay=True),
@@ -281,6 +670,12 @@ def worker_only(
     log_level,
     host,
     port,
+    tenant_weights,
+    partial_results,
+    metrics_path_label,
+    redis_max_connections,
+    redis_socket_keepalive,
+    redis_health_check_interval,
     root_dir,
 ):
     """Start a worker-only instance that processes jobs from Redis queue."""
@@ -288,16 +683,29 @@ def worker_only(
     config_log(log_level)
 
     from .config import config
+    from .redis.pool import worker_max_connections
     from .redis.worker import WorkerPool
 
     # Initialize config
     config.__init__()
     config.root_dir = root_dir
     config.redis_url = redis_url
+    config.redis_socket_keepalive = redis_socket_keepalive
+    config.redis_health_check_interval = redis_health_check_interval
     config.cache_expire_seconds = cache_seconds
+    config.tenant_weights = tenant_weights
+    config.partial_results = partial_results
 
     # Use WorkerPool for both single worker and multiple workers
     num_workers = 1 if worker_id else num_workers
+    try:
+        config.redis_max_connections = worker_max_connections(
+            num_workers, redis_max_connections
+        )
+    except ValueError as e:
+        raise click.BadParameter(
+            str(e), param_hint="'--redis-max-connections'"
+        )
     worker_pool = WorkerPool(
         num_workers,
         first_worker_id=worker_id,
@@ -1,12 +1,29 @@
+from typing import Dict
+
+
 class Config:
     root_dir: str
+    mounts: Dict[str, str]
     redis_url: str
     cache_expire_seconds: int
+    tenant_weights: Dict[str, float]
+    partial_results: bool
+    undeclared_params: str
+    redis_max_connections: int
+    redis_socket_keepalive: bool
+    redis_health_check_interval: int
 
     def __init__(self) -> None:
         self.root_dir = ""
+        self.mounts = {}
         self.redis_url = "redis://localhost:6379/0"
         self.cache_expire_seconds = 300
+        self.tenant_weights = {}
+        self.partial_results = False
+        self.undeclared_params = "drop"
+        self.redis_max_connections = 128
+        self.redis_socket_keepalive = True
+        self.redis_health_check_interval = 30
 
 
 config = Config()
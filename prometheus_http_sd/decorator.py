@@ -16,12 +16,14 @@ _thread_cache_count = Gauge(
     "httpsd_garbage_collection_cache_count",
     "Show current thread_cache count",
     ["name"],
+    multiprocess_mode="livesum",
 )
 
 _heap_cache_count = Gauge(
     "httpsd_garbage_collection_heap_count",
     "Show current heap length",
     ["name"],
+    multiprocess_mode="livesum",
 )
 
 _collection_run_interval = Histogram(
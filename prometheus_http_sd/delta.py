@@ -0,0 +1,138 @@
+"""Versions and group level diffs of the targets of a path, for
+``/targets/<path>?since=<version>``.
+
+The history of a path is a small json document stored next to its cache::
+
+    {
+        "version": 3,
+        "etag": "<etag of version 3>",
+        "hashes": ["<hash of every group in version 3>", ...],
+        "diffs": [
+            {"version": 2, "added": [<group>, ...], "removed": [...],
+             "bytes": <encoded size of the diff>},
+            {"version": 3, "added": [...], "removed": [...], "bytes": ...},
+        ],
+    }
+
+The version only increases when groups are added or removed, and only the
+last ``MAX_HISTORY`` diffs are kept, fewer if they take more than
+``MAX_HISTORY_BYTES``, the history is rewritten on every change.
+"""
+
+import hashlib
+import json
+from typing import Callable, List, Optional
+
+MAX_HISTORY = 50
+MAX_HISTORY_BYTES = 1024 * 1024
+
+
+def group_hash(group) -> str:
+    return hashlib.md5(
+        json.dumps(group, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+
+
+def diff_bytes(diff: dict) -> int:
+    size = diff.get("bytes")
+    if size is None:
+        # written before the size was stored
+        size = len(json.dumps(diff, separators=(",", ":")))
+    return size
+
+
+def parse_since(args: dict):
+    """Split the ``since`` parameter from the parameters for the
+    generators. Raise ValueError if it is not a version."""
+    args = dict(args)
+    since = args.pop("since", None)
+    if since is None:
+        return args, None
+    since = int(since)
+    if since < 0:
+        raise ValueError("since should not be negative")
+    return args, since
+
+
+def update_history(
+    history: Optional[dict],
+    targets: List,
+    etag: str,
+    previous_targets: Callable[[], List],
+) -> Optional[dict]:
+    """Return the history with ``targets`` as the latest version, or None if
+    the targets are not changed. ``previous_targets`` is called only when
+    groups were removed, to put them into the diff."""
+    if history is not None and history["etag"] == etag:
+        return None
+
+    hashes = [group_hash(group) for group in targets]
+    if history is None:
+        return {"version": 1, "etag": etag, "hashes": hashes, "diffs": []}
+
+    old_hashes = set(history["hashes"])
+    new_hashes = set(hashes)
+    history = dict(history, etag=etag, hashes=hashes)
+    if old_hashes == new_hashes:
+        # only the order is changed
+        return history
+
+    removed_hashes = old_hashes - new_hashes
+    removed = []
+    if removed_hashes:
+        removed = [
+            group
+            for group in previous_targets()
+            if group_hash(group) in removed_hashes
+        ]
+    added = [
+        group
+        for group, group_h in zip(targets, hashes)
+        if group_h not in old_hashes
+    ]
+    history["version"] += 1
+    diff = {"version": history["version"], "added": added, "removed": removed}
+    diff["bytes"] = diff_bytes(diff)
+    diffs = history["diffs"] + [diff]
+    del diffs[:-MAX_HISTORY]
+    total = sum(diff_bytes(d) for d in diffs)
+    while diffs and total > MAX_HISTORY_BYTES:
+        total -= diff_bytes(diffs.pop(0))
+    history["diffs"] = diffs
+    return history
+
+
+def delta_since(history: Optional[dict], since: int) -> Optional[dict]:
+    """The groups added and removed after version ``since``, or None if the
+    history does not go back that far, then a full snapshot should be
+    sent."""
+    if history is None:
+        return None
+    version = history["version"]
+    diffs = history["diffs"]
+    oldest = diffs[0]["version"] - 1 if diffs else version
+    if since < oldest or since > version:
+        return None
+
+    added, removed = {}, {}
+    for diff in diffs:
+        if diff["version"] <= since:
+            continue
+        for group in diff["removed"]:
+            h = group_hash(group)
+            if added.pop(h, None) is None:
+                removed[h] = group
+        for group in diff["added"]:
+            h = group_hash(group)
+            if removed.pop(h, None) is None:
+                added[h] = group
+    return {
+        "version": version,
+        "full": False,
+        "added": list(added.values()),
+        "removed": list(removed.values()),
+    }
+
+
+def full_snapshot(version: Optional[int], targets: List) -> dict:
+    return {"version": version or 0, "full": True, "targets": targets}
@@ -1,50 +1,89 @@
 from concurrent.futures import ThreadPoolExecutor
 import copy
-import hashlib
 import json
 import logging
+import os
 from pathlib import Path
+import socket
 import threading
 import time
-
-from .config import config
-from .sd import generate
+from typing import Optional, Tuple
+import uuid
+
+from .cache_store import (  # noqa: F401
+    CacheEntry,
+    CacheError,
+    CacheExpired,
+    CacheNotExist,
+    CacheNotValidJson,
+    FileCacheStore,
+)
+from .delta import update_history
+from .fair_queue import FairQueue, top_level_dir
+from .mounts import locate
+from .path_index import PathIndex
+from .profiling import ProfileJobs
+from .refresh_interval import key_expire_seconds
+from .watch import ChangeNotifier, compute_etag
+from .sd import generate, generate_partial, generate_scrape_configs
 from .metrics import (
     generator_latency,
+    path_labeler,
     queue_job_gauge,
     finished_jobs,
     dispatcher_started_counter,
+    shared_cache_skipped,
 )
 
 logger = logging.getLogger(__name__)
 
+# how often a serving process of ``serve --processes`` forwards the tasks
+# requested in it to the scheduler process
+FORWARD_INTERVAL = 1
+
+# the dispatcher checks the tasks at most this often, the tasks requested
+# after they are due are queued together
+SCHEDULE_RESOLUTION = 1
 
-class CacheError(Exception):
-    """Cache is not valid"""
+# what a task generates, the targets of a directory, or the scrape configs of
+# a python file
+TARGETS = "targets"
+SCRAPE_CONFIGS = "scrape_configs"
 
 
-class CacheNotValidJson(CacheError):
-    """Cache file is not a valid json"""
+def count_targets(targets) -> int:
+    if (
+        isinstance(targets, list)
+        and len(targets) > 0
+        and isinstance(targets[0], dict)
+    ):
+        return sum(len(t.get("targets", []) or []) for t in targets)
+    return 0
 
 
-class CacheNotExist(CacheError):
-    """Cache not exist"""
+def encode_targets(targets) -> bytes:
+    # the same compact format that flask.jsonify produces
+    return json.dumps(targets, separators=(",", ":")).encode()
 
 
-class CacheExpired(CacheError):
-    def __init__(self, updated_timestamp, cache_excepire_seconds) -> None:
-        super().__init__("Cache file expired")
-        self.updated_timestamp = updated_timestamp
-        self.cache_excepire_seconds = cache_excepire_seconds
+def encode_scrape_configs(generated) -> Tuple[bytes, str]:
+    """A scrape config generator may return a string, which is sent as it
+    is, like flask does for a view."""
+    if isinstance(generated, str):
+        return generated.encode(), "text/html; charset=utf-8"
+    return encode_targets(generated), "application/json"
 
 
 class Task:
-    def __init__(self, full_path, path, extra_args) -> None:
+    def __init__(self, full_path, path, extra_args, kind=TARGETS) -> None:
         self.full_path = full_path
         self.path = path
         self.extra_args = extra_args
+        self.kind = kind
         self.need_update = True
         self.running = False
+        # when the task was last put into the queue
+        self.last_queued = 0.0
 
 
 class Dispatcher:
@@ -54,6 +93,11 @@ class Dispatcher:
         max_workers: int,
         cache_location: Path,
         cache_expire_seconds: int,
+        cache_store=None,
+        shared_cache: bool = False,
+        tenant_weights=None,
+        partial_results: bool = False,
+        tenant_concurrency=None,
     ) -> None:
         self.interval = interval
         self.tasks = {}
@@ -61,9 +105,40 @@ class Dispatcher:
 
         logger.info("Create threadpool with workers=%d", max_workers)
         self.threadpool = ThreadPoolExecutor(max_workers=max_workers)
+        # the threadpool runs jobs in FIFO order, tasks are queued here per
+        # top level directory instead, every job submitted to the threadpool
+        # takes the fairest task at the time it starts to run.
+        self.queue = FairQueue(tenant_weights, tenant_concurrency)
         self.cache_location = cache_location
+        if cache_store is None:
+            cache_store = FileCacheStore(cache_location)
+        self.cache_store = cache_store
         self.cache_expire_seconds = cache_expire_seconds
 
+        # replicas sharing the same cache take a lease on a key before
+        # refreshing it, so that a key is refreshed once per interval
+        # instead of once per replica
+        self.shared_cache = shared_cache
+        self.owner_id = (
+            f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        )
+
+        # a failed generator does not fail the whole path, use its last
+        # good result instead
+        self.partial_results = partial_results
+
+        # ?debug=true runs the generators again in background
+        self.profile_jobs = ProfileJobs()
+
+        # what the admin page shows
+        self.index = PathIndex()
+
+        # wakes up the ?watch= requests when a cache is written
+        self.notifier = ChangeNotifier()
+
+        # set when a task is requested after it is due
+        self.wakeup = threading.Event()
+
         self.dispather_thread = None
 
     def run_forever(self):
@@ -77,33 +152,79 @@ class Dispatcher:
                 logger.warning("dispatcher thread died! restart it now")
                 self.start_dispatcher()
 
-            counter = 0
-
-            copy_start = time.time()
-            with self.tasks_lock:
-                task_pool = copy.copy(self.tasks)
-            copy_end = time.time()
-            logger.info(
-                "copy tasks done, took %s seconds", copy_end - copy_start
-            )
-
-            for task in task_pool.values():
-                if task.need_update:
-                    if not task.running:
-                        task.running = True
-                        logger.info(
-                            "Put into queue: full_path=%s", task.full_path
-                        )
-                        self.threadpool.submit(self.update, task)
-                        counter += 1
-                        queue_job_gauge.labels("pending").inc()
-                    task.need_update = False
+            checked_at = time.time()
+            counter, sleep_seconds = self.check_tasks()
             logger.info(
                 "All tasks checked, %d tasks added, now I sleep %d seconds",
                 counter,
-                self.interval,
+                sleep_seconds,
             )
-            time.sleep(self.interval)
+            # a task requested after it is due wakes us up earlier
+            self.wakeup.wait(sleep_seconds)
+            self.wakeup.clear()
+            # the tasks are requested one after another, check the ones
+            # requested in a short while together
+            time.sleep(max(checked_at + SCHEDULE_RESOLUTION - time.time(), 0))
+
+    def check_tasks(self, now: Optional[float] = None) -> Tuple[int, float]:
+        """Queue the requested tasks whose refresh interval has passed since
+        they were last queued, return how many, and how long until the
+        next task is due."""
+        if now is None:
+            now = time.time()
+        counter = 0
+
+        copy_start = time.time()
+        with self.tasks_lock:
+            task_pool = copy.copy(self.tasks)
+        copy_end = time.time()
+        logger.info("copy tasks done, took %s seconds", copy_end - copy_start)
+
+        sleep_seconds = self.interval
+        for task in task_pool.values():
+            interval = self.task_interval(task)
+            due = task.last_queued + interval
+            if task.need_update and task.running:
+                task.need_update = False
+            elif task.need_update and now >= due:
+                task.running = True
+                task.last_queued = now
+                due = now + interval
+                logger.info("Put into queue: full_path=%s", task.full_path)
+                self.queue.put(top_level_dir(task.path), task)
+                self.index.record_status(task.full_path, task.path, "queued")
+                self.threadpool.submit(self.update_next)
+                counter += 1
+                queue_job_gauge.labels("pending").inc()
+                task.need_update = False
+            # every task is due at its own interval, one requested after
+            # that wakes us up by ``request_task``
+            if due > now:
+                sleep_seconds = min(sleep_seconds, due - now)
+        return counter, sleep_seconds
+
+    def request_task(self, task, new: bool = False):
+        """The task is requested, it is refreshed once it is due."""
+        if task.need_update and not new:
+            return
+        task.need_update = True
+        if not task.running and (
+            time.time() >= task.last_queued + self.task_interval(task)
+        ):
+            self.wakeup.set()
+
+    def task_interval(self, task) -> float:
+        """How often the task is refreshed: the smallest refresh interval
+        its clients ask for, or the global interval."""
+        refresh_interval = self.index.refresh_interval(task.full_path)
+        if refresh_interval is None:
+            return self.interval
+        return refresh_interval
+
+    def expire_seconds(self, full_path) -> float:
+        return key_expire_seconds(
+            self.cache_expire_seconds, self.index.refresh_interval(full_path)
+        )
 
     def start_dispatcher(self):
         thread = threading.Thread(target=self.run_forever, daemon=True)
@@ -112,26 +233,160 @@ class Dispatcher:
         logger.info("dispather started")
         dispatcher_started_counter.inc()
 
+    def start_forwarder(self, task_queue):
+        """With ``serve --processes``, a serving process does not refresh
+        anything itself, it forwards the tasks requested in it to the
+        scheduler process, which calls ``receive_tasks``."""
+        # a debug job may be polled from another process
+        self.profile_jobs.store = self.cache_store
+        threading.Thread(
+            target=self.forward_tasks, args=(task_queue,), daemon=True
+        ).start()
+
+    def forward_tasks(self, task_queue):
+        while True:
+            time.sleep(FORWARD_INTERVAL)
+            with self.tasks_lock:
+                task_pool = list(self.tasks.values())
+            batch = []
+            for task in task_pool:
+                if task.need_update:
+                    task.need_update = False
+                    batch.append(
+                        (
+                            task.full_path,
+                            task.path,
+                            task.extra_args,
+                            task.kind,
+                            self.index.refresh_interval(task.full_path),
+                        )
+                    )
+            if batch:
+                task_queue.put(batch)
+
+    def start_receiver(self, task_queue):
+        threading.Thread(
+            target=self.receive_tasks, args=(task_queue,), daemon=True
+        ).start()
+
+    def receive_tasks(self, task_queue):
+        while True:
+            batch = task_queue.get()
+            for full_path, path, extra_args, kind, refresh_interval in batch:
+                self.append_task(full_path, path, extra_args, kind)
+                if refresh_interval is not None:
+                    self.index.record_refresh_interval(
+                        full_path, path, refresh_interval
+                    )
+
+    def update_next(self):
+        # the jobs of a tenant at its concurrency limit are skipped, they
+        # are run by the workers that finish its running jobs
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            try:
+                self.update(task)
+            finally:
+                self.queue.done(top_level_dir(task.path))
+
+    def claim(self, task) -> bool:
+        """Return False if another replica has refreshed this key in the
+        current interval, or is refreshing it right now."""
+        try:
+            if not self.cache_store.acquire_lease(
+                task.full_path, self.owner_id, self.lease_seconds(task)
+            ):
+                shared_cache_skipped.labels(reason="leased").inc()
+                return False
+
+            header = self.cache_store.read_header(task.full_path)
+            if header is not None and time.time() - header[
+                "updated_timestamp"
+            ] < self.task_interval(task):
+                self.cache_store.release_lease(task.full_path, self.owner_id)
+                shared_cache_skipped.labels(reason="fresh").inc()
+                return False
+        except Exception:
+            # can not coordinate, better to refresh it by ourself
+            logger.exception("Failed to claim full_path=%s", task.full_path)
+        return True
+
+    def lease_seconds(self, task) -> float:
+        # about one refresh interval, a replica that died holding the lease
+        # delays the refresh by that much, not until the cache expires; it
+        # is renewed while the refresh runs
+        return self.task_interval(task)
+
+    def renew_lease(self, task, done: threading.Event):
+        ttl = self.lease_seconds(task)
+        while not done.wait(ttl / 3):
+            try:
+                if not self.cache_store.renew_lease(
+                    task.full_path, self.owner_id, ttl
+                ):
+                    logger.warning(
+                        "Lost the lease of full_path=%s", task.full_path
+                    )
+                    return
+            except Exception:
+                logger.exception(
+                    "Failed to renew the lease of full_path=%s",
+                    task.full_path,
+                )
+
     def update(self, task):
+        if self.shared_cache and not self.claim(task):
+            logger.info(
+                "Task for full_path=%s is refreshed by another replica",
+                task.full_path,
+            )
+            task.running = False
+            queue_job_gauge.labels("pending").dec()
+            return
+
+        done = threading.Event()
+        if self.shared_cache:
+            threading.Thread(
+                target=self.renew_lease, args=(task, done), daemon=True
+            ).start()
+
         start_time = time.time()
         logger.info("Task for full_path=%s started", task.full_path)
         queue_job_gauge.labels("pending").dec()
         queue_job_gauge.labels("running").inc()
+        self.index.record_status(task.full_path, task.path, "refreshing")
         try:
-            targets = generate(config.root_dir, task.path, **task.extra_args)
-
-            data = {"updated_timestamp": time.time(), "results": targets}
-
-            flocation = self.get_cache_location(task.full_path)
-            with open(flocation, "w+") as f:
-                json.dump(data, f)
+            root, path = locate(task.path)
+            if task.kind == SCRAPE_CONFIGS:
+                generated = generate_scrape_configs(
+                    root, path, **task.extra_args
+                )
+                header = self.write_scrape_configs(task.full_path, generated)
+            elif self.partial_results:
+                targets = self.run_partial(task)
+                header = self.write_cache(task.full_path, targets)
+            else:
+                targets = generate(root, path, **task.extra_args)
+                header = self.write_cache(task.full_path, targets)
             duration = time.time() - start_time
-            generator_latency.labels(task.full_path, "success").observe(
-                duration
+            generator_latency.labels(
+                path_labeler.full_path_label(task.full_path, task.path),
+                "success",
+            ).observe(duration)
+            self.index.record_refresh(
+                task.full_path, task.path, "success", duration, header
             )
         except:  # noqa
             duration = time.time() - start_time
-            generator_latency.labels(task.full_path, "fail").observe(duration)
+            generator_latency.labels(
+                path_labeler.full_path_label(task.full_path, task.path),
+                "fail",
+            ).observe(duration)
+            self.index.record_refresh(
+                task.full_path, task.path, "failed", duration
+            )
             logger.exception(
                 "Error when run for task full_path=%s", task.full_path
             )
@@ -142,50 +397,214 @@ class Dispatcher:
                 task.full_path,
                 time.time() - start_time,
             )
+            if self.shared_cache:
+                done.set()
+                self.release(task)
             task.running = False
             queue_job_gauge.labels("running").dec()
             finished_jobs.inc()
 
-    def append_task(self, full_path, path, extra_args):
+    def release(self, task):
+        try:
+            self.cache_store.release_lease(task.full_path, self.owner_id)
+        except Exception:
+            logger.exception("Failed to release full_path=%s", task.full_path)
+
+    def append_task(self, full_path, path, extra_args, kind=TARGETS):
         task = self.tasks.get(full_path)
-        if not task:
+        new = task is None
+        if new:
             with self.tasks_lock:
                 task = self.tasks.setdefault(
-                    full_path, Task(full_path, path, extra_args)
+                    full_path, Task(full_path, path, extra_args, kind)
                 )
-        task.need_update = True
-
-    def _hash_key(self, full_path) -> str:
-        md5_hash = hashlib.md5(full_path.encode()).hexdigest()
-        return md5_hash
-
-    def get_cache_location(self, full_path) -> Path:
-        return self.cache_location / self._hash_key(full_path)
-
-    def get_targets(self, path: str, full_path: str, **extra_args):
-        self.append_task(full_path, path, extra_args)
-
-        cache_file = self.get_cache_location(full_path)
-
-        if not cache_file.exists():
-            raise CacheNotExist()
-
-        with open(cache_file) as f:
+        self.request_task(task, new)
+
+    def append_tasks(self, requests, kind=TARGETS):
+        """``append_task`` for many ``(full_path, path, extra_args)``,
+        the new tasks are added in a single pass under the lock."""
+        with self.tasks_lock:
+            for full_path, path, extra_args in requests:
+                task = self.tasks.get(full_path)
+                new = task is None
+                if new:
+                    task = self.tasks[full_path] = Task(
+                        full_path, path, extra_args, kind
+                    )
+                self.request_task(task, new)
+
+    def _generators_key(self, full_path) -> str:
+        return f"{full_path}#generators"
+
+    def run_partial(self, task):
+        """Generate in partial result mode, the result of every generator is
+        stored, to be used as the last good result when it fails next
+        time."""
+        key = self._generators_key(task.full_path)
+        last_good = self.read_generators(task.full_path).get("results", {})
+
+        root, path = locate(task.path)
+        targets, results, failures = generate_partial(
+            root, path, task.extra_args, last_good
+        )
+
+        # the errors go into the payload, not the header, a header must stay
+        # small enough to be parsed without reading the payload
+        payload = encode_targets({"results": results, "failures": failures})
+        header = {
+            "updated_timestamp": time.time(),
+            "size": len(payload),
+            "failure_count": len(failures),
+        }
+        self.cache_store.save(key, header, payload)
+        return targets
+
+    def read_generators(self, full_path) -> dict:
+        """The results and failures of every generator of the last refresh
+        in partial result mode."""
+        try:
+            entry = self.cache_store.open(self._generators_key(full_path))
+        except CacheError:
+            return {}
+        stored = json.loads(entry.read())
+        if "results" not in stored:
+            # written before the failures were stored with the results,
+            # generator paths are absolute so never "results"
+            return {"results": stored, "failures": {}}
+        return stored
+
+    def get_generator_failures(self, full_path) -> dict:
+        """The failed generators of the last refresh in partial result
+        mode."""
+        return self.read_generators(full_path).get("failures", {})
+
+    def write_cache(self, full_path, targets):
+        payload = encode_targets(targets)
+        etag = compute_etag(payload)
+        header = {
+            "updated_timestamp": time.time(),
+            "size": len(payload),
+            "target_count": count_targets(targets),
+            "etag": etag,
+        }
+        history = self.get_history(full_path)
+        updated = self.update_history(full_path, history, targets, etag)
+        if updated is not None:
+            history = updated
+        if history is not None:
+            header["version"] = history["version"]
+        self.cache_store.save(full_path, header, payload)
+        if updated is not None:
+            self.save_history(full_path, updated)
+        self.notifier.notify(full_path)
+        return header
+
+    def _history_key(self, full_path) -> str:
+        return f"{full_path}#history"
+
+    def get_history(self, full_path) -> Optional[dict]:
+        try:
+            entry = self.cache_store.open(self._history_key(full_path))
+        except CacheError:
+            return None
+        return json.loads(entry.read())
+
+    def save_history(self, full_path, history):
+        payload = encode_targets(history)
+        header = {"updated_timestamp": time.time(), "size": len(payload)}
+        self.cache_store.save(self._history_key(full_path), header, payload)
+
+    def update_history(
+        self, full_path, history, targets, etag
+    ) -> Optional[dict]:
+        """The history with ``targets`` as the latest version, or None if
+        the targets are not changed."""
+
+        def previous_targets():
             try:
-                data = json.load(f)
-            except json.decoder.JSONDecodeError:
-                logger.warning(
-                    "Cache file %s is not a valid json, delete it...",
-                    cache_file,
-                )
-                Path(cache_file).unlink()
-                raise CacheNotValidJson()
+                return json.loads(self.cache_store.open(full_path).read())
+            except CacheError:
+                return []
 
-        updated_timestamp = data["updated_timestamp"]
+        try:
+            updated = update_history(history, targets, etag, previous_targets)
+        except Exception:
+            # e.g. the targets are not a list of groups
+            logger.exception("Failed to update history of %s", full_path)
+            return history
+        return history if updated is None else updated
+
+    def write_scrape_configs(self, full_path, generated):
+        payload, content_type = encode_scrape_configs(generated)
+        header = {
+            "updated_timestamp": time.time(),
+            "size": len(payload),
+            "content_type": content_type,
+            "etag": compute_etag(payload),
+        }
+        self.cache_store.save(full_path, header, payload)
+        return header
+
+    def open_cache(self, full_path, path="") -> CacheEntry:
+        self.index.record_request(full_path, path)
+        return self.open_fresh_cache(full_path, path)
+
+    def open_fresh_cache(self, full_path, path="") -> CacheEntry:
+        """``open_cache`` without counting a request of the key."""
+        entry = self.cache_store.open(full_path)
+        self.index.record_cache(full_path, path, entry.header)
+
+        updated_timestamp = entry.updated_timestamp
         current = time.time()
-        if current - updated_timestamp > self.cache_expire_seconds:
+        expire_seconds = self.expire_seconds(full_path)
+        if current - updated_timestamp > expire_seconds:
+            entry.close()
             raise CacheExpired(
                 updated_timestamp=updated_timestamp,
-                cache_excepire_seconds=self.cache_expire_seconds,
+                cache_excepire_seconds=expire_seconds,
             )
-        return data["results"]
+        return entry
+
+    def get_targets_entry(
+        self, path: str, full_path: str, **extra_args
+    ) -> CacheEntry:
+        """Like get_targets, but return the opened cache without decoding
+        the payload, the caller must close the entry."""
+        self.append_task(full_path, path, extra_args)
+        return self.open_cache(full_path, path)
+
+    def get_fresh_targets_entry(
+        self, path: str, full_path: str, extra_args: dict
+    ) -> CacheEntry:
+        """Like get_targets_entry, but if the cache is not fresh, raise
+        without counting the request or queueing the task, the caller
+        falls back to get_targets_entry then."""
+        entry = self.open_fresh_cache(full_path, path)
+        self.index.record_request(full_path, path)
+        self.append_task(full_path, path, extra_args)
+        return entry
+
+    def get_targets_entries(self, requests) -> list:
+        """``get_targets_entry`` for many ``(full_path, path, extra_args)``,
+        the result of each request is either its opened cache entry or the
+        ``CacheError`` raised when opening it."""
+        self.append_tasks(requests)
+        results = []
+        for full_path, path, _ in requests:
+            try:
+                results.append(self.open_cache(full_path, path))
+            except CacheError as e:
+                results.append(e)
+        return results
+
+    def get_targets(self, path: str, full_path: str, **extra_args):
+        entry = self.get_targets_entry(path, full_path, **extra_args)
+        return json.loads(entry.read())
+
+    def get_scrape_configs_entry(
+        self, path: str, full_path: str, **extra_args
+    ) -> CacheEntry:
+        """The cached scrape configs of ``<root>/<path>.py``, which are
+        refreshed in background like targets."""
+        self.append_task(full_path, path, extra_args, kind=SCRAPE_CONFIGS)
+        return self.open_cache(full_path, path)
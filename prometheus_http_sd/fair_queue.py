@@ -0,0 +1,154 @@
+import collections
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from .config import config
+from .metrics import (
+    OTHER_PATHS,
+    tenant_queue_depth,
+    tenant_queue_wait_seconds,
+    tenant_running_jobs,
+)
+
+
+def top_level_dir(path: str) -> str:
+    """The tenant of a target path is its first level directory."""
+    return path.strip("/").split("/")[0]
+
+
+def tenant_label(tenant: str) -> str:
+    """The ``tenant`` label of the queue metrics, a tenant comes from the
+    requested path, only the ones that exist (a mount, or a directory or
+    scrape config file under the root dir) keep their own label, so that
+    requests of random paths can not add series."""
+    if not tenant or tenant in config.mounts:
+        return tenant
+    if config.root_dir:
+        location = os.path.join(config.root_dir, tenant)
+        if os.path.exists(location) or os.path.exists(f"{location}.py"):
+            return tenant
+    return OTHER_PATHS
+
+
+def parse_weights(weights) -> Dict[str, float]:
+    """Parse ``("team-a=3", "team-b=0.5")`` into a dict."""
+    result = {}
+    for weight in weights or ():
+        tenant, sep, value = weight.rpartition("=")
+        if not sep:
+            raise ValueError(f"weight should be <dir>=<weight>: {weight}")
+        value = float(value)
+        if value <= 0:
+            raise ValueError(f"weight should be positive: {weight}")
+        result[tenant] = value
+    return result
+
+
+def parse_concurrency(limits) -> Dict[str, int]:
+    """Parse ``("team-a=8",)`` into a dict."""
+    result = {}
+    for limit in limits or ():
+        tenant, sep, value = limit.rpartition("=")
+        if not sep:
+            raise ValueError(f"concurrency should be <dir>=<jobs>: {limit}")
+        value = int(value)
+        if value <= 0:
+            raise ValueError(f"concurrency should be positive: {limit}")
+        result[tenant] = value
+    return result
+
+
+class FairQueue:
+    """
+    Weighted fair queue, jobs are queued per tenant (the top level
+    directory) and dispatched by their virtual finish time, so that a tenant
+    with thousands of jobs can not starve the others. With weight ``w``, a
+    tenant gets ``w`` times the share of a tenant with weight 1 when all of
+    them have jobs waiting.
+
+    A tenant with a ``concurrency`` limit is skipped while that many of its
+    jobs are running, the caller reports a finished job by ``done``.
+    """
+
+    def __init__(
+        self,
+        weights: Optional[Dict[str, float]] = None,
+        concurrency: Optional[Dict[str, int]] = None,
+    ) -> None:
+        self.weights = weights or {}
+        self.concurrency = concurrency or {}
+        self._running = collections.Counter()
+        self._queues = {}
+        self._last_finish = {}
+        # the metrics label of the tenants with jobs queued or running, it
+        # stays the same until they have none, so the gauges add up
+        self._labels = {}
+        self._virtual_time = 0.0
+        self._lock = threading.Lock()
+
+    def weight(self, tenant: str) -> float:
+        return self.weights.get(tenant, 1.0)
+
+    def put(self, tenant: str, item):
+        with self._lock:
+            finish = max(
+                self._virtual_time, self._last_finish.get(tenant, 0.0)
+            ) + 1 / self.weight(tenant)
+            self._last_finish[tenant] = finish
+            queue = self._queues.setdefault(tenant, collections.deque())
+            queue.append((finish, time.time(), item))
+            label = self._labels.get(tenant)
+            if label is None:
+                label = self._labels[tenant] = tenant_label(tenant)
+        # many tenants may share the ``other`` label, so the gauges are
+        # moved by one instead of set to the numbers of a tenant
+        tenant_queue_depth.labels(tenant=label).inc()
+
+    def _full(self, tenant: str) -> bool:
+        limit = self.concurrency.get(tenant)
+        return limit is not None and self._running[tenant] >= limit
+
+    def get(self):
+        """Pop the next job, return None if there is no job, or all the
+        tenants with jobs are at their concurrency limit."""
+        with self._lock:
+            candidates = [
+                (q[0][0], t)
+                for t, q in self._queues.items()
+                if q and not self._full(t)
+            ]
+            if not candidates:
+                return None
+            _, tenant = min(candidates)
+            queue = self._queues[tenant]
+            finish, enqueued_at, item = queue.popleft()
+            self._virtual_time = finish
+            if not queue:
+                del self._queues[tenant]
+                del self._last_finish[tenant]
+            self._running[tenant] += 1
+            label = self._labels[tenant]
+        tenant_queue_depth.labels(tenant=label).dec()
+        tenant_running_jobs.labels(tenant=label).inc()
+        tenant_queue_wait_seconds.labels(tenant=label).observe(
+            time.time() - enqueued_at
+        )
+        return item
+
+    def done(self, tenant: str):
+        """A job of ``tenant`` returned by ``get`` is finished."""
+        with self._lock:
+            self._running[tenant] -= 1
+            if self._running[tenant] <= 0:
+                del self._running[tenant]
+            if tenant in self._queues or tenant in self._running:
+                label = self._labels[tenant]
+            else:
+                label = self._labels.pop(tenant)
+        tenant_running_jobs.labels(tenant=label).dec()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
@@ -0,0 +1,58 @@
+"""A lean WSGI handler for the hot route of ``serve``: a GET of
+``/targets/...`` whose targets are already cached. It looks up the cache by
+the canonical key and streams the cached bytes, without Flask routing,
+request contexts or logging. Everything else (cache misses, debug, admin,
+scrape configs) falls through to the wrapped Flask app."""
+
+from wsgiref.util import FileWrapper
+
+from .handler import lookup_cached_targets, parse_query_args
+from .refresh_interval import parse_refresh_interval
+
+BLOCK_SIZE = 256 * 1024
+
+
+class TargetsFastPath:
+    def __init__(self, app, prefix, dispatcher) -> None:
+        self.app = app
+        self.dispatcher = dispatcher
+        self.targets_path = prefix.rstrip("/") + "/targets/"
+
+    def __call__(self, environ, start_response):
+        if environ["REQUEST_METHOD"] != "GET":
+            return self.app(environ, start_response)
+
+        # PEP 3333: PATH_INFO is the raw bytes decoded as latin-1
+        try:
+            path = environ.get("PATH_INFO", "").encode("latin-1").decode()
+        except UnicodeError:
+            # not utf-8, flask handles it
+            return self.app(environ, start_response)
+        if not path.startswith(self.targets_path):
+            return self.app(environ, start_response)
+
+        args = parse_query_args(environ.get("QUERY_STRING", ""))
+        if args.get("debug") == "true" or "watch" in args or "since" in args:
+            return self.app(environ, start_response)
+
+        entry = lookup_cached_targets(
+            self.dispatcher,
+            path.removeprefix(self.targets_path),
+            args,
+            parse_refresh_interval(
+                environ.get("HTTP_X_PROMETHEUS_REFRESH_INTERVAL_SECONDS")
+            ),
+        )
+        if entry is None:
+            return self.app(environ, start_response)
+
+        headers = [
+            ("Content-Type", entry.content_type),
+            ("Content-Length", str(entry.size)),
+            ("ETag", f'"{entry.etag}"'),
+        ]
+        if entry.version is not None:
+            headers.append(("X-Targets-Version", str(entry.version)))
+        start_response("200 OK", headers)
+        file_wrapper = environ.get("wsgi.file_wrapper", FileWrapper)
+        return file_wrapper(entry.stream, BLOCK_SIZE)
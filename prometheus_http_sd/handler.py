@@ -0,0 +1,500 @@
+"""The request handling shared by the WSGI (Flask) and the ASGI apps of the
+``serve`` command."""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+from werkzeug.http import http_date
+
+from .cache_store import (
+    CacheEntry,
+    CacheError,
+    CacheExpired,
+    CacheNotExist,
+)
+from .delta import delta_since, full_snapshot, parse_since
+from .fair_queue import tenant_label
+from .mounts import is_served, locate
+from .params import params_index
+from .profiling import TooManyJobs
+from .metrics import (
+    OTHER_PATHS,
+    path_labeler,
+    path_last_generated_targets,
+    scrape_configs_requests_total,
+    scrape_configs_request_duration_seconds,
+    target_path_requests_total,
+    target_path_request_duration_seconds,
+    watch_requests_limited,
+)
+from .watch import WATCH_POLL_SECONDS, parse_watch_args
+
+logger = logging.getLogger(__name__)
+
+# the most paths a bulk request can ask for
+MAX_BULK_REQUESTS = 1000
+
+
+class TargetsResult:
+    """Either the cache entry to send to the client, or an error body."""
+
+    def __init__(
+        self,
+        status: int,
+        entry: Optional[CacheEntry] = None,
+        body: Optional[dict] = None,
+        etag: Optional[str] = None,
+    ) -> None:
+        self.status = status
+        self.entry = entry
+        self.body = body
+        # for 304, the entry is not sent
+        self.etag = etag if entry is None else entry.etag
+
+
+def parse_query_args(query_string: str) -> dict:
+    """The parameters of a query string, a repeated one keeps its first
+    value, like ``dict(request.args)`` of flask."""
+    args = {}
+    for key, value in parse_qsl(query_string, keep_blank_values=True):
+        args.setdefault(key, value)
+    return args
+
+
+def cache_key(rest_path: str, args) -> str:
+    """The canonical cache key of a targets request, the same path and
+    parameters (in any order) always have the same key."""
+    return f"/targets/{rest_path}?{urlencode(sorted(args.items()))}"
+
+
+def scrape_configs_key(rest_path: str, args) -> str:
+    return f"/scrape_configs/{rest_path}?{urlencode(sorted(args.items()))}"
+
+
+def split_dirs(rest_path: str) -> Tuple[str, str]:
+    """The ``l1_dir`` and ``l2_dir`` labels of a target path. Like
+    ``tenant_label``, a directory that does not exist is counted as
+    ``other``, so that requests of random paths can not add series."""
+    path_splits = rest_path.split("/")
+    l1_dir = tenant_label(path_splits[0])
+    l2_dir = path_splits[1] if len(path_splits) > 1 else ""
+    if l1_dir == OTHER_PATHS:
+        return l1_dir, ""
+    if l2_dir:
+        root, path = locate("/".join(path_splits[:2]))
+        if not os.path.exists(os.path.join(root, path)):
+            l2_dir = OTHER_PATHS
+    return l1_dir, l2_dir
+
+
+def lookup_targets(dispatcher, rest_path: str, args: dict) -> TargetsResult:
+    full_path = cache_key(rest_path, args)
+    logger.info(
+        "request target path: {}, with parameters: {}".format(
+            rest_path,
+            args,
+        )
+    )
+
+    l1_dir, l2_dir = split_dirs(rest_path)
+    path_label = path_labeler.label(rest_path)
+
+    with target_path_request_duration_seconds.labels(path=path_label).time():
+        try:
+            entry = dispatcher.get_targets_entry(rest_path, full_path, **args)
+        except CacheNotExist:
+            target_path_requests_total.labels(
+                path=path_label,
+                status="cache-not-exist",
+                l1_dir=l1_dir,
+                l2_dir=l2_dir,
+            ).inc()
+            logger.error("Cache miss, full_path=%s", full_path)
+            return TargetsResult(500, body={"error": "cache miss"})
+        except CacheExpired as e:
+            target_path_requests_total.labels(
+                path=path_label,
+                status="cache-expired",
+                l1_dir=l1_dir,
+                l2_dir=l2_dir,
+            ).inc()
+            updated_timestamp = e.updated_timestamp
+            cache_expire_seconds = e.cache_excepire_seconds
+            dt = datetime.fromtimestamp(updated_timestamp)
+
+            logger.error(
+                "Cache expired, full_path=%s, updated_timestamp: %s, "
+                "cache_expire_seconds: %s (%s)",
+                full_path,
+                updated_timestamp,
+                cache_expire_seconds,
+                dt,
+            )
+            return TargetsResult(
+                500,
+                body={
+                    "error": "cache expired, you should try again later",
+                    "updated_timestamp": updated_timestamp,
+                    "updated_time": http_date(dt),
+                    "cache_expire_seconds": cache_expire_seconds,
+                },
+            )
+        except:  # noqa: E722
+            target_path_requests_total.labels(
+                path=path_label, status="fail", l1_dir=l1_dir, l2_dir=l2_dir
+            ).inc()
+            raise
+        else:
+            target_path_requests_total.labels(
+                path=path_label,
+                status="success",
+                l1_dir=l1_dir,
+                l2_dir=l2_dir,
+            ).inc()
+            path_last_generated_targets.labels(path=path_label).set(
+                entry.target_count
+            )
+            return TargetsResult(200, entry=entry)
+
+
+def not_served(rest_path: str) -> TargetsResult:
+    return TargetsResult(
+        404, body={"error": f"no root dir or mount serves /{rest_path}"}
+    )
+
+
+def serve_targets(
+    dispatcher,
+    rest_path: str,
+    args: dict,
+    refresh_interval: Optional[int] = None,
+    watchers: Optional[threading.Semaphore] = None,
+) -> TargetsResult:
+    """``lookup_targets``, or ``watch_targets`` if ``watch`` is given, then
+    only the changes after the version ``since`` if it is given.
+    ``refresh_interval`` is how often the client polls, see
+    refresh_interval.py."""
+    if not is_served(rest_path):
+        return not_served(rest_path)
+    try:
+        args, etag, timeout = parse_watch_args(args)
+        args, since = parse_since(args)
+        args = params_index.filter(rest_path, args)
+    except ValueError as e:
+        return TargetsResult(400, body={"error": str(e)})
+    if refresh_interval is not None:
+        dispatcher.index.record_refresh_interval(
+            cache_key(rest_path, args), rest_path, refresh_interval
+        )
+    if etag is None:
+        result = lookup_targets(dispatcher, rest_path, args)
+    else:
+        result = watch_targets(
+            dispatcher, rest_path, args, etag, timeout, watchers
+        )
+    if since is None or result.entry is None:
+        return result
+
+    # ?since=<version>, only the groups changed after that version
+    entry = result.entry
+    history = dispatcher.get_history(cache_key(rest_path, args))
+    delta = delta_since(history, since)
+    if delta is None:
+        delta = full_snapshot(entry.version, json.loads(entry.read()))
+    else:
+        entry.close()
+    return TargetsResult(200, body=delta)
+
+
+def watched_key(dispatcher, rest_path: str, args: dict) -> str:
+    """The cache key of a ``?watch=`` request, ``args`` are without
+    ``watch`` and ``timeout``. The path is kept refreshed while it is
+    watched. Raise ValueError if the parameters are not valid."""
+    args, _ = parse_since(args)
+    args = params_index.filter(rest_path, args)
+    full_path = cache_key(rest_path, args)
+    dispatcher.append_task(full_path, rest_path, args)
+    return full_path
+
+
+def targets_changed(dispatcher, full_path: str, etag: str) -> bool:
+    header = dispatcher.cache_store.read_header(full_path)
+    return header is None or header.get("etag") != etag
+
+
+def watch_targets(
+    dispatcher,
+    rest_path: str,
+    args: dict,
+    etag: str,
+    timeout: float,
+    watchers: Optional[threading.Semaphore] = None,
+) -> TargetsResult:
+    """``lookup_targets``, but wait up to ``timeout`` seconds until the
+    targets are different from ``etag``, return 304 if they are not.
+
+    The wait holds the thread, with ``watchers``, only that many requests
+    wait at a time, the others are answered at once."""
+    full_path = cache_key(rest_path, args)
+    # keep the path refreshed while it is watched
+    dispatcher.append_task(full_path, rest_path, args)
+    if watchers is not None and not watchers.acquire(blocking=False):
+        watch_requests_limited.inc()
+        timeout, watchers = 0, None
+    try:
+        deadline = time.time() + timeout
+        while True:
+            event = dispatcher.notifier.event(full_path)
+            if targets_changed(dispatcher, full_path, etag):
+                return lookup_targets(dispatcher, rest_path, args)
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return TargetsResult(304, etag=etag)
+            event.wait(min(remaining, WATCH_POLL_SECONDS))
+    finally:
+        if watchers is not None:
+            watchers.release()
+
+
+def parse_bulk_request(body) -> List[Tuple[str, dict]]:
+    """The ``(path, args)`` of a bulk request body::
+
+        {"requests": [{"path": "a/b", "args": {"env": "prod"}}, ...]}
+
+    Raise ValueError if the body is not like that."""
+    if not isinstance(body, dict) or not isinstance(
+        body.get("requests"), list
+    ):
+        raise ValueError("the body should be {'requests': [...]}")
+    requests = body["requests"]
+    if len(requests) > MAX_BULK_REQUESTS:
+        raise ValueError(
+            f"at most {MAX_BULK_REQUESTS} requests can be sent at once"
+        )
+
+    parsed = []
+    for request in requests:
+        if not isinstance(request, dict) or not isinstance(
+            request.get("path"), str
+        ):
+            raise ValueError("every request should have a path")
+        args = request.get("args") or {}
+        if not isinstance(args, dict) or not all(
+            isinstance(v, str) for v in args.values()
+        ):
+            raise ValueError("args should be an object of strings")
+        path = request["path"].strip("/")
+        try:
+            args = params_index.filter(path, args)
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}")
+        parsed.append((path, args))
+    return parsed
+
+
+def bulk_result_error(e: CacheError) -> dict:
+    if isinstance(e, CacheExpired):
+        return {
+            "status": 500,
+            "error": "cache expired, you should try again later",
+            "updated_timestamp": e.updated_timestamp,
+            "cache_expire_seconds": e.cache_excepire_seconds,
+        }
+    if isinstance(e, CacheNotExist):
+        return {"status": 500, "error": "cache miss"}
+    return {"status": 500, "error": str(e)}
+
+
+def bulk_targets(dispatcher, requests: List[Tuple[str, dict]]) -> bytes:
+    """The cached targets of many paths in one response, see
+    ``bulk_body``."""
+    keys = [
+        (cache_key(rest_path, args), rest_path, args)
+        for rest_path, args in requests
+    ]
+    return bulk_body(keys, dispatcher.get_targets_entries(keys))
+
+
+def bulk_body(keys, results) -> bytes:
+    """The body of a bulk response::
+
+        {"results": [{"path": ..., "args": ..., "status": 200,
+                      "etag": ..., "version": ..., "targets": [...]}, ...]}
+
+    for the ``(full_path, path, args)`` keys and the result of each, either
+    its opened cache entry or the ``CacheError`` raised for it, in the order
+    of the requests. A path that is not cached has status 500 and an error
+    instead of targets, like a single request. The cached payloads are put
+    into the body as they are, without decoding them."""
+    parts = []
+    for (full_path, rest_path, args), result in zip(keys, results):
+        l1_dir, l2_dir = split_dirs(rest_path)
+        path_label = path_labeler.label(rest_path)
+        item = {"path": rest_path, "args": args}
+        if isinstance(result, CacheError):
+            status = (
+                "cache-expired"
+                if isinstance(result, CacheExpired)
+                else "cache-not-exist"
+            )
+            logger.error("Bulk %s, full_path=%s", status, full_path)
+            item.update(bulk_result_error(result))
+            parts.append(json.dumps(item).encode())
+        else:
+            status = "success"
+            path_last_generated_targets.labels(path=path_label).set(
+                result.target_count
+            )
+            payload = result.read()
+            item.update(status=200, etag=result.etag, version=result.version)
+            # ``{...}`` with the payload as the value of "targets"
+            parts.append(
+                json.dumps(item).encode()[:-1]
+                + b', "targets": '
+                + payload
+                + b"}"
+            )
+        target_path_requests_total.labels(
+            path=path_label, status=status, l1_dir=l1_dir, l2_dir=l2_dir
+        ).inc()
+    return b'{"results": [' + b", ".join(parts) + b"]}"
+
+
+def lookup_cached_targets(
+    dispatcher,
+    rest_path: str,
+    args: dict,
+    refresh_interval: Optional[int] = None,
+) -> Optional[CacheEntry]:
+    """The hot path of ``lookup_targets``: return the cache entry if it is
+    fresh, otherwise None without logging or counting anything, the caller
+    should fall back to ``lookup_targets`` then."""
+    start = time.perf_counter()
+    try:
+        args = params_index.filter(rest_path, args)
+        full_path = cache_key(rest_path, args)
+        if refresh_interval is not None:
+            dispatcher.index.record_refresh_interval(
+                full_path, rest_path, refresh_interval
+            )
+        entry = dispatcher.get_fresh_targets_entry(rest_path, full_path, args)
+    except (CacheError, ValueError):
+        return None
+
+    l1_dir, l2_dir = split_dirs(rest_path)
+    path_label = path_labeler.label(rest_path)
+    target_path_requests_total.labels(
+        path=path_label, status="success", l1_dir=l1_dir, l2_dir=l2_dir
+    ).inc()
+    path_last_generated_targets.labels(path=path_label).set(entry.target_count)
+    target_path_request_duration_seconds.labels(path=path_label).observe(
+        time.perf_counter() - start
+    )
+    return entry
+
+
+def debug_targets(dispatcher, rest_path: str, args: dict) -> Tuple[int, dict]:
+    """Start a profiling job for the generators of the path, the result is
+    fetched later by ``debug_job``. ``args`` are the request parameters,
+    ``debug`` and the optional ``profile=<top N>`` are not passed to the
+    generators."""
+    args = dict(args)
+    args.pop("debug", None)
+    try:
+        profile_top = int(args.pop("profile", 0))
+    except ValueError:
+        return 400, {"error": "profile should be the number of functions"}
+    try:
+        args = params_index.filter(rest_path, args)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+
+    try:
+        job = dispatcher.profile_jobs.submit(rest_path, args, profile_top)
+    except TooManyJobs as e:
+        return 429, {"error": str(e)}
+    result = {"job_id": job.job_id, "status": job.status}
+    if dispatcher.partial_results:
+        result["generator_failures"] = dispatcher.get_generator_failures(
+            cache_key(rest_path, args)
+        )
+    return 202, result
+
+
+def debug_job(dispatcher, job_id: str) -> Tuple[int, dict]:
+    job = dispatcher.profile_jobs.get_dict(job_id)
+    if job is None:
+        return 404, {"error": "job not found, it may have been cleaned up"}
+    return 200, job
+
+
+def lookup_scrape_configs(
+    dispatcher, rest_path: str, args: dict
+) -> TargetsResult:
+    """Like ``lookup_targets``, for the scrape configs generated by
+    ``<root>/<rest_path>.py``."""
+    try:
+        args = params_index.filter(rest_path, args, scrape_configs=True)
+    except ValueError as e:
+        return TargetsResult(400, body={"error": str(e)})
+    full_path = scrape_configs_key(rest_path, args)
+    path_label = path_labeler.label(rest_path)
+    with scrape_configs_request_duration_seconds.labels(
+        path=path_label
+    ).time():
+        try:
+            entry = dispatcher.get_scrape_configs_entry(
+                rest_path, full_path, **args
+            )
+        except CacheNotExist:
+            scrape_configs_requests_total.labels(
+                path=path_label, status="cache-not-exist"
+            ).inc()
+            logger.error("Cache miss, full_path=%s", full_path)
+            return TargetsResult(500, body={"error": "cache miss"})
+        except CacheExpired as e:
+            scrape_configs_requests_total.labels(
+                path=path_label, status="cache-expired"
+            ).inc()
+            logger.error("Cache expired, full_path=%s", full_path)
+            return TargetsResult(
+                500,
+                body={
+                    "error": "cache expired, you should try again later",
+                    "updated_timestamp": e.updated_timestamp,
+                    "cache_expire_seconds": e.cache_excepire_seconds,
+                },
+            )
+        except:  # noqa: E722
+            scrape_configs_requests_total.labels(
+                path=path_label, status="fail"
+            ).inc()
+            raise
+        scrape_configs_requests_total.labels(
+            path=path_label, status="success"
+        ).inc()
+        return TargetsResult(200, entry=entry)
+
+
+def list_paths(root_dir: str) -> List[str]:
+    paths = []
+
+    for dirpath, _, _ in os.walk(root_dir):
+        should_ignore_underscore = any(
+            p.startswith("_") for p in os.path.normpath(dirpath).split(os.sep)
+        )
+        if should_ignore_underscore:
+            continue
+
+        dirpath = dirpath.removeprefix(root_dir)
+        dirpath = dirpath.removeprefix("/")
+        paths.append(dirpath)
+
+    return sorted(list(set(paths)))
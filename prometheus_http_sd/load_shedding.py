@@ -0,0 +1,180 @@
+"""Adaptive load shedding for the ``/targets`` requests.
+
+Under a thundering herd (e.g. a whole Prometheus fleet restarting), the
+server accepts far more connections than it has threads, and the requests
+wait in its queue until the latency of every client is too high. Instead,
+the number of targets requests handled at the same time is limited, and the
+requests beyond the limit get a cheap 503 with ``Retry-After``, which drains
+the queue quickly.
+
+The limit is adjusted by AIMD: it increases by one for every ``limit``
+requests that finish within the target latency, and is cut by
+``BACKOFF_RATIO`` when a request takes longer, at most once per target
+latency so that one slow burst does not collapse it.
+
+The latency of a request starts when it arrives, not when a thread picks it
+up: waitress never runs more requests than it has threads, so they queue
+before the app, where the app can not count them. The server of
+``create_server`` puts the arrival time of every request in its environ, and
+a request that already waited longer than the target latency is shed.
+
+``?watch=`` requests are held on purpose, so they are not limited.
+"""
+
+import json
+import threading
+import time
+from urllib.parse import parse_qsl
+
+from waitress.channel import HTTPChannel
+from waitress.parser import HTTPRequestParser
+from waitress.server import MultiSocketServer
+from waitress.server import create_server as create_waitress_server
+from waitress.task import WSGITask
+
+from .metrics import concurrency_limit, inflight_requests, shed_requests_total
+
+BACKOFF_RATIO = 0.9
+MIN_LIMIT = 1
+
+# what the shed clients are told to wait before retrying
+RETRY_AFTER_SECONDS = 5
+
+SHED_BODY = json.dumps({"error": "overloaded, try again later"}).encode()
+
+# the environ key of the ``time.perf_counter()`` a request arrived at
+RECEIVED_AT = "httpsd.received_at"
+
+
+class AIMDLimiter:
+    def __init__(self, target_latency: float, max_limit: int) -> None:
+        self.target_latency = target_latency
+        self.max_limit = max(max_limit, MIN_LIMIT)
+        self.limit = float(self.max_limit)
+        self.inflight = 0
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+        concurrency_limit.set(self.limit)
+
+    def _decrease(self, now: float):
+        # under the lock
+        if now - self.last_decrease >= self.target_latency:
+            self.limit = max(MIN_LIMIT, self.limit * BACKOFF_RATIO)
+            self.last_decrease = now
+
+    def acquire(self, queued: float = 0.0) -> bool:
+        """Return False if the request should be shed, otherwise call
+        ``release`` when it is done. ``queued`` is how long the request
+        waited before, beyond the target latency it is shed."""
+        with self.lock:
+            if queued > self.target_latency:
+                self._decrease(time.time())
+                limit = self.limit
+            elif self.inflight < int(self.limit):
+                self.inflight += 1
+                limit = None
+            else:
+                limit = self.limit
+        if limit is not None:
+            shed_requests_total.inc()
+            concurrency_limit.set(limit)
+            return False
+        inflight_requests.inc()
+        return True
+
+    def release(self, latency: float):
+        """``latency`` includes the time the request was queued."""
+        now = time.time()
+        with self.lock:
+            self.inflight -= 1
+            if latency > self.target_latency:
+                self._decrease(now)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            limit = self.limit
+        inflight_requests.dec()
+        concurrency_limit.set(limit)
+
+
+def is_limited(path: str, query_string: str, targets_path: str) -> bool:
+    """Only the targets requests are limited, except ``?watch=``."""
+    if path != targets_path and not path.startswith(targets_path + "/"):
+        return False
+    return not any(key == "watch" for key, _ in parse_qsl(query_string, True))
+
+
+class _TimedRequestParser(HTTPRequestParser):
+    def __init__(self, adj) -> None:
+        super().__init__(adj)
+        # created when the first bytes of the request are read
+        self.received_at = time.perf_counter()
+
+
+class _TimedTask(WSGITask):
+    def get_environment(self):
+        environ = super().get_environment()
+        environ[RECEIVED_AT] = self.request.received_at
+        return environ
+
+
+class TimedChannel(HTTPChannel):
+    parser_class = _TimedRequestParser
+    task_class = _TimedTask
+
+
+def create_server(app, **kwargs):
+    """``waitress.create_server``, putting the time every request arrived in
+    its environ."""
+    server = create_waitress_server(app, **kwargs)
+    if isinstance(server, MultiSocketServer):
+        listeners = list(server.map.values())
+    else:
+        listeners = [server]
+    for listener in listeners:
+        listener.channel_class = TimedChannel
+    return server
+
+
+def serve(app, **kwargs):
+    """``waitress.serve`` with the server of ``create_server``."""
+    server = create_server(app, **kwargs)
+    server.print_listen("Serving on http://{}:{}")
+    server.run()
+
+
+class LoadShedding:
+    """WSGI middleware putting an ``AIMDLimiter`` in front of the targets
+    requests of ``app``. The latency is the time from the arrival of the
+    request, if the server gives it, until ``app`` returns, sending the body
+    to a slow client is not counted."""
+
+    def __init__(self, app, prefix: str, limiter: AIMDLimiter) -> None:
+        self.app = app
+        self.limiter = limiter
+        self.targets_path = prefix.rstrip("/") + "/targets"
+
+    def __call__(self, environ, start_response):
+        if not is_limited(
+            environ.get("PATH_INFO", ""),
+            environ.get("QUERY_STRING", ""),
+            self.targets_path,
+        ):
+            return self.app(environ, start_response)
+
+        start = time.perf_counter()
+        queued = start - environ.get(RECEIVED_AT, start)
+        if not self.limiter.acquire(queued):
+            start_response(
+                "503 Service Unavailable",
+                [
+                    ("Content-Type", "application/json"),
+                    ("Content-Length", str(len(SHED_BODY))),
+                    ("Retry-After", str(RETRY_AFTER_SECONDS)),
+                ],
+            )
+            return [SHED_BODY]
+
+        try:
+            return self.app(environ, start_response)
+        finally:
+            self.limiter.release(time.perf_counter() - start + queued)
@@ -1,12 +1,47 @@
-from prometheus_client import Counter, Gauge, Histogram, Info, Summary
+import os
+import threading
+import time
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    Info,
+    Summary,
+    make_asgi_app,
+    make_wsgi_app,
+    multiprocess,
+)
 from .version import VERSION
 
+# set by ``serve --processes``, before prometheus_client is imported. In
+# that mode, a gauge that counts something (jobs, requests, connections) is
+# the sum of the live processes, a gauge of a last value is their max.
+MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+# The label value for the paths after the first N in the ``first:N``
+# strategy
+OTHER_PATHS = "other"
+PATH_LABEL_STRATEGIES = ("full", "l1", "l2", "depth:<n>", "first:<n>")
+
 # Version info metric
-version_info = Info(
-    "httpsd_version",
-    "prometheus_http_sd version info",
-)
-version_info.info({"version": VERSION})
+if os.environ.get(MULTIPROC_DIR_ENV):
+    # Info does not work in the multiprocess mode, the same sample by a gauge
+    version_info = Gauge(
+        "httpsd_version_info",
+        "prometheus_http_sd version info",
+        ["version"],
+        multiprocess_mode="max",
+    )
+    version_info.labels(version=VERSION).set(1)
+else:
+    version_info = Info(
+        "httpsd_version",
+        "prometheus_http_sd version info",
+    )
+    version_info.info({"version": VERSION})
 
 # Request metrics
 target_path_requests_total = Counter(
@@ -26,6 +61,20 @@ path_last_generated_targets = Gauge(
     "httpsd_path_last_generated_targets",
     "Generated targets count in last request",
     ["path"],
+    multiprocess_mode="max",
+)
+
+scrape_configs_requests_total = Counter(
+    "httpsd_scrape_configs_requests_total",
+    "The total count of a scrape configs path being requested, status label"
+    " can be success/fail/cache-not-exist/cache-expired",
+    ["path", "status"],
+)
+
+scrape_configs_request_duration_seconds = Histogram(
+    "httpsd_scrape_configs_request_duration_seconds",
+    "The bucket of scrape configs request duration in seconds",
+    ["path"],
 )
 
 # Generator metrics
@@ -37,11 +86,35 @@ generator_latency = Summary(
 
 # Queue metrics
 queue_job_gauge = Gauge(
-    "httpsd_update_queue_jobs", "Current jobs pending in the queue", ["status"]
+    "httpsd_update_queue_jobs",
+    "Current jobs pending in the queue",
+    ["status"],
+    multiprocess_mode="livesum",
 )
 
 finished_jobs = Counter("httpsd_finished_jobs", "Already finished jobs")
 
+tenant_queue_depth = Gauge(
+    "httpsd_tenant_queue_depth",
+    "Refresh jobs waiting in the queue, by top level directory",
+    ["tenant"],
+    multiprocess_mode="livesum",
+)
+
+tenant_running_jobs = Gauge(
+    "httpsd_tenant_running_jobs",
+    "Refresh jobs running, by top level directory",
+    ["tenant"],
+    multiprocess_mode="livesum",
+)
+
+tenant_queue_wait_seconds = Histogram(
+    "httpsd_tenant_queue_wait_seconds",
+    "How long a refresh job waited in the queue, by top level directory",
+    ["tenant"],
+    buckets=[0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600],
+)
+
 # Cache metrics
 cache_operations = Counter(
     "httpsd_cache_operations_total",
@@ -49,6 +122,13 @@ cache_operations = Counter(
     ["operation"],
 )
 
+shared_cache_skipped = Counter(
+    "httpsd_shared_cache_skipped_total",
+    "Refreshes skipped because another replica sharing the cache dir"
+    " refreshed the key (fresh) or is refreshing it (leased)",
+    ["reason"],
+)
+
 dispatcher_started_counter = Counter(
     "httpsd_dispatcher_started_total",
     "How many times has the dispatcher has been started?",
@@ -61,8 +141,188 @@ worker_jobs_processed = Counter(
     ["worker_id", "status"],
 )
 
+redis_jobs_deduplicated = Counter(
+    "httpsd_redis_jobs_deduplicated_total",
+    "Jobs not enqueued because a job of the same path is queued or running",
+)
+
+redis_job_lease_timeouts = Counter(
+    "httpsd_redis_job_lease_timeouts_total",
+    "Jobs whose worker did not finish them before their lease expired",
+)
+
+redis_jobs_redelivered = Counter(
+    "httpsd_redis_jobs_redelivered_total",
+    "Jobs queued again after their lease expired",
+)
+
 worker_started_counter = Counter(
     "httpsd_redis_worker_started_total",
     "How many times have workers been started?",
     ["worker_id"],
 )
+
+local_cache_operations = Counter(
+    "httpsd_local_cache_operations_total",
+    "Reads of the in-process cache of the Redis server (hit or miss), and"
+    " keys dropped from it because a worker wrote them (invalidate)",
+    ["operation"],
+)
+
+redis_pool_connections = Gauge(
+    "httpsd_redis_pool_connections",
+    "Connections of the shared Redis pools, state is in_use or created",
+    ["state"],
+    multiprocess_mode="livesum",
+)
+
+redis_pool_max_connections = Gauge(
+    "httpsd_redis_pool_max_connections",
+    "The most connections the shared Redis pools can open",
+    multiprocess_mode="livesum",
+)
+
+redis_pool_wait_seconds = Histogram(
+    "httpsd_redis_pool_wait_seconds",
+    "How long it took to get a connection from the shared Redis pool",
+    buckets=[0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 20],
+)
+
+# Load shedding metrics
+shed_requests_total = Counter(
+    "httpsd_shed_requests_total",
+    "Targets requests answered with 503 because the concurrency limit was"
+    " reached",
+)
+
+watch_requests_limited = Counter(
+    "httpsd_watch_requests_limited_total",
+    "?watch= requests answered at once because the most watches that can"
+    " wait at a time were waiting",
+)
+
+concurrency_limit = Gauge(
+    "httpsd_concurrency_limit",
+    "The current adaptive limit of concurrent targets requests",
+    multiprocess_mode="livesum",
+)
+
+inflight_requests = Gauge(
+    "httpsd_inflight_requests",
+    "Targets requests being handled now",
+    multiprocess_mode="livesum",
+)
+
+# Exposition metrics, they describe the previous scrape
+metrics_exposition_bytes = Gauge(
+    "httpsd_metrics_exposition_bytes",
+    "The size of the last /metrics response in bytes",
+    multiprocess_mode="max",
+)
+
+metrics_render_seconds = Histogram(
+    "httpsd_metrics_render_seconds",
+    "The time to render the /metrics response",
+    buckets=[0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+)
+
+
+class PathLabeler:
+    """
+    Turn a target path into the ``path`` label of the request metrics, so
+    that the number of series can be bounded:
+
+    - ``full``: the path as it is
+    - ``l1``, ``l2``: only the first one or two directories
+    - ``depth:<n>``: only the first ``n`` directories
+    - ``first:<n>``: the first ``n`` different paths requested since the
+      start keep their own label for good, whatever their traffic, the
+      paths after them are counted as ``other``
+    """
+
+    def __init__(self, strategy: str = "full") -> None:
+        self.configure(strategy)
+
+    def configure(self, strategy: str):
+        name, _, value = strategy.partition(":")
+        if name in ("l1", "l2") and not value:
+            name, value = "depth", name[1]
+        if name == "full" and not value:
+            self.depth = self.first = None
+        elif name in ("depth", "first") and value.isdigit() and int(value):
+            self.depth = int(value) if name == "depth" else None
+            self.first = int(value) if name == "first" else None
+        else:
+            raise ValueError(
+                f"path label should be one of"
+                f" {', '.join(PATH_LABEL_STRATEGIES)}: {strategy}"
+            )
+        self.strategy = strategy
+        self._known = set()
+        self._lock = threading.Lock()
+
+    def label(self, path: str) -> str:
+        if self.depth is not None:
+            return "/".join(path.split("/")[: self.depth])
+        if self.first is not None and path not in self._known:
+            with self._lock:
+                if len(self._known) >= self.first:
+                    return OTHER_PATHS
+                self._known.add(path)
+        return path
+
+    def full_path_label(self, full_path: str, path: str) -> str:
+        """The label for the query string of a refresh job, it is the path
+        label unless the strategy is ``full``."""
+        if self.depth is None and self.first is None:
+            return full_path
+        return self.label(path)
+
+
+path_labeler = PathLabeler()
+
+
+def metrics_registry():
+    """The registry to expose, with ``serve --processes`` it collects the
+    metrics of all the processes from ``PROMETHEUS_MULTIPROC_DIR``."""
+    if not os.environ.get(MULTIPROC_DIR_ENV):
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def make_metrics_wsgi_app():
+    """``make_wsgi_app``, which also measures the size of the response and
+    the time to render it."""
+    app = make_wsgi_app(metrics_registry())
+
+    def metrics_app(environ, start_response):
+        start = time.perf_counter()
+        body = app(environ, start_response)
+        metrics_render_seconds.observe(time.perf_counter() - start)
+        metrics_exposition_bytes.set(sum(len(chunk) for chunk in body))
+        return body
+
+    return metrics_app
+
+
+def make_metrics_asgi_app():
+    """Like ``make_metrics_wsgi_app``, for the ASGI app."""
+    app = make_asgi_app(metrics_registry())
+
+    async def metrics_app(scope, receive, send):
+        start = time.perf_counter()
+        size = 0
+
+        async def measured_send(message):
+            nonlocal size
+            if message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        await app(scope, receive, measured_send)
+        metrics_render_seconds.observe(time.perf_counter() - start)
+        metrics_exposition_bytes.set(size)
+
+    return metrics_app
@@ -0,0 +1,49 @@
+"""More root dirs served by one ``serve``: ``--mount team-a=/srv/team-a``
+serves ``/srv/team-a`` under ``/targets/team-a``, as if it were the
+``team-a`` directory of the root dir. All the mounts share the update pool,
+the generator executor, the cache store and the metrics of the process.
+
+A mount is a top level directory, so it is a tenant of the fair queue, and
+``--tenant-weight`` and ``--tenant-concurrency`` apply to it.
+"""
+
+import os
+from typing import Dict, List, Tuple
+
+from .config import config
+
+
+def parse_mounts(mounts) -> Dict[str, str]:
+    """Parse ``("team-a=/srv/team-a",)`` into a dict."""
+    result = {}
+    for mount in mounts or ():
+        name, sep, root = mount.partition("=")
+        name = name.strip("/")
+        if not sep or not name or "/" in name:
+            raise ValueError(f"mount should be <name>=<dir>: {mount}")
+        if not os.path.isdir(root):
+            raise ValueError(f"mount dir does not exist: {root}")
+        result[name] = root.rstrip("/")
+    return result
+
+
+def is_served(path: str) -> bool:
+    """If ``path`` is under the root dir or a mount. With only mounts, the
+    empty path, or a path whose first directory is not a mount, is not
+    served, there is no root dir to find it in."""
+    return bool(config.root_dir) or path.partition("/")[0] in config.mounts
+
+
+def locate(path: str) -> Tuple[str, str]:
+    """The root dir of a target path, and the path relative to it."""
+    name, _, rest = path.partition("/")
+    if name in config.mounts:
+        return config.mounts[name], rest
+    if not config.root_dir:
+        raise FileNotFoundError(f"{path} not exist!")
+    return config.root_dir, path
+
+
+def roots() -> List[str]:
+    """The root dir, if any, and the dirs of all mounts."""
+    return [r for r in (config.root_dir, *config.mounts.values()) if r]
@@ -0,0 +1,233 @@
+"""The query parameters a target path accepts, so that parameters no
+generator uses do not create their own cache keys and generator runs.
+
+A python generator declares the parameters it accepts by a module level
+list of names::
+
+    QUERY_PARAMS = ["domain", "env"]
+
+    def generate_targets(domain, env="prod", **kwargs):
+        ...
+
+Without ``QUERY_PARAMS``, the named parameters of ``generate_targets`` are
+the declared ones, unless it takes ``**kwargs``, then it accepts any
+parameter. Json and yaml files accept none. A path accepts the parameters
+of all the generators under it.
+
+The generators are parsed, not imported. The result of a path is kept for
+the ``PARAMS_PATHS_SIZE`` most recently requested paths, and checked again
+in the background once it is ``PARAMS_CHECK_INTERVAL`` seconds old, so only
+the first request of a path waits for the scan.
+"""
+
+import ast
+import collections
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, FrozenSet, Optional, Tuple
+
+from .config import config
+from .mounts import locate
+from .sd import should_ignore
+
+logger = logging.getLogger(__name__)
+
+# what to do with the parameters that no generator of the path declares:
+# drop them from the request, reject the request with 400, or keep them and
+# pass them to the generators as before
+UNDECLARED_PARAMS_POLICIES = ("drop", "reject", "keep")
+
+# the generators of a path are checked again after this many seconds
+PARAMS_CHECK_INTERVAL = 10
+
+# how many paths are kept, the least recently requested are dropped
+PARAMS_PATHS_SIZE = 1024
+
+DECLARATION_NAME = "QUERY_PARAMS"
+
+
+class UndeclaredParams(ValueError):
+    def __init__(self, params) -> None:
+        super().__init__(
+            f"parameters not accepted by this path: {', '.join(params)}"
+        )
+        self.params = params
+
+
+def _python_params(source: str) -> Optional[FrozenSet[str]]:
+    tree = ast.parse(source)
+    signature = None
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            targets = node.targets
+        elif isinstance(node, ast.AnnAssign) and node.value is not None:
+            # QUERY_PARAMS: list = [...]
+            targets = [node.target]
+        else:
+            targets = []
+        if any(
+            isinstance(t, ast.Name) and t.id == DECLARATION_NAME
+            for t in targets
+        ):
+            return frozenset(ast.literal_eval(node.value))
+        if (
+            isinstance(node, ast.FunctionDef)
+            and node.name == "generate_targets"
+        ):
+            signature = node.args
+    if signature is None or signature.kwarg is not None:
+        return None
+    return frozenset(
+        arg.arg
+        for arg in signature.posonlyargs
+        + signature.args
+        + signature.kwonlyargs
+    )
+
+
+def declared_params(generator_path: str) -> Optional[FrozenSet[str]]:
+    """The parameters the generator accepts, or None if it accepts any."""
+    if not generator_path.endswith(".py"):
+        return frozenset()
+    try:
+        return _python_params(Path(generator_path).read_text())
+    except (OSError, SyntaxError, ValueError) as e:
+        # the generator fails by itself when it runs, do not guess here
+        logger.warning(
+            "Can not find the parameters of %s: %s", generator_path, e
+        )
+        return None
+
+
+class ParamsIndex:
+    def __init__(self, max_paths: int = PARAMS_PATHS_SIZE) -> None:
+        # generator file -> (mtime_ns, params)
+        self._files: Dict[str, Tuple[int, Optional[FrozenSet[str]]]] = {}
+        # path -> (checked_at, params), in the order they were requested
+        self._paths = collections.OrderedDict()
+        self.max_paths = max_paths
+        # the paths being checked again in the background
+        self._refreshing = set()
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self._files.clear()
+            self._paths.clear()
+
+    def _file_params(self, generator_path: str) -> Optional[FrozenSet[str]]:
+        mtime = os.stat(generator_path).st_mtime_ns
+        cached = self._files.get(generator_path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, declared_params(generator_path))
+            with self.lock:
+                self._files[generator_path] = cached
+        return cached[1]
+
+    def _scan(self, generator_paths) -> Optional[FrozenSet[str]]:
+        params = frozenset()
+        for generator_path in generator_paths:
+            file_params = self._file_params(generator_path)
+            if file_params is None:
+                return None
+            params |= file_params
+        return params
+
+    def _generator_paths(self, root: str, path: str, scrape_configs: bool):
+        if scrape_configs:
+            yield os.path.join(root, path + ".py")
+            return
+        for dirpath, _, files in os.walk(os.path.join(root, path)):
+            for file in files:
+                generator_path = os.path.join(dirpath, file)
+                if not should_ignore(generator_path, None):
+                    yield generator_path
+
+    def _exists(self, root: str, path: str, scrape_configs: bool) -> bool:
+        if scrape_configs:
+            return os.path.isfile(os.path.join(root, path + ".py"))
+        return os.path.isdir(os.path.join(root, path))
+
+    def _check(self, key: str, root: str, path: str, scrape_configs: bool):
+        """Scan the generators of the path and keep the result, or forget
+        the path if it does not exist (anymore)."""
+        if not self._exists(root, path, scrape_configs):
+            with self.lock:
+                self._paths.pop(key, None)
+            return None
+        try:
+            params = self._scan(
+                self._generator_paths(root, path, scrape_configs)
+            )
+        except OSError:
+            params = None
+        with self.lock:
+            self._paths[key] = (time.time(), params)
+            self._paths.move_to_end(key)
+            while len(self._paths) > self.max_paths:
+                self._paths.popitem(last=False)
+        return params
+
+    def _check_later(
+        self, key: str, root: str, path: str, scrape_configs: bool
+    ):
+        with self.lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def check():
+            try:
+                self._check(key, root, path, scrape_configs)
+            except Exception:
+                logger.exception("Can not check the parameters of %s", path)
+            finally:
+                with self.lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=check, daemon=True).start()
+
+    def accepted(
+        self, root: str, path: str, scrape_configs: bool = False
+    ) -> Optional[FrozenSet[str]]:
+        """The parameters the generators of the path accept, or None if
+        they accept any, or the path does not exist."""
+        key = f"{scrape_configs}:{root}:{path}"
+        with self.lock:
+            cached = self._paths.get(key)
+            if cached is not None:
+                self._paths.move_to_end(key)
+        if cached is None:
+            return self._check(key, root, path, scrape_configs)
+        if time.time() - cached[0] > PARAMS_CHECK_INTERVAL:
+            self._check_later(key, root, path, scrape_configs)
+        return cached[1]
+
+    def filter(
+        self, path: str, args: dict, scrape_configs: bool = False
+    ) -> dict:
+        """The ``args`` of a request to pass to the generators of the path,
+        by the ``config.undeclared_params`` policy. Raise
+        ``UndeclaredParams`` if the policy is reject."""
+        policy = config.undeclared_params
+        if policy == "keep" or not args:
+            return args
+        try:
+            root, rel_path = locate(path)
+        except FileNotFoundError:
+            return args
+        accepted = self.accepted(root, rel_path, scrape_configs)
+        if accepted is None:
+            return args
+        undeclared = [name for name in args if name not in accepted]
+        if not undeclared:
+            return args
+        if policy == "reject":
+            raise UndeclaredParams(sorted(undeclared))
+        return {k: v for k, v in args.items() if k in accepted}
+
+
+params_index = ParamsIndex()
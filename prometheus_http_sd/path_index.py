@@ -0,0 +1,191 @@
+"""In-memory index of the target paths for the admin page: the paths under
+the root dir, and for every requested cache key, the state of its cache,
+its last refresh and how often it is requested. It is updated as requests
+and refreshes happen, so rendering the admin page reads only memory."""
+
+import collections
+import threading
+import time
+from typing import List, Optional
+
+from .config import config
+from .handler import list_paths
+from .refresh_interval import RefreshIntervals
+
+# rescan the root dir in background if the listing is older than this
+PATH_SCAN_INTERVAL = 60
+
+# the keys the admin page of a Redis server keeps stats for
+SERVER_INDEX_SIZE = 1024
+
+# request rates are counted in windows of this many seconds
+RATE_WINDOW = 60
+
+
+class RateCounter:
+    """Requests per second in the last complete window."""
+
+    def __init__(self) -> None:
+        self.window_start = time.time()
+        self.count = 0
+        self.last_count = 0
+
+    def _roll(self, now):
+        elapsed = now - self.window_start
+        if elapsed >= RATE_WINDOW:
+            # an idle window in between means there were no requests
+            self.last_count = self.count if elapsed < 2 * RATE_WINDOW else 0
+            self.count = 0
+            self.window_start = now - elapsed % RATE_WINDOW
+
+    def inc(self):
+        self._roll(time.time())
+        self.count += 1
+
+    def rate(self) -> float:
+        self._roll(time.time())
+        return self.last_count / RATE_WINDOW
+
+
+class KeyStats:
+    def __init__(self, full_path: str, path: str) -> None:
+        self.full_path = full_path
+        self.path = path
+        self.updated_timestamp = None
+        self.size = None
+        self.target_count = None
+        self.last_duration = None
+        self.status = "unknown"
+        self.requests = RateCounter()
+        self.refresh_intervals = RefreshIntervals()
+
+    def to_dict(self) -> dict:
+        age = None
+        if self.updated_timestamp is not None:
+            age = time.time() - self.updated_timestamp
+        return {
+            "full_path": self.full_path,
+            "path": self.path,
+            "cache_age_seconds": age,
+            "size": self.size,
+            "target_count": self.target_count,
+            "last_duration_seconds": self.last_duration,
+            "status": self.status,
+            "refresh_interval_seconds": self.refresh_intervals.current(),
+            "requests_per_second": self.requests.rate(),
+        }
+
+
+class PathIndex:
+    """With ``max_keys``, only the stats of that many most recently used
+    keys are kept, for a server that sees whatever keys the clients ask
+    for, not only the ones it refreshes."""
+
+    def __init__(self, max_keys: Optional[int] = None) -> None:
+        self.keys = collections.OrderedDict()
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self._paths = None
+        self._paths_scanned_at = 0.0
+        self._scanning = False
+
+    def _stats(self, full_path: str, path: str) -> KeyStats:
+        if self.max_keys is None:
+            stats = self.keys.get(full_path)
+            if stats is None:
+                with self.lock:
+                    stats = self.keys.setdefault(
+                        full_path, KeyStats(full_path, path)
+                    )
+            return stats
+        with self.lock:
+            stats = self.keys.get(full_path)
+            if stats is None:
+                stats = self.keys[full_path] = KeyStats(full_path, path)
+                while len(self.keys) > self.max_keys:
+                    self.keys.popitem(last=False)
+            else:
+                self.keys.move_to_end(full_path)
+        return stats
+
+    def record_request(self, full_path: str, path: str):
+        self._stats(full_path, path).requests.inc()
+
+    def record_cache(
+        self, full_path: str, path: str, header: Optional[dict]
+    ) -> None:
+        """What the cache of the key looks like, from its header."""
+        stats = self._stats(full_path, path)
+        if header:
+            stats.updated_timestamp = header.get("updated_timestamp")
+            stats.size = header.get("size")
+            stats.target_count = header.get("target_count")
+
+    def record_refresh_interval(self, full_path: str, path: str, seconds):
+        """The refresh interval a client of the key asked for."""
+        self._stats(full_path, path).refresh_intervals.record(seconds)
+
+    def refresh_interval(self, full_path: str) -> Optional[int]:
+        """The smallest refresh interval the clients of the key ask for,
+        None if they did not ask for any."""
+        stats = self.keys.get(full_path)
+        if stats is None:
+            return None
+        return stats.refresh_intervals.current()
+
+    def record_status(self, full_path: str, path: str, status: str):
+        self._stats(full_path, path).status = status
+
+    def record_refresh(
+        self,
+        full_path: str,
+        path: str,
+        status: str,
+        duration: float,
+        header: Optional[dict] = None,
+    ) -> None:
+        stats = self._stats(full_path, path)
+        stats.status = status
+        stats.last_duration = duration
+        self.record_cache(full_path, path, header)
+
+    def rows(self) -> List[dict]:
+        with self.lock:
+            keys = list(self.keys.values())
+        return sorted(
+            (stats.to_dict() for stats in keys),
+            key=lambda row: row["full_path"],
+        )
+
+    def paths(self, root_dir: str) -> List[str]:
+        """The paths under ``root_dir`` and the mounts, the first call
+        scans the dirs, then they are rescanned in background when the
+        listing gets old."""
+        if self._paths is None:
+            self._scan(root_dir)
+        elif (
+            time.time() - self._paths_scanned_at > PATH_SCAN_INTERVAL
+            and not self._scanning
+        ):
+            self._scanning = True
+            threading.Thread(
+                target=self._scan, args=(root_dir,), daemon=True
+            ).start()
+        return self._paths
+
+    def rescan(self):
+        """Scan the root dir again on the next ``paths``."""
+        self._paths_scanned_at = 0.0
+
+    def _scan(self, root_dir: str):
+        try:
+            paths = list_paths(root_dir) if root_dir else []
+            for name, mount_dir in config.mounts.items():
+                paths.extend(
+                    f"{name}/{path}" if path else name
+                    for path in list_paths(mount_dir)
+                )
+            self._paths = sorted(set(paths))
+            self._paths_scanned_at = time.time()
+        finally:
+            self._scanning = False
@@ -0,0 +1,291 @@
+"""``serve --processes N``: N serving processes accept on one listening
+socket, so requests are handled on N cores instead of one GIL.
+
+The parent process only opens the socket and forks the children, it keeps
+no threads so that forking again is safe, and restarts a child that died:
+
+- one scheduler process runs the Dispatcher scheduler and the generators,
+  and writes the results into the cache store
+- N serving processes answer the requests from the same cache store, the
+  tasks requested in them are forwarded to the scheduler through a pipe
+
+The metrics of all the processes are collected from
+``PROMETHEUS_MULTIPROC_DIR``, see ``enable_multiprocess_metrics``.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import select
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from prometheus_client import multiprocess
+
+from .metrics import MULTIPROC_DIR_ENV
+
+logger = logging.getLogger(__name__)
+
+# a child that dies sooner than this after it started is restarted only
+# after this delay, to not fork in a busy loop
+RESTART_DELAY = 1
+
+# the parent checks its children this often
+WAIT_INTERVAL = 0.2
+
+# a new server process should be ready this soon on reload
+READY_TIMEOUT = 60
+
+# an old server process finishes its requests in this time on reload
+DRAIN_TIMEOUT = 30
+
+# set to the temporary dir of ``enable_multiprocess_metrics``, which the
+# parent removes on exit, a dir set by the user is kept
+OWNED_MULTIPROC_DIR_ENV = "PROMETHEUS_HTTP_SD_OWNED_MULTIPROC_DIR"
+
+# blocked from the exec of ``enable_multiprocess_metrics`` until the parent
+# handles them, so that it never dies without removing its temporary dir
+STOP_SIGNALS = {signal.SIGTERM, signal.SIGINT}
+
+SCHEDULER = "scheduler"
+SERVER = "server"
+
+
+def enable_multiprocess_metrics(argv):
+    """prometheus_client selects the multiprocess mode when it is imported,
+    so if ``PROMETHEUS_MULTIPROC_DIR`` is not set yet, set it to a new
+    temporary dir and run the command again in place. Return only if it
+    is set."""
+    if os.environ.get(MULTIPROC_DIR_ENV):
+        # the command that runs again, whatever way it exits
+        atexit.register(remove_multiprocess_dir)
+        return
+    # kept blocked across the exec, see ``Prefork.run``
+    signal.pthread_sigmask(signal.SIG_BLOCK, STOP_SIGNALS)
+    env = dict(os.environ)
+    env[MULTIPROC_DIR_ENV] = tempfile.mkdtemp(prefix="prometheus-http-sd-")
+    env[OWNED_MULTIPROC_DIR_ENV] = env[MULTIPROC_DIR_ENV]
+    logger.info(
+        "Collect metrics of all processes in %s", env[MULTIPROC_DIR_ENV]
+    )
+    os.execve(
+        sys.executable,
+        [
+            sys.executable,
+            "-c",
+            "from prometheus_http_sd.cli import main; main()",
+            *argv,
+        ],
+        env,
+    )
+
+
+def remove_multiprocess_dir():
+    """Remove the dir created by ``enable_multiprocess_metrics``, the
+    children exit by ``os._exit`` and never get here."""
+    multiproc_dir = os.environ.get(MULTIPROC_DIR_ENV)
+    if multiproc_dir and multiproc_dir == os.environ.get(
+        OWNED_MULTIPROC_DIR_ENV
+    ):
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+
+
+def create_socket(host: str, port: int, backlog: int = 1024):
+    sock = socket.create_server((host, port), backlog=backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def create_task_queue():
+    return multiprocessing.get_context("fork").SimpleQueue()
+
+
+class Prefork:
+    """Fork ``run_scheduler(ready)`` once and ``run_server(ready)``
+    ``processes`` times, and keep them running until SIGTERM or SIGINT.
+    The targets call ``ready()`` when they are about to serve.
+
+    On SIGHUP, the scheduler reloads in place, see ``reload.py``, and the
+    serving processes are replaced one by one: a new one is started, and
+    only when it is ready the old one is told to stop accepting and finish
+    its requests. The cache is in the shared store, so a new process serves
+    it at once, and there is no moment without ``processes`` ready servers.
+    """
+
+    def __init__(self, processes: int, run_scheduler, run_server) -> None:
+        self.processes = processes
+        self.targets = {SCHEDULER: run_scheduler, SERVER: run_server}
+        # pid -> (role, started_at)
+        self.children = {}
+        # the old servers of a rotation, not to be restarted
+        self.retiring = set()
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self, role: str):
+        """Start a ``role`` process, return its pid and a pipe that is
+        readable when it is ready."""
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # the child, never return into the loop of the parent
+            os.close(ready_r)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+            def ready():
+                try:
+                    os.write(ready_w, b"1")
+                    os.close(ready_w)
+                except OSError:
+                    # nobody is waiting for it
+                    pass
+
+            code = 0
+            try:
+                self.targets[role](ready)
+            except BaseException:
+                logger.exception("The %s process %d failed", role, os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(ready_w)
+        self.children[pid] = (role, time.time())
+        logger.info("Started the %s process %d", role, pid)
+        return pid, ready_r
+
+    def start(self, role: str):
+        if self.stopping:
+            return
+        _, ready_r = self.spawn(role)
+        os.close(ready_r)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            self.kill(pid)
+
+    def reload(self, signum, frame):
+        self.reloading = True
+
+    def kill(self, pid: int):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def wait_ready(self, ready_r: int) -> bool:
+        try:
+            readable, _, _ = select.select([ready_r], [], [], READY_TIMEOUT)
+            # empty if the process exited before it was ready
+            return bool(readable) and os.read(ready_r, 1) == b"1"
+        finally:
+            os.close(ready_r)
+
+    def rotate(self):
+        self.reloading = False
+        logger.info("Reloading, replace the server processes one by one")
+        for pid, (role, _) in list(self.children.items()):
+            if role == SCHEDULER:
+                os.kill(pid, signal.SIGHUP)
+
+        old_servers = [
+            pid
+            for pid, (role, _) in self.children.items()
+            if role == SERVER and pid not in self.retiring
+        ]
+        for old in old_servers:
+            if self.stopping:
+                return
+            new, ready_r = self.spawn(SERVER)
+            if not self.wait_ready(ready_r):
+                # keep serving by the old ones, the new one is restarted
+                # by the loop if it died
+                logger.error(
+                    "The server process %d is not ready in %ds, stop"
+                    " reloading",
+                    new,
+                    READY_TIMEOUT,
+                )
+                return
+            self.retiring.add(old)
+            self.kill(old)
+
+    def reap(self, pid: int, status: int):
+        role, started_at = self.children.pop(pid, (None, 0))
+        if role is None:
+            return
+        mark_process_dead(pid)
+        if pid in self.retiring:
+            self.retiring.discard(pid)
+            return
+        if self.stopping:
+            return
+        logger.error(
+            "The %s process %d exited with %d, restart it",
+            role,
+            pid,
+            os.waitstatus_to_exitcode(status),
+        )
+        if time.time() - started_at < RESTART_DELAY:
+            time.sleep(RESTART_DELAY)
+        self.start(role)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        # a stop signal that came during the start is handled now
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+        self.start(SCHEDULER)
+        for _ in range(self.processes):
+            self.start(SERVER)
+
+        while self.children:
+            if self.reloading and not self.stopping:
+                self.rotate()
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                # os.wait() would not return on SIGHUP, so poll
+                time.sleep(WAIT_INTERVAL)
+                continue
+            self.reap(pid, status)
+
+
+def serve_waitress(server, ready):
+    """Run a waitress ``server`` of ``create_server``, on SIGTERM stop
+    accepting and exit when the requests in progress are done."""
+
+    def drain():
+        deadline = time.time() + DRAIN_TIMEOUT
+        while time.time() < deadline and any(
+            channel.requests or channel.total_outbufs_len
+            for channel in list(server.active_channels.values())
+        ):
+            time.sleep(WAIT_INTERVAL)
+        os._exit(0)
+
+    def stop(signum, frame):
+        # the listening socket is shared, only this process stops accepting
+        server.del_channel()
+        server.socket.close()
+        threading.Thread(target=drain, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    ready()
+    server.run()
+
+
+def mark_process_dead(pid: int):
+    if os.environ.get(MULTIPROC_DIR_ENV):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,172 @@
+"""Background profiling jobs for ``?debug=true``. Profiling runs every
+generator under a path again, which may take minutes on a large tree, so it
+runs in its own small threadpool and the client polls the result by job
+id."""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import threading
+import time
+from typing import Optional
+import uuid
+
+from .cache_store import CacheError
+from .mounts import locate
+from .sd import profile_generators
+
+logger = logging.getLogger(__name__)
+
+# finished jobs are dropped, oldest first, when there are more than this
+MAX_JOBS = 100
+
+# new jobs are rejected while this many are waiting or running
+MAX_PENDING_JOBS = 10
+
+
+class TooManyJobs(Exception):
+    def __init__(self, max_pending: int) -> None:
+        super().__init__(
+            f"{max_pending} profiling jobs are pending, try again later"
+        )
+
+
+class ProfileJob:
+    def __init__(self, path: str, extra_args: dict, profile_top: int) -> None:
+        self.job_id = uuid.uuid4().hex
+        self.path = path
+        self.extra_args = extra_args
+        self.profile_top = profile_top
+        self.status = "pending"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "path": self.path,
+            "extra_args": self.extra_args,
+            "profile_top": self.profile_top,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "generators": self.result,
+            "error": self.error,
+        }
+
+
+class ProfileJobs:
+    def __init__(
+        self,
+        max_workers: int = 1,
+        max_jobs: int = MAX_JOBS,
+        store=None,
+        max_pending: int = MAX_PENDING_JOBS,
+    ):
+        self.threadpool = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_jobs = max_jobs
+        self.max_pending = max_pending
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        # with several serve processes, the job may be polled from another
+        # process than the one running it, so it is saved into the shared
+        # cache store too
+        self.store = store
+
+    def _store_key(self, job_id: str) -> str:
+        return f"/debug/jobs/{job_id}"
+
+    def _save(self, job: ProfileJob):
+        if self.store is None:
+            return
+        payload = json.dumps(job.to_dict(), default=str).encode()
+        header = {"updated_timestamp": time.time(), "size": len(payload)}
+        try:
+            self.store.save(self._store_key(job.job_id), header, payload)
+        except Exception:
+            logger.exception("Failed to save profiling job %s", job.job_id)
+
+    def _delete(self, job_id: str):
+        if self.store is None:
+            return
+        try:
+            self.store.delete(self._store_key(job_id))
+        except Exception:
+            logger.exception("Failed to delete profiling job %s", job_id)
+
+    def submit(
+        self, path: str, extra_args: dict, profile_top: int = 0
+    ) -> ProfileJob:
+        """Start profiling ``path``, the same job is returned if the path
+        with the same arguments is still waiting or running. Raise
+        ``TooManyJobs`` if ``max_pending`` jobs are."""
+        with self.lock:
+            pending = [job for job in self.jobs.values() if not job.finished]
+            for job in pending:
+                if (
+                    job.path == path
+                    and job.extra_args == extra_args
+                    and job.profile_top == profile_top
+                ):
+                    return job
+            if len(pending) >= self.max_pending:
+                raise TooManyJobs(self.max_pending)
+
+            job = ProfileJob(path, extra_args, profile_top)
+            self.jobs[job.job_id] = job
+            evicted = self._evict()
+        for job_id in evicted:
+            self._delete(job_id)
+        self._save(job)
+        self.threadpool.submit(self.run, job)
+        return job
+
+    def _evict(self) -> list:
+        finished = [j.job_id for j in self.jobs.values() if j.finished]
+        evicted = finished[: max(0, len(self.jobs) - self.max_jobs)]
+        for job_id in evicted:
+            del self.jobs[job_id]
+        return evicted
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    def get_dict(self, job_id: str) -> Optional[dict]:
+        """The job as a dict, from this process or the shared store."""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if self.store is None:
+            return None
+        try:
+            entry = self.store.open(self._store_key(job_id))
+        except CacheError:
+            return None
+        return json.loads(entry.read())
+
+    def run(self, job: ProfileJob):
+        job.status = "running"
+        job.started_at = time.time()
+        self._save(job)
+        try:
+            root, path = locate(job.path)
+            job.result = profile_generators(
+                root, path, job.extra_args, job.profile_top
+            )
+            job.status = "done"
+        except Exception as e:
+            logger.exception("Profiling job %s failed", job.job_id)
+            job.error = f"{type(e).__name__}: {e}"
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            self._save(job)
@@ -1,17 +1,48 @@
 import json
 import logging
+from typing import Any, Dict, List, Optional
+
 import redis
-from typing import Any, Dict, Optional
+
+from .pool import get_client
 
 logger = logging.getLogger(__name__)
 
+# workers publish the key of every cache they write to this channel
+CHANGES_CHANNEL = "httpsd:changes"
+
+# a generated result is a hash of these small fields, with their types, and
+# of its payload, encoded once by the worker and sent by the servers as it is
+HEADER_FIELDS = {
+    "updated_timestamp": float,
+    "duration": float,
+    "size": int,
+    "target_count": int,
+    "etag": str,
+    "version": int,
+    "content_type": str,
+}
+PAYLOAD_FIELD = "payload"
+
+
+def _parse_header(values) -> Optional[Dict[str, Any]]:
+    header = {}
+    for (name, parse), value in zip(HEADER_FIELDS.items(), values):
+        if value is not None:
+            if isinstance(value, bytes):
+                value = value.decode()
+            header[name] = parse(value)
+    if "updated_timestamp" not in header:
+        return None
+    return header
+
 
 class RedisCache:
     def __init__(self, redis_url: str = "redis://localhost:6379/0"):
         self.redis_url = redis_url
-        self._redis_client = redis.from_url(
-            self.redis_url, decode_responses=True
-        )
+        self._redis_client = get_client(self.redis_url)
+        # the payloads are bytes, read them without decoding
+        self._raw_client = get_client(self.redis_url, decode_responses=False)
 
     def get(self, key: str) -> Optional[Dict[str, Any]]:
         data = self._redis_client.get(key)
@@ -29,6 +60,66 @@ class RedisCache:
         )
         return result
 
+    def set_entry(
+        self,
+        key: str,
+        header: Dict[str, Any],
+        payload: bytes,
+        expire_seconds: int = 300,
+    ) -> bool:
+        """Store a generated result as the hash of its ``header`` fields and
+        its encoded ``payload``, replacing the previous one at once."""
+        mapping = {
+            name: value
+            for name, value in header.items()
+            if name in HEADER_FIELDS and value is not None
+        }
+        mapping[PAYLOAD_FIELD] = payload
+        pipe = self._raw_client.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, expire_seconds)
+        result = pipe.execute()[-1]
+        logger.debug(
+            f"Cached {len(payload)} bytes for key {key} with "
+            f"{expire_seconds}s expiration"
+        )
+        return bool(result)
+
+    def read_header(self, key: str) -> Optional[Dict[str, Any]]:
+        """The header fields of the result of ``key``, without its
+        payload."""
+        try:
+            values = self._redis_client.hmget(key, list(HEADER_FIELDS))
+        except redis.ResponseError:
+            # not a hash, e.g. written by an older worker
+            return None
+        return _parse_header(values)
+
+    def read_entries(self, keys: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """The header fields of the results of ``keys`` with their payload
+        bytes under ``"payload"``, in one round trip."""
+        if not keys:
+            return []
+        fields = list(HEADER_FIELDS) + [PAYLOAD_FIELD]
+        pipe = self._raw_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, fields)
+        entries = []
+        for values in pipe.execute(raise_on_error=False):
+            # an error if the key is not a hash, e.g. written by an older
+            # worker, it is a miss then
+            entry = None
+            if not isinstance(values, Exception) and values[-1] is not None:
+                entry = _parse_header(values[:-1])
+                if entry is not None:
+                    entry[PAYLOAD_FIELD] = values[-1]
+            entries.append(entry)
+        return entries
+
+    def read_entry(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.read_entries([key])[0]
+
     def delete(self, key: str) -> bool:
         """Delete cached data for a key."""
         result = self._redis_client.delete(key)
@@ -38,3 +129,18 @@ class RedisCache:
     def exists(self, key: str) -> bool:
         """Check if a key exists in cache."""
         return bool(self._redis_client.exists(key))
+
+    def publish_change(self, key: str) -> None:
+        """Tell the servers that the cache of ``key`` was written."""
+        self._redis_client.publish(CHANGES_CHANNEL, key)
+
+    def listen_changes(self, callback, on_subscribed=None) -> None:
+        """Call ``callback(key)`` for every change published, forever.
+        ``on_subscribed()`` is called once the channel is subscribed."""
+        pubsub = self._redis_client.pubsub()
+        pubsub.subscribe(CHANGES_CHANNEL)
+        for message in pubsub.listen():
+            if message["type"] == "message":
+                callback(message["data"])
+            elif message["type"] == "subscribe" and on_subscribed:
+                on_subscribed()
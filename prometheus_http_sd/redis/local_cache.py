@@ -0,0 +1,108 @@
+"""In-process read-through cache of ``ServerDispatcher``: the hot keys are
+read by every Prometheus server polling them, so the data of the most
+recently read keys is kept in memory, and a request for them does not go to
+Redis at all.
+
+It stays consistent by the ``httpsd:changes`` channel, where the workers
+publish every key they write: a published key is dropped here, and read from
+Redis again by its next request. A message published while the server is
+not subscribed is lost, so the whole cache is cleared, and not used, until
+the subscription is back.
+
+It is bounded both by its number of keys and by the total bytes of their
+payloads, a single result bigger than all the bytes is not kept.
+"""
+
+import collections
+import threading
+from typing import Any, Optional
+
+from ..metrics import local_cache_operations
+
+# how many keys are kept by default
+LOCAL_CACHE_SIZE = 1024
+# how many bytes of payload are kept by default
+LOCAL_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def payload_size(value: Any) -> int:
+    """The bytes of the ``"payload"`` of a cached entry."""
+    if isinstance(value, dict):
+        payload = value.get("payload")
+        if isinstance(payload, (bytes, str)):
+            return len(payload)
+    return 0
+
+
+class LocalCache:
+    def __init__(
+        self,
+        max_size: int = LOCAL_CACHE_SIZE,
+        max_bytes: int = LOCAL_CACHE_BYTES,
+    ) -> None:
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        # key -> (value, size)
+        self._data = collections.OrderedDict()
+        self.bytes = 0
+        # increased by every invalidation, a value read from Redis before
+        # an invalidation may be outdated and is not put
+        self.generation = 0
+        self.enabled = False
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            value, _ = self._data.get(key, (None, 0))
+            if value is not None:
+                self._data.move_to_end(key)
+        local_cache_operations.labels(
+            operation="miss" if value is None else "hit"
+        ).inc()
+        return value
+
+    def put(self, key: str, value: Any, generation: int):
+        """Keep ``value`` read from Redis when ``generation`` was
+        current."""
+        if not self.max_size or value is None:
+            return
+        size = payload_size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if not self.enabled or generation != self.generation:
+                return
+            self._pop(key)
+            self._data[key] = (value, size)
+            self.bytes += size
+            while (
+                len(self._data) > self.max_size or self.bytes > self.max_bytes
+            ):
+                _, (_, dropped) = self._data.popitem(last=False)
+                self.bytes -= dropped
+
+    def _pop(self, key: str) -> bool:
+        # under the lock
+        value, size = self._data.pop(key, (None, 0))
+        self.bytes -= size
+        return value is not None
+
+    def invalidate(self, key: str):
+        with self.lock:
+            self.generation += 1
+            if self._pop(key):
+                local_cache_operations.labels(operation="invalidate").inc()
+
+    def subscribed(self):
+        """The changes channel is subscribed, the cache can be used."""
+        with self.lock:
+            self.generation += 1
+            self.enabled = True
+
+    def unsubscribed(self):
+        """The changes channel is lost, forget everything."""
+        with self.lock:
+            self.generation += 1
+            self.enabled = False
+            self._data.clear()
+            self.bytes = 0
@@ -0,0 +1,95 @@
+"""One Redis connection pool per process and url, shared by all the
+``RedisCache`` and ``RedisJobQueue`` instances, e.g. of all the workers of a
+``WorkerPool``, instead of a pool per instance. The raw clients, which return
+bytes instead of decoding them, have a pool of their own.
+
+The pool blocks up to ``POOL_TIMEOUT`` seconds for a free connection when
+``config.redis_max_connections`` are in use, how long is exported as
+``httpsd_redis_pool_wait_seconds``.
+"""
+
+import threading
+import time
+from typing import Dict, Tuple
+
+import redis
+
+from ..config import config
+from ..metrics import (
+    redis_pool_connections,
+    redis_pool_max_connections,
+    redis_pool_wait_seconds,
+)
+
+# raise ConnectionError if no connection is free after this many seconds
+POOL_TIMEOUT = 20
+
+# the default of --redis-max-connections
+MAX_CONNECTIONS = 128
+
+# a worker holds one connection while it waits for a job (BRPOP), and one
+# more to renew the lease of the job it processes
+CONNECTIONS_PER_WORKER = 2
+
+# beside the workers, for the requeue thread of the pool and the metrics
+SPARE_CONNECTIONS = 4
+
+_pools: Dict[Tuple[str, bool], "InstrumentedConnectionPool"] = {}
+_pools_lock = threading.Lock()
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        connection = super().get_connection(*args, **kwargs)
+        redis_pool_wait_seconds.observe(time.perf_counter() - start)
+        redis_pool_connections.labels(state="in_use").inc()
+        redis_pool_connections.labels(state="created").set(
+            sum(len(pool._connections) for pool in list(_pools.values()))
+        )
+        return connection
+
+    def release(self, connection):
+        super().release(connection)
+        redis_pool_connections.labels(state="in_use").dec()
+
+
+def worker_max_connections(num_workers: int, max_connections=None) -> int:
+    """The pool size of a process that runs ``num_workers`` workers, by
+    default enough for all of them, at least ``MAX_CONNECTIONS``. A
+    ``max_connections`` that is too small is rejected, the workers would
+    wait for the pool and then fail."""
+    needed = num_workers * CONNECTIONS_PER_WORKER + SPARE_CONNECTIONS
+    if max_connections is None:
+        return max(MAX_CONNECTIONS, needed)
+    if max_connections < needed:
+        raise ValueError(
+            f"{num_workers} workers need at least {needed} connections,"
+            f" got {max_connections}"
+        )
+    return max_connections
+
+
+def create_pool(
+    redis_url: str, decode_responses: bool = True
+) -> InstrumentedConnectionPool:
+    redis_pool_max_connections.inc(config.redis_max_connections)
+    return InstrumentedConnectionPool.from_url(
+        redis_url,
+        max_connections=config.redis_max_connections,
+        timeout=POOL_TIMEOUT,
+        socket_keepalive=config.redis_socket_keepalive,
+        health_check_interval=config.redis_health_check_interval,
+        decode_responses=decode_responses,
+    )
+
+
+def get_client(redis_url: str, decode_responses: bool = True) -> redis.Redis:
+    """A client of the shared pool of ``redis_url``, the pool is created by
+    the first call with the current ``config``."""
+    key = (redis_url, decode_responses)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = create_pool(redis_url, decode_responses)
+    return redis.Redis(connection_pool=pool)
@@ -1,83 +1,403 @@
 import json
 import logging
-import redis
 import time
 from typing import Any, Dict, Optional
-from ..metrics import queue_job_gauge
+from ..fair_queue import tenant_label, top_level_dir
+from .pool import get_client
+from ..metrics import (
+    queue_job_gauge,
+    redis_job_lease_timeouts,
+    redis_jobs_deduplicated,
+    redis_jobs_redelivered,
+    tenant_queue_depth,
+    tenant_queue_wait_seconds,
+)
 
 logger = logging.getLogger(__name__)
 
+# A job is in flight from its enqueue until a worker finishes it, while the
+# ``<queue>:inflight:<full_path>`` marker is there, no other job of the same
+# full_path is enqueued. The marker expires by itself after this many
+# seconds, so a lost job does not block its path forever.
+INFLIGHT_SECONDS = 600
+
+# A dequeued job is leased to its worker, in the ``<queue>:processing``
+# sorted set scored by the lease deadline, until the worker acks it by
+# ``finish_job``. The worker renews the lease while the job runs, a job whose
+# lease expired (its worker died) is queued again by ``requeue_expired``, at
+# most ``MAX_DELIVERIES`` times in total, so jobs are processed at least once.
+VISIBILITY_TIMEOUT = 60
+MAX_DELIVERIES = 3
+
+# Jobs are queued per tenant (top level directory) into
+# ``<queue>:tenant:<tenant>``, the tenants which have jobs waiting are kept in
+# the ``<queue>:tenants`` sorted set, scored by the virtual time of their next
+# job. Dequeue always serves the tenant with the lowest score, then moves it
+# forward by 1/weight, so tenants share the workers by their weights.
+# A newly active tenant starts at the current virtual time instead of 0, so it
+# can not take over the workers because it was idle for a long time.
+#
+# Every key a script touches is passed in KEYS, as Redis requires, keys which
+# depend on what is in Redis (the tenant to serve, the job of an expired
+# lease) are read first and checked again in the script. On Redis Cluster all
+# the keys must be in one slot, use a queue name with a hash tag for that,
+# e.g. ``{target_generation_queue}``.
+ENQUEUE_SCRIPT = """
+local tenants_key, vtime_key, signal_key = KEYS[1], KEYS[2], KEYS[3]
+local marker_key, tenant_queue_key = KEYS[4], KEYS[5]
+if not redis.call('SET', marker_key, ARGV[3], 'NX', 'EX', ARGV[4]) then
+    return 0
+end
+redis.call('LPUSH', tenant_queue_key, ARGV[2])
+if not redis.call('ZSCORE', tenants_key, ARGV[1]) then
+    local vtime = tonumber(redis.call('GET', vtime_key) or '0')
+    redis.call('ZADD', tenants_key, vtime, ARGV[1])
+end
+redis.call('LPUSH', signal_key, '1')
+return redis.call('LLEN', tenant_queue_key)
+"""
+
+# A lease is ``<job_id>#<delivery>``, so the ack of a worker whose lease
+# expired does not remove the lease of the next delivery. The marker is
+# cleared only if it is still the one of this job.
+FINISH_SCRIPT = """
+local processing_key, jobs_key, deliveries_key = KEYS[1], KEYS[2], KEYS[3]
+if redis.call('ZREM', processing_key, ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HDEL', jobs_key, ARGV[1])
+redis.call('HDEL', deliveries_key, ARGV[2])
+if redis.call('GET', KEYS[4]) == ARGV[2] then
+    redis.call('DEL', KEYS[4])
+end
+return 1
+"""
+
+EXTEND_SCRIPT = """
+if redis.call('ZADD', KEYS[1], 'XX', 'CH', ARGV[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return 1
+"""
+
+# Move the job of an expired lease back to the head of its tenant queue, or
+# drop it after max deliveries. Returns 1 if it is queued again, 2 if it is
+# dropped, 0 if the lease was acked or renewed since it was read.
+REQUEUE_SCRIPT = """
+local processing_key, jobs_key, deliveries_key = KEYS[1], KEYS[2], KEYS[3]
+local tenants_key, vtime_key, signal_key = KEYS[4], KEYS[5], KEYS[6]
+local marker_key, tenant_queue_key = KEYS[7], KEYS[8]
+local lease, job_id, tenant = ARGV[1], ARGV[6], ARGV[5]
+local deadline = redis.call('ZSCORE', processing_key, lease)
+if not deadline or tonumber(deadline) > tonumber(ARGV[2]) then
+    return 0
+end
+local job = redis.call('HGET', jobs_key, lease)
+redis.call('ZREM', processing_key, lease)
+redis.call('HDEL', jobs_key, lease)
+if not job then
+    return 0
+end
+local deliveries = tonumber(redis.call('HGET', deliveries_key, job_id) or '0')
+if deliveries >= tonumber(ARGV[3]) then
+    redis.call('HDEL', deliveries_key, job_id)
+    if redis.call('GET', marker_key) == job_id then
+        redis.call('DEL', marker_key)
+    end
+    return 2
+end
+redis.call('RPUSH', tenant_queue_key, job)
+if not redis.call('ZSCORE', tenants_key, tenant) then
+    local vtime = tonumber(redis.call('GET', vtime_key) or '0')
+    redis.call('ZADD', tenants_key, vtime, tenant)
+end
+redis.call('LPUSH', signal_key, '1')
+redis.call('EXPIRE', marker_key, ARGV[4])
+return 1
+"""
+
+# Take a job of ``ARGV[1]``, which was read as the tenant with the lowest
+# score, returns 0 if another worker served a tenant meanwhile, then the
+# caller reads the head again.
+DEQUEUE_SCRIPT = """
+local tenants_key, vtime_key = KEYS[1], KEYS[2]
+local processing_key, jobs_key, deliveries_key = KEYS[3], KEYS[4], KEYS[5]
+local tenant_queue_key = KEYS[6]
+local tenant = ARGV[1]
+local head = redis.call('ZRANGE', tenants_key, 0, 0, 'WITHSCORES')
+if head[1] ~= tenant then
+    return 0
+end
+local vtime = tonumber(head[2])
+local job = redis.call('RPOP', tenant_queue_key)
+local depth = redis.call('LLEN', tenant_queue_key)
+if depth == 0 then
+    redis.call('ZREM', tenants_key, tenant)
+else
+    redis.call('ZINCRBY', tenants_key, 1 / tonumber(ARGV[2]), tenant)
+end
+if not job then
+    return 0
+end
+redis.call('SET', vtime_key, vtime)
+local job_id = cjson.decode(job)['job_id']
+local delivery = redis.call('HINCRBY', deliveries_key, job_id, 1)
+local lease = job_id .. '#' .. delivery
+redis.call('ZADD', processing_key, ARGV[3], lease)
+redis.call('HSET', jobs_key, lease, job)
+return {job, depth, lease, delivery}
+"""
+
+# how many expired leases one requeue_expired call handles
+REQUEUE_BATCH = 100
+
 
 class RedisJobQueue:
     def __init__(
         self,
         redis_url: str = "redis://localhost:6379/0",
         queue_name: str = "target_generation_queue",
+        tenant_weights: Optional[Dict[str, float]] = None,
+        inflight_seconds: int = INFLIGHT_SECONDS,
+        visibility_timeout: int = VISIBILITY_TIMEOUT,
+        max_deliveries: int = MAX_DELIVERIES,
     ):
         self.redis_url = redis_url
         self.queue_name = queue_name
-        self._redis_client = redis.from_url(
-            self.redis_url, decode_responses=True
-        )
+        self.tenant_weights = tenant_weights or {}
+        self.inflight_seconds = inflight_seconds
+        self.inflight_prefix = f"{queue_name}:inflight:"
+        self.visibility_timeout = visibility_timeout
+        self.max_deliveries = max_deliveries
+        self.processing_key = f"{queue_name}:processing"
+        self.jobs_key = f"{queue_name}:jobs"
+        self.deliveries_key = f"{queue_name}:deliveries"
+        self.tenants_key = f"{queue_name}:tenants"
+        self.tenant_queue_prefix = f"{queue_name}:tenant:"
+        self.vtime_key = f"{queue_name}:vtime"
+        self.signal_key = f"{queue_name}:signal"
+        # the tenant labels whose depth was last set above 0
+        self._depth_labels = set()
+        self._redis_client = get_client(self.redis_url)
         self._redis_client.ping()
+        self._enqueue_script = self._redis_client.register_script(
+            ENQUEUE_SCRIPT
+        )
+        self._dequeue_script = self._redis_client.register_script(
+            DEQUEUE_SCRIPT
+        )
+        self._finish_script = self._redis_client.register_script(FINISH_SCRIPT)
+        self._extend_script = self._redis_client.register_script(EXTEND_SCRIPT)
+        self._requeue_script = self._redis_client.register_script(
+            REQUEUE_SCRIPT
+        )
         logger.info(f"Connected to Redis queue at {self.redis_url}")
 
+    def _tenant_queue(self, tenant: str) -> str:
+        return f"{self.tenant_queue_prefix}{tenant}"
+
+    def _inflight_key(self, full_path: str) -> str:
+        return f"{self.inflight_prefix}{full_path}"
+
     def is_job_queued_or_processing(self, full_path: str) -> bool:
-        """Check if a job for the given full_path is already queued.
+        """Check if a job for the given full_path is queued, or being
+        processed by a worker.
 
         Args:
             full_path: The full path of the job to check
 
         Returns:
-            bool: True if job is queued, False otherwise
+            bool: True if job is queued or processing, False otherwise
         """
-        jobs = self._redis_client.lrange(self.queue_name, 0, -1)
-        main_queue_count = len(jobs)
-        logger.debug(
-            f"Checking {main_queue_count} jobs in queue for " f"{full_path}"
+        return bool(self._redis_client.exists(self._inflight_key(full_path)))
+
+    def finish_job(self, job_data: Dict[str, Any]) -> bool:
+        """Ack the job when it is done, successful or not, a new job of
+        its full_path can be enqueued then. Return False if its lease had
+        expired, then it may be processed again."""
+        return bool(
+            self._finish_script(
+                keys=[
+                    self.processing_key,
+                    self.jobs_key,
+                    self.deliveries_key,
+                    self._inflight_key(job_data["full_path"]),
+                ],
+                args=[job_data.get("lease", ""), job_data.get("job_id", "")],
+            )
         )
 
-        for job_json in jobs:
-            job = json.loads(job_json)
-            if job.get("full_path") == full_path:
-                logger.info(f"Found job in queue for {full_path}")
-                return True
+    def extend_lease(self, job_data: Dict[str, Any]) -> bool:
+        """Renew the lease of a running job, return False if it had
+        expired."""
+        return bool(
+            self._extend_script(
+                keys=[
+                    self.processing_key,
+                    self._inflight_key(job_data["full_path"]),
+                ],
+                args=[
+                    job_data["lease"],
+                    time.time() + self.visibility_timeout,
+                    self.inflight_seconds,
+                ],
+            )
+        )
 
-        logger.debug(f"No existing job found for {full_path}")
-        return False
+    def requeue_expired(self) -> int:
+        """Queue again the jobs whose lease expired, return how many."""
+        now = time.time()
+        leases = self._redis_client.zrangebyscore(
+            self.processing_key, "-inf", now, start=0, num=REQUEUE_BATCH
+        )
+        requeued, dropped = 0, 0
+        for lease in leases:
+            job_json = self._redis_client.hget(self.jobs_key, lease)
+            if job_json is None:
+                self._redis_client.zrem(self.processing_key, lease)
+                continue
+            job_data = json.loads(job_json)
+            tenant = top_level_dir(job_data.get("path", ""))
+            result = self._requeue_script(
+                keys=[
+                    self.processing_key,
+                    self.jobs_key,
+                    self.deliveries_key,
+                    self.tenants_key,
+                    self.vtime_key,
+                    self.signal_key,
+                    self._inflight_key(job_data["full_path"]),
+                    self._tenant_queue(tenant),
+                ],
+                args=[
+                    lease,
+                    now,
+                    self.max_deliveries,
+                    self.inflight_seconds,
+                    tenant,
+                    job_data["job_id"],
+                ],
+            )
+            if result == 1:
+                requeued += 1
+            elif result == 2:
+                dropped += 1
+        if requeued or dropped:
+            redis_job_lease_timeouts.inc(requeued + dropped)
+            redis_jobs_redelivered.inc(requeued)
+            logger.warning(
+                f"Leases expired: {requeued} jobs queued again, {dropped}"
+                f" jobs dropped after {self.max_deliveries} deliveries"
+            )
+        return requeued
 
     def _update_queue_metrics(self):
         """Update Prometheus queue metrics."""
-        # Get queue length
-        queue_length = self._redis_client.llen(self.queue_name)
+        tenants = self._redis_client.zrange(self.tenants_key, 0, -1)
+        pipeline = self._redis_client.pipeline(transaction=False)
+        for t in tenants:
+            pipeline.llen(self._tenant_queue(t))
+
+        # many tenants may share the ``other`` label, add them up
+        depths = dict.fromkeys(self._depth_labels, 0)
+        for t, depth in zip(tenants, pipeline.execute()):
+            label = tenant_label(t)
+            depths[label] = depths.get(label, 0) + depth
+        for label, depth in depths.items():
+            tenant_queue_depth.labels(tenant=label).set(depth)
+        self._depth_labels = {label for label, d in depths.items() if d}
 
-        # Update metrics
-        queue_job_gauge.labels(status="pending").set(queue_length)
+        queue_job_gauge.labels(status="pending").set(sum(depths.values()))
 
     def enqueue_job(self, job_data: Dict[str, Any]) -> bool:
+        """Enqueue the job, return False if a job of the same full_path
+        is already queued or processing."""
         job_id = f"{job_data['full_path']}:{int(time.time())}"
         job_data["job_id"] = job_id
+        job_data["enqueued_at"] = time.time()
+        tenant = top_level_dir(job_data.get("path", ""))
 
-        result = self._redis_client.lpush(
-            self.queue_name, json.dumps(job_data)
+        tenant_depth = self._enqueue_script(
+            keys=[
+                self.tenants_key,
+                self.vtime_key,
+                self.signal_key,
+                self._inflight_key(job_data["full_path"]),
+                self._tenant_queue(tenant),
+            ],
+            args=[
+                tenant,
+                json.dumps(job_data),
+                job_id,
+                self.inflight_seconds,
+            ],
+        )
+        if not tenant_depth:
+            redis_jobs_deduplicated.inc()
+            logger.info(
+                f"Job already queued/processing for {job_data['full_path']}"
+            )
+            return False
+        logger.info(
+            f"Enqueued job {job_id} for {job_data['full_path']} "
+            f"(tenant={tenant!r})"
         )
-        logger.info(f"Enqueued job {job_id} for {job_data['full_path']}")
 
         # Update queue metrics
         self._update_queue_metrics()
 
-        return bool(result)
+        return True
 
     def dequeue_job(self, timeout: int = 0) -> Optional[Dict[str, Any]]:
-        result = self._redis_client.brpop(self.queue_name, timeout=timeout)
+        # every enqueued job pushes a signal, block on the signal list,
+        # then take the fairest job which may not be the one who signaled.
+        # The signal is popped apart from the job, a worker may die between
+        # the two, so look for a job on timeout as well, a job whose signal
+        # was lost still gets to run.
+        self._redis_client.brpop(self.signal_key, timeout=timeout)
+
+        result = self._dequeue_fairest()
         if result:
-            _, job_json = result
+            tenant, (job_json, _, lease, delivery) = result
             job_data = json.loads(job_json)
+            job_data["lease"] = lease
+            job_data["delivery"] = delivery
 
             logger.debug(f"Dequeued job {job_data.get('job_id', 'unknown')}")
+            if "enqueued_at" in job_data:
+                tenant_queue_wait_seconds.labels(
+                    tenant=tenant_label(tenant)
+                ).observe(time.time() - job_data["enqueued_at"])
 
             # Update queue metrics
             self._update_queue_metrics()
 
             return job_data
         return None
+
+    def _dequeue_fairest(self):
+        """The tenant with the lowest score and the job taken from it, or
+        None if no job is queued."""
+        while True:
+            head = self._redis_client.zrange(self.tenants_key, 0, 0)
+            if not head:
+                return None
+            tenant = head[0]
+            result = self._dequeue_script(
+                keys=[
+                    self.tenants_key,
+                    self.vtime_key,
+                    self.processing_key,
+                    self.jobs_key,
+                    self.deliveries_key,
+                    self._tenant_queue(tenant),
+                ],
+                args=[
+                    tenant,
+                    self.tenant_weights.get(tenant, 1),
+                    time.time() + self.visibility_timeout,
+                ],
+            )
+            if result:
+                return tenant, result
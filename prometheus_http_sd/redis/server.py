@@ -1,68 +1,280 @@
+import collections
+import io
+import json
 import logging
+import threading
 import time
 from datetime import datetime
-from pathlib import Path
+from typing import Optional
 
 from flask import Flask, jsonify, render_template, request
-from prometheus_client import make_wsgi_app
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
-from urllib.parse import urlencode
 
 from ..config import config
-from ..sd import run_python
+from ..handler import (
+    bulk_body,
+    cache_key,
+    parse_bulk_request,
+    scrape_configs_key,
+    split_dirs,
+)
+from ..delta import delta_since, full_snapshot, parse_since
+from ..load_shedding import AIMDLimiter, LoadShedding
+from ..params import params_index
+from ..path_index import SERVER_INDEX_SIZE, PathIndex
+from ..refresh_interval import (
+    REFRESH_INTERVAL_HEADER,
+    key_expire_seconds,
+    parse_refresh_interval,
+)
+from ..watch import (
+    ChangeNotifier,
+    WATCH_POLL_SECONDS,
+    max_watchers,
+    parse_watch_args,
+)
 from ..version import VERSION
 from .cache import RedisCache
+from .local_cache import LOCAL_CACHE_BYTES, LOCAL_CACHE_SIZE, LocalCache
 from .queue import RedisJobQueue
-from ..dispather import CacheNotExist, CacheExpired
+from ..dispather import (
+    SCRAPE_CONFIGS,
+    TARGETS,
+    CacheEntry,
+    CacheError,
+    CacheNotExist,
+    CacheExpired,
+)
 from ..metrics import (
     cache_operations,
+    make_metrics_wsgi_app,
+    path_labeler,
     path_last_generated_targets,
     target_path_requests_total,
     target_path_request_duration_seconds,
+    watch_requests_limited,
 )
 
 logger = logging.getLogger(__name__)
 
+# the keys whose refresh enqueued by this server is remembered, so that the
+# requests of a key do not run the enqueue script until it lands
+ENQUEUED_KEYS_SIZE = 4096
+
 
 class ServerDispatcher:
-    def __init__(self, cache_expire_seconds: int):
+    def __init__(
+        self,
+        cache_expire_seconds: int,
+        local_cache_size: int = LOCAL_CACHE_SIZE,
+        local_cache_bytes: int = LOCAL_CACHE_BYTES,
+    ):
         self.cache_expire_seconds = cache_expire_seconds
         self.cache = RedisCache(config.redis_url)
+        self.local_cache = LocalCache(local_cache_size, local_cache_bytes)
         self.queue = RedisJobQueue(config.redis_url)
+        # what the admin page shows, as seen by this server, any key a
+        # client asks for gets in, so only the recent ones are kept
+        self.index = PathIndex(SERVER_INDEX_SIZE)
+        # full_path -> when this server last enqueued a refresh of it
+        self._enqueued = collections.OrderedDict()
+        self._enqueued_lock = threading.Lock()
+
+        # wakes up the ?watch= requests when a worker writes a cache
+        self.notifier = ChangeNotifier()
+        threading.Thread(target=self._listen_changes, daemon=True).start()
+
+    def _listen_changes(self):
+        while True:
+            try:
+                self.cache.listen_changes(
+                    self._on_change, self.local_cache.subscribed
+                )
+            except Exception as e:
+                logger.error(f"Lost the changes channel: {e}, reconnecting")
+            # changes may be missed until subscribed again
+            self.local_cache.unsubscribed()
+            with self._enqueued_lock:
+                self._enqueued.clear()
+            time.sleep(1)
+
+    def _on_change(self, full_path: str):
+        """``full_path`` was written, or its refresh failed."""
+        self.local_cache.invalidate(full_path)
+        with self._enqueued_lock:
+            self._enqueued.pop(full_path, None)
+        self.notifier.notify(full_path)
+
+    def _read(self, full_path: str):
+        """The cached header and payload of ``full_path``, from the local
+        cache if it is there, otherwise from Redis."""
+        data = self.local_cache.get(full_path)
+        if data is None:
+            generation = self.local_cache.generation
+            data = self.cache.read_entry(full_path)
+            self.local_cache.put(full_path, data, generation)
+        return data
+
+    def _read_many(self, full_paths) -> list:
+        datas = [self.local_cache.get(full_path) for full_path in full_paths]
+        missing = [i for i, data in enumerate(datas) if data is None]
+        if missing:
+            generation = self.local_cache.generation
+            fetched = self.cache.read_entries([full_paths[i] for i in missing])
+            for i, data in zip(missing, fetched):
+                datas[i] = data
+                self.local_cache.put(full_paths[i], data, generation)
+        return datas
 
     def _enqueue_job(
-        self, full_path: str, path: str, extra_args: dict, reason: str = ""
+        self,
+        full_path: str,
+        path: str,
+        extra_args: dict,
+        reason: str = "",
+        kind: str = TARGETS,
+        updated_timestamp: Optional[float] = None,
     ):
-        if self.queue.is_job_queued_or_processing(full_path):
-            logger.info(
-                f"Job already queued/processing for {full_path}, "
-                f"skipping duplicate"
-            )
+        if self._recently_enqueued(full_path, updated_timestamp):
+            # its refresh is queued or running, a hot key would otherwise
+            # run the enqueue script for every request until it lands
             return
+        with self._enqueued_lock:
+            self._enqueued[full_path] = time.time()
+            self._enqueued.move_to_end(full_path)
+            while len(self._enqueued) > ENQUEUED_KEYS_SIZE:
+                self._enqueued.popitem(last=False)
 
         job_data = {
             "full_path": full_path,
             "path": path,
             "extra_args": extra_args,
+            "kind": kind,
+            # the worker keeps the cache as long as the server accepts it
+            "refresh_interval": self.index.refresh_interval(full_path),
         }
 
+        # a duplicate of a queued or processing job is dropped by the queue
         if self.queue.enqueue_job(job_data):
+            self.index.record_status(full_path, path, "queued")
             log_msg = f"Enqueued job for {full_path}"
             if reason:
                 log_msg += f" ({reason})"
             logger.info(log_msg)
-        else:
-            logger.error(f"Failed to enqueue job for {full_path}")
+
+    def _recently_enqueued(
+        self, full_path: str, updated_timestamp: Optional[float]
+    ) -> bool:
+        """If this server enqueued a refresh of ``full_path`` that has not
+        landed yet, it is skipped for a refresh interval of the key, at most
+        until the in-flight marker of the job expires."""
+        enqueued_at = self._enqueued.get(full_path)
+        if enqueued_at is None:
+            return False
+        if updated_timestamp is not None and updated_timestamp >= enqueued_at:
+            return False
+        window = self.queue.inflight_seconds
+        refresh_interval = self.index.refresh_interval(full_path)
+        if refresh_interval is not None:
+            window = min(window, refresh_interval)
+        return time.time() - enqueued_at < window
 
     def get_targets(self, path: str, full_path: str, **extra_args):
-        data = self.cache.get(full_path)
+        data = self.get_targets_data(path, full_path, **extra_args)
+        return json.loads(data["payload"])
+
+    def get_targets_data(self, path: str, full_path: str, **extra_args):
+        """Like ``get_targets``, but return the cached header, with the
+        etag and the update time, and the encoded ``"payload"``."""
+        return self._get_cached(full_path, path, extra_args, TARGETS)
+
+    def watch_targets(self, full_path: str, etag: str, timeout: float):
+        """Wait up to ``timeout`` seconds until the cached targets have an
+        etag different from ``etag``, return False if they do not."""
+        deadline = time.time() + timeout
+        while True:
+            event = self.notifier.event(full_path)
+            # only the etag is needed, not the payload
+            data = self.local_cache.get(full_path) or self.cache.read_header(
+                full_path
+            )
+            if data is None or data.get("etag") != etag:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            event.wait(min(remaining, WATCH_POLL_SECONDS))
+
+    def get_scrape_configs(self, path: str, full_path: str, **extra_args):
+        """The cached scrape configs of ``<root>/<path>.py``, generated by
+        the workers like targets, as ``get_targets_data``."""
+        return self._get_cached(full_path, path, extra_args, SCRAPE_CONFIGS)
+
+    def get_targets_data_many(self, requests) -> list:
+        """``get_targets_data`` for many ``(full_path, path, extra_args)``
+        in one round trip, the result of each request is either its cached data
+        or the ``CacheError`` raised for it."""
+        datas = self._read_many([full_path for full_path, _, _ in requests])
+        results = []
+        for (full_path, path, extra_args), data in zip(requests, datas):
+            try:
+                results.append(
+                    self._check_cached(
+                        full_path, path, extra_args, TARGETS, data
+                    )
+                )
+            except CacheError as e:
+                results.append(e)
+        return results
+
+    def _get_cached(
+        self, full_path: str, path: str, extra_args: dict, kind: str
+    ):
+        return self._check_cached(
+            full_path, path, extra_args, kind, self._read(full_path)
+        )
+
+    def _check_cached(
+        self, full_path: str, path: str, extra_args: dict, kind: str, data
+    ):
+        """Return ``data`` read from the cache of ``full_path`` if it is
+        fresh, otherwise enqueue a job to refresh it and raise."""
+        self.index.record_request(full_path, path)
         if data:
             updated_timestamp = data["updated_timestamp"]
+            self.index.record_refresh(
+                full_path,
+                path,
+                "cached",
+                data.get("duration"),
+                {
+                    "updated_timestamp": updated_timestamp,
+                    "target_count": data.get("target_count"),
+                },
+            )
             current = datetime.now().timestamp()
-            if current - updated_timestamp <= self.cache_expire_seconds:
+            refresh_interval = self.index.refresh_interval(full_path)
+            expire_seconds = key_expire_seconds(
+                self.cache_expire_seconds, refresh_interval
+            )
+            if current - updated_timestamp <= expire_seconds:
                 logger.info(f"Cache hit for {full_path}")
                 cache_operations.labels(operation="hit").inc()
-                return data["results"]
+                if (
+                    refresh_interval is not None
+                    and current - updated_timestamp > refresh_interval
+                ):
+                    # the clients poll more often than the cache expires,
+                    # refresh it before that
+                    self._enqueue_job(
+                        full_path,
+                        path,
+                        extra_args,
+                        "refresh interval",
+                        kind,
+                        updated_timestamp,
+                    )
+                return data
             else:
                 logger.info(
                     f"Cache expired for {full_path} "
@@ -70,15 +282,22 @@ class ServerDispatcher:
                 )
                 cache_operations.labels(operation="expired").inc()
                 # Enqueue new job to refresh expired cache
-                self._enqueue_job(full_path, path, extra_args, "cache expired")
+                self._enqueue_job(
+                    full_path,
+                    path,
+                    extra_args,
+                    "cache expired",
+                    kind,
+                    updated_timestamp,
+                )
                 raise CacheExpired(
                     updated_timestamp=updated_timestamp,
-                    cache_excepire_seconds=self.cache_expire_seconds,
+                    cache_excepire_seconds=expire_seconds,
                 )
 
         # Cache miss - enqueue job for workers to process
         cache_operations.labels(operation="miss").inc()
-        self._enqueue_job(full_path, path, extra_args, "cache miss")
+        self._enqueue_job(full_path, path, extra_args, "cache miss", kind)
         raise CacheNotExist()
 
     def get_debug_info(self, full_path: str):
@@ -108,8 +327,13 @@ class ServerDispatcher:
                     ]
             debug_info["error_details"] = error_details
 
+        # Check for failed generators in partial result mode
+        generators_data = self.cache.get(f"generators:{full_path}")
+        if generators_data and generators_data.get("failures"):
+            debug_info["generator_failures"] = generators_data["failures"]
+
         # Check for normal cache result
-        normal_cache_data = self.cache.get(full_path)
+        normal_cache_data = self.cache.read_entry(full_path)
         logger.debug(f"Normal cache data: {normal_cache_data}")
 
         if normal_cache_data:
@@ -125,7 +349,7 @@ class ServerDispatcher:
                     if updated_timestamp
                     else None
                 ),
-                "results": normal_cache_data.get("results"),
+                "results": json.loads(normal_cache_data["payload"]),
                 "cache_age_seconds": (
                     f"{cache_age_seconds:.1f}s ago"
                     if cache_age_seconds
@@ -150,6 +374,8 @@ class ServerDispatcher:
         cache_deleted = self.cache.delete(full_path)
         if cache_deleted:
             logger.info(f"Cleared cache for {full_path}")
+            # drop it from the local cache of every server
+            self.cache.publish_change(full_path)
 
         # Clear error cache
         error_cache_key = f"error:{full_path}"
@@ -157,7 +383,9 @@ class ServerDispatcher:
         if error_cache_deleted:
             logger.info(f"Cleared error cache for {full_path}")
 
-        # Enqueue new job to regenerate
+        # Enqueue new job to regenerate, even if one was enqueued lately
+        with self._enqueued_lock:
+            self._enqueued.pop(full_path, None)
         self._enqueue_job(
             full_path, path, extra_args, "hard reload requested by user"
         )
@@ -171,7 +399,14 @@ class ServerDispatcher:
         }
 
 
-def create_server_app(prefix, cache_seconds):
+def create_server_app(
+    prefix,
+    cache_seconds,
+    shed_latency=0,
+    max_concurrency=64,
+    local_cache_size=LOCAL_CACHE_SIZE,
+    local_cache_bytes=LOCAL_CACHE_BYTES,
+):
     """Create Flask application for server-only mode."""
     import os
 
@@ -182,31 +417,88 @@ def create_server_app(prefix, cache_seconds):
     app = Flask(__name__, template_folder=template_folder)
 
     # Initialize dispatcher
-    dispatcher = ServerDispatcher(cache_seconds)
+    dispatcher = ServerDispatcher(
+        cache_seconds, local_cache_size, local_cache_bytes
+    )
+
+    # a ?watch= request holds a server thread while it waits, the waitress
+    # threads are max_concurrency
+    watchers = threading.BoundedSemaphore(max_watchers(max_concurrency))
+
+    def send_cached(data):
+        # the payload was encoded by the worker, send it as it is instead
+        # of decoding and encoding it again
+        response = app.response_class(
+            data["payload"],
+            content_type=data.get("content_type", "application/json"),
+        )
+        if data.get("etag"):
+            response.set_etag(data["etag"])
+        if data.get("version") is not None:
+            response.headers["X-Targets-Version"] = str(data["version"])
+        return response
 
     @app.route(f"{prefix}/")
     def admin():
         """Admin page showing available targets."""
         paths = []
         try:
-            root_path = Path(config.root_dir)
-            if root_path.exists():
-                for item in root_path.iterdir():
-                    if item.is_dir():
-                        paths.append(item.name)
+            paths = dispatcher.index.paths(config.root_dir)
         except Exception as e:
             logger.error(f"Error listing paths: {e}")
 
         return render_template(
-            "admin.html", prefix=prefix, paths=paths, version=VERSION
+            "admin.html",
+            prefix=prefix,
+            paths=paths,
+            rows=dispatcher.index.rows(),
+            version=VERSION,
         )
 
     @app.route(f"{prefix}/scrape_configs/<path:rest_path>")
     def get_scrape_configs(rest_path):
-        generated = run_python(
-            str(Path(config.root_dir) / (rest_path + ".py")), **request.args
+        try:
+            arg_list = params_index.filter(
+                rest_path, dict(request.args), scrape_configs=True
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        full_path = scrape_configs_key(rest_path, arg_list)
+        try:
+            generated = dispatcher.get_scrape_configs(
+                rest_path, full_path, **arg_list
+            )
+        except CacheNotExist:
+            logger.error("Cache miss, full_path=%s", full_path)
+            return jsonify({"error": "cache miss"}), 500
+        except CacheExpired:
+            logger.error("Cache expired, full_path=%s", full_path)
+            return jsonify({"error": "cache expired"}), 500
+        return send_cached(generated)
+
+    @app.route(f"{prefix}/targets/_bulk", methods=["POST"])
+    def get_targets_bulk():
+        try:
+            requests = parse_bulk_request(request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        keys = [
+            (cache_key(rest_path, args), rest_path, args)
+            for rest_path, args in requests
+        ]
+        results = [
+            (
+                result
+                if isinstance(result, CacheError)
+                # the bulk body is built from cache entries, as in serve
+                else CacheEntry(result, io.BytesIO(result["payload"]))
+            )
+            for result in dispatcher.get_targets_data_many(keys)
+        ]
+        return app.response_class(
+            bulk_body(keys, results), mimetype="application/json"
         )
-        return generated
 
     @app.route(f"{prefix}/targets", defaults={"rest_path": ""})
     @app.route(f"{prefix}/targets/", defaults={"rest_path": ""})
@@ -218,14 +510,12 @@ def create_server_app(prefix, cache_seconds):
             arg_list = dict(request.args)
             if "reload" in arg_list:
                 del arg_list["reload"]
+            try:
+                arg_list = params_index.filter(rest_path, arg_list)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
 
-            if arg_list:
-                query_string = urlencode(arg_list, doseq=True)
-                full_path_without_reload = (
-                    f"/targets/{rest_path}?{query_string}"
-                )
-            else:
-                full_path_without_reload = f"/targets/{rest_path}?"
+            full_path_without_reload = cache_key(rest_path, arg_list)
 
             logger.info(
                 f"Hard reload requested for {full_path_without_reload}"
@@ -240,14 +530,12 @@ def create_server_app(prefix, cache_seconds):
             arg_list = dict(request.args)
             if "debug" in arg_list:
                 del arg_list["debug"]
+            try:
+                arg_list = params_index.filter(rest_path, arg_list)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
 
-            if arg_list:
-                query_string = urlencode(arg_list, doseq=True)
-                full_path_without_debug = (
-                    f"/targets/{rest_path}?{query_string}"
-                )
-            else:
-                full_path_without_debug = f"/targets/{rest_path}?"
+            full_path_without_debug = cache_key(rest_path, arg_list)
 
             debug_info = dispatcher.get_debug_info(full_path_without_debug)
 
@@ -298,33 +586,62 @@ def create_server_app(prefix, cache_seconds):
             )
         )
 
-        l1_dir = l2_dir = ""
-        path_splits = rest_path.split("/")
-        if len(path_splits) > 0:
-            l1_dir = path_splits[0]
-        if len(path_splits) > 1:
-            l2_dir = path_splits[1]
-
+        arg_list = dict(request.args)
+        etag = since = None
+        try:
+            arg_list, etag, timeout = parse_watch_args(arg_list)
+            arg_list, since = parse_since(arg_list)
+            arg_list = params_index.filter(rest_path, arg_list)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        # the same key as bulk requests, whatever the order of the
+        # parameters and the url prefix
+        full_path = cache_key(rest_path, arg_list)
+        refresh_interval = parse_refresh_interval(
+            request.headers.get(REFRESH_INTERVAL_HEADER)
+        )
+        if refresh_interval is not None:
+            dispatcher.index.record_refresh_interval(
+                full_path, rest_path, refresh_interval
+            )
+        if etag is not None:
+            if watchers.acquire(blocking=False):
+                try:
+                    changed = dispatcher.watch_targets(
+                        full_path, etag, timeout
+                    )
+                finally:
+                    watchers.release()
+            else:
+                # every watch slot holds a server thread, do not wait
+                watch_requests_limited.inc()
+                changed = dispatcher.watch_targets(full_path, etag, 0)
+            if not changed:
+                response = app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+
+        l1_dir, l2_dir = split_dirs(rest_path)
+        path_label = path_labeler.label(rest_path)
         with target_path_request_duration_seconds.labels(
-            path=rest_path
+            path=path_label
         ).time():
             try:
-                full_path = request.full_path
-                targets = dispatcher.get_targets(
-                    rest_path, full_path, **request.args
+                data = dispatcher.get_targets_data(
+                    rest_path, full_path, **arg_list
                 )
             except CacheNotExist:
                 target_path_requests_total.labels(
-                    path=rest_path,
+                    path=path_label,
                     status="cache-not-exist",
                     l1_dir=l1_dir,
                     l2_dir=l2_dir,
                 ).inc()
-                logger.error("Cache miss, full_path=%s", request.full_path)
+                logger.error("Cache miss, full_path=%s", full_path)
                 return jsonify({"error": "cache miss"})
             except CacheExpired as e:
                 target_path_requests_total.labels(
-                    path=rest_path,
+                    path=path_label,
                     status="cache-expired",
                     l1_dir=l1_dir,
                     l2_dir=l2_dir,
@@ -332,14 +649,14 @@ def create_server_app(prefix, cache_seconds):
                 logger.error(
                     "Cache expired, full_path=%s, updated_timestamp=%s, "
                     "cache_excepire_seconds=%s",
-                    request.full_path,
+                    full_path,
                     e.updated_timestamp,
                     e.cache_excepire_seconds,
                 )
                 return jsonify({"error": "cache expired"})
             except Exception as e:
                 target_path_requests_total.labels(
-                    path=rest_path,
+                    path=path_label,
                     status="fail",
                     l1_dir=l1_dir,
                     l2_dir=l2_dir,
@@ -351,17 +668,33 @@ def create_server_app(prefix, cache_seconds):
                 return jsonify({"error": str(e)}), 500
 
         target_path_requests_total.labels(
-            path=rest_path,
+            path=path_label,
             status="success",
             l1_dir=l1_dir,
             l2_dir=l2_dir,
         ).inc()
-        path_last_generated_targets.labels(path=rest_path).set(len(targets))
-        return jsonify(targets)
+        path_last_generated_targets.labels(path=path_label).set(
+            data.get("target_count", 0)
+        )
+        if since is not None:
+            # only the groups changed after that version
+            history = dispatcher.cache.get(f"history:{full_path}")
+            delta = delta_since(history, since)
+            if delta is None:
+                delta = full_snapshot(
+                    data.get("version"), json.loads(data["payload"])
+                )
+            return jsonify(delta)
+        return send_cached(data)
+
+    if shed_latency:
+        app.wsgi_app = LoadShedding(
+            app.wsgi_app, prefix, AIMDLimiter(shed_latency, max_concurrency)
+        )
 
     # Add Prometheus metrics endpoint
     app.wsgi_app = DispatcherMiddleware(
-        app.wsgi_app, {"/metrics": make_wsgi_app()}
+        app.wsgi_app, {"/metrics": make_metrics_wsgi_app()}
     )
 
     return app
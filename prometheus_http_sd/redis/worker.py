@@ -1,3 +1,4 @@
+import json
 import logging
 import signal
 import threading
@@ -5,15 +6,26 @@ import time
 import traceback
 from datetime import datetime
 from flask import Flask
-from prometheus_client import make_wsgi_app
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 
 from ..config import config
-from ..sd import generate
+from ..mounts import locate
+from ..dispather import (
+    SCRAPE_CONFIGS,
+    count_targets,
+    encode_scrape_configs,
+    encode_targets,
+)
+from ..sd import generate, generate_partial, generate_scrape_configs
+from ..delta import update_history
+from ..refresh_interval import key_expire_seconds
+from ..watch import compute_etag
 from .cache import RedisCache
 from .queue import RedisJobQueue
 from ..metrics import (
     generator_latency,
+    make_metrics_wsgi_app,
+    path_labeler,
     finished_jobs,
     worker_jobs_processed,
     worker_started_counter,
@@ -21,6 +33,12 @@ from ..metrics import (
 
 logger = logging.getLogger(__name__)
 
+# How long to keep the per generator results for partial result mode
+LAST_GOOD_EXPIRE_SECONDS = 7 * 24 * 3600
+
+# How often the worker pool queues again the jobs whose lease expired
+REAP_INTERVAL = 10
+
 
 class WorkerMetricsServer:
     """Flask-based server to expose worker metrics."""
@@ -37,7 +55,7 @@ class WorkerMetricsServer:
         app = Flask(__name__)
 
         # Add prometheus wsgi middleware to route /metrics requests
-        prometheus_wsgi_app = make_wsgi_app()
+        prometheus_wsgi_app = make_metrics_wsgi_app()
         app.wsgi_app = DispatcherMiddleware(
             app.wsgi_app,
             {
@@ -92,7 +110,9 @@ class Worker:
         self.worker_id = worker_id
         self.running = False
         self.cache = RedisCache(config.redis_url)
-        self.queue = RedisJobQueue(config.redis_url)
+        self.queue = RedisJobQueue(
+            config.redis_url, tenant_weights=config.tenant_weights
+        )
         self._stop_event = threading.Event()
 
     def start(self):
@@ -127,7 +147,7 @@ class Worker:
                 job_data = self.queue.dequeue_job(timeout=1)
 
                 if job_data:
-                    self._process_job(job_data)
+                    self._process_leased_job(job_data)
                 else:
                     continue
 
@@ -137,30 +157,106 @@ class Worker:
                 )
                 time.sleep(1)
 
-    def _process_job(self, job_data: dict):
+    def _process_leased_job(self, job_data: dict):
+        """Process the job, renew its lease meanwhile, and ack it."""
+        done = threading.Event()
+
+        def renew_lease():
+            while not done.wait(self.queue.visibility_timeout / 3):
+                if not self.queue.extend_lease(job_data):
+                    logger.warning(
+                        f"Worker {self.worker_id} lost the lease of job "
+                        f"{job_data.get('job_id')}"
+                    )
+                    return
+
+        if job_data.get("delivery", 1) > 1:
+            logger.warning(
+                f"Worker {self.worker_id} processing job "
+                f"{job_data.get('job_id')} again, delivery "
+                f"{job_data['delivery']}"
+            )
+        threading.Thread(target=renew_lease, daemon=True).start()
+        succeeded = False
+        try:
+            succeeded = self._process_job(job_data)
+        finally:
+            done.set()
+            self.queue.finish_job(job_data)
+        if not succeeded:
+            # the servers do not enqueue a key again until it changes, once
+            # its in-flight marker is cleared the next request retries it
+            self.cache.publish_change(job_data.get("full_path", ""))
+
+    def _process_job(self, job_data: dict) -> bool:
+        """Generate the job and cache the result, return if it is cached."""
         job_id = job_data.get("job_id", "unknown")
         full_path = job_data.get("full_path", "")
         path = job_data.get("path", "")
         extra_args = job_data.get("extra_args", {})
+        kind = job_data.get("kind")
 
         logger.info(
             f"Worker {self.worker_id} processing job {job_id} for path: {path}"
         )
+        full_path_label = path_labeler.full_path_label(full_path, path)
         start_time = time.time()
 
         try:
             # Track generator latency
             with generator_latency.labels(
-                full_path=full_path, status="success"
+                full_path=full_path_label, status="success"
             ).time():
-                targets = generate(config.root_dir, path, **extra_args)
+                if kind == SCRAPE_CONFIGS:
+                    targets = generate_scrape_configs(
+                        *locate(path), **extra_args
+                    )
+                elif config.partial_results:
+                    targets = self._generate_partial(
+                        full_path, path, extra_args
+                    )
+                else:
+                    targets = generate(*locate(path), **extra_args)
 
-            # Store result in cache
-            cache_data = {"updated_timestamp": time.time(), "results": targets}
+            # Store result in cache, encoded once here, the servers send
+            # the payload as it is
+            if kind == SCRAPE_CONFIGS:
+                payload, content_type = encode_scrape_configs(targets)
+            else:
+                payload, content_type = (
+                    encode_targets(targets),
+                    "application/json",
+                )
+            header = {
+                "updated_timestamp": time.time(),
+                "size": len(payload),
+                "target_count": count_targets(targets),
+                "duration": time.time() - start_time,
+                "etag": compute_etag(payload),
+                "content_type": content_type,
+            }
+            history, history_changed = None, False
+            if kind != SCRAPE_CONFIGS:
+                history, history_changed = self._update_history(
+                    full_path, targets, header["etag"]
+                )
+                if history is not None:
+                    header["version"] = history["version"]
 
-            if self.cache.set(
-                full_path, cache_data, config.cache_expire_seconds
+            expire_seconds = key_expire_seconds(
+                config.cache_expire_seconds, job_data.get("refresh_interval")
+            )
+            if self.cache.set_entry(
+                full_path, header, payload, expire_seconds
             ):
+                if history_changed:
+                    self.cache.set(
+                        f"history:{full_path}",
+                        history,
+                        LAST_GOOD_EXPIRE_SECONDS,
+                    )
+                # wake up the ?watch= requests on the servers
+                self.cache.publish_change(full_path)
                 duration = time.time() - start_time
                 logger.info(
                     f"Worker {self.worker_id} completed job {job_id} "
@@ -170,6 +266,7 @@ class Worker:
                 worker_jobs_processed.labels(
                     worker_id=self.worker_id, status="success"
                 ).inc()
+                return True
             else:
                 logger.error(
                     f"Worker {self.worker_id} failed to cache results "
@@ -181,7 +278,7 @@ class Worker:
 
         except Exception as e:
             with generator_latency.labels(
-                full_path=full_path, status="error"
+                full_path=full_path_label, status="error"
             ).time():
                 pass
 
@@ -221,6 +318,55 @@ class Worker:
             worker_jobs_processed.labels(
                 worker_id=self.worker_id, status="error"
             ).inc()
+        return False
+
+    def _update_history(self, full_path: str, targets, etag: str):
+        """The version history of ``full_path`` with ``targets`` as the
+        latest version, and if it is changed and should be saved."""
+        history = self.cache.get(f"history:{full_path}")
+
+        def previous_targets():
+            entry = self.cache.read_entry(full_path)
+            if entry is None:
+                return []
+            return json.loads(entry["payload"])
+
+        try:
+            updated = update_history(history, targets, etag, previous_targets)
+        except Exception as e:
+            # e.g. the targets are not a list of groups
+            logger.error(f"Failed to update history of {full_path}: {e}")
+            return history, False
+        if updated is None:
+            return history, False
+        return updated, True
+
+    def _generate_partial(self, full_path: str, path: str, extra_args: dict):
+        """Generate in partial result mode, a failed generator is replaced
+        by its last good result stored under ``generators:<full_path>``."""
+        generators_cache_key = f"generators:{full_path}"
+        last_good = self.cache.get(generators_cache_key) or {}
+
+        root, rel_path = locate(path)
+        targets, results, failures = generate_partial(
+            root, rel_path, extra_args, last_good.get("results")
+        )
+        if failures:
+            logger.warning(
+                f"Worker {self.worker_id} generated {full_path} with failed "
+                f"generators: {', '.join(failures)}"
+            )
+
+        self.cache.set(
+            generators_cache_key,
+            {
+                "updated_timestamp": time.time(),
+                "results": results,
+                "failures": failures,
+            },
+            LAST_GOOD_EXPIRE_SECONDS,
+        )
+        return targets
 
 
 class WorkerPool:
@@ -268,8 +414,21 @@ class WorkerPool:
             thread.start()
             self.threads.append(thread)
 
+        threading.Thread(target=self._requeue_expired, daemon=True).start()
+
         logger.info(f"Worker pool started with {len(self.workers)} workers")
 
+    def _requeue_expired(self):
+        """Queue again the jobs of the workers that died, every worker
+        pool does it, the script is atomic."""
+        queue = RedisJobQueue(config.redis_url)
+        while self.running:
+            try:
+                queue.requeue_expired()
+            except Exception as e:
+                logger.error(f"Failed to queue again the expired jobs: {e}")
+            time.sleep(REAP_INTERVAL)
+
     def _signal_handler(self, signum, frame):
         logger.info(f"Worker pool received signal {signum}, shutting down...")
         self.stop()
@@ -0,0 +1,67 @@
+"""Per key refresh intervals from the ``X-Prometheus-Refresh-Interval-Seconds``
+header, which Prometheus sends with every HTTP SD request. A key is
+refreshed as often as its most eager client polls it, and expires after a
+few of those intervals, instead of by the global settings."""
+
+import time
+from typing import Optional
+
+REFRESH_INTERVAL_HEADER = "X-Prometheus-Refresh-Interval-Seconds"
+
+# the intervals asked for are bounded to this range
+MIN_REFRESH_INTERVAL = 5
+MAX_REFRESH_INTERVAL = 3600
+
+# an interval is active while it was asked for in the last this many of
+# itself, e.g. a client polling every 5 minutes is forgotten after 15
+ACTIVE_INTERVALS = 3
+
+# a key with a refresh interval expires after this many of its intervals,
+# but not earlier than the global cache expire seconds
+EXPIRE_INTERVALS = 5
+
+
+def parse_refresh_interval(value: Optional[str]) -> Optional[int]:
+    """The refresh interval in whole seconds, None if the header is missing
+    or not a positive number."""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        return None
+    if not seconds > 0:
+        return None
+    return int(min(max(seconds, MIN_REFRESH_INTERVAL), MAX_REFRESH_INTERVAL))
+
+
+def key_expire_seconds(
+    cache_expire_seconds: float, refresh_interval: Optional[float]
+) -> float:
+    if refresh_interval is None:
+        return cache_expire_seconds
+    return max(cache_expire_seconds, EXPIRE_INTERVALS * refresh_interval)
+
+
+class RefreshIntervals:
+    """The refresh intervals the clients of one key asked for."""
+
+    def __init__(self) -> None:
+        # interval -> when it was last asked for
+        self.last_seen = {}
+
+    def record(self, seconds: int):
+        self.last_seen[seconds] = time.time()
+
+    def current(self) -> Optional[int]:
+        """The smallest active interval, None if there is none."""
+        if not self.last_seen:
+            return None
+        now = time.time()
+        active = []
+        for seconds, seen in list(self.last_seen.items()):
+            if now - seen <= ACTIVE_INTERVALS * seconds:
+                active.append(seconds)
+            else:
+                self.last_seen.pop(seconds, None)
+        return min(active) if active else None
@@ -0,0 +1,188 @@
+"""Reload ``serve`` on SIGHUP without a restart: the settings of the
+``--config`` file are applied again, and the modules imported by the
+generators are forgotten so that the next run imports them again. The task
+list and the cached results are kept, every task is refreshed with the new
+code and settings in background, and requests are answered from the cache
+meanwhile.
+
+The config file is yaml, all the keys are optional and override the command
+line options::
+
+    cache_seconds: 300
+    cache_refresh_interval: 60
+    tenant_weights:
+      team-a: 3
+    tenant_concurrency:
+      team-a: 8
+    partial_results: true
+    undeclared_params: drop
+    metrics_path_label: l2
+    # modules imported by the generators to import again, by name prefix,
+    # the modules under the root dir are always imported again
+    reload_modules:
+      - mycompany.inventory
+"""
+
+import importlib
+import logging
+import os
+import sys
+import threading
+from typing import List, Optional
+
+import yaml
+
+from .config import config
+from .fair_queue import parse_concurrency, parse_weights
+from .metrics import PathLabeler, path_labeler
+from .mounts import roots
+from .params import UNDECLARED_PARAMS_POLICIES, params_index
+
+logger = logging.getLogger(__name__)
+
+CONFIG_KEYS = (
+    "cache_seconds",
+    "cache_refresh_interval",
+    "tenant_weights",
+    "tenant_concurrency",
+    "partial_results",
+    "undeclared_params",
+    "metrics_path_label",
+    "reload_modules",
+)
+
+
+def load_config_file(path: str) -> dict:
+    """Read and check the config file, raise ValueError if it is not
+    valid, then nothing of it should be applied."""
+    try:
+        with open(path) as f:
+            settings = yaml.safe_load(f) or {}
+    except (OSError, yaml.YAMLError) as e:
+        raise ValueError(f"can not read {path}: {e}")
+    if not isinstance(settings, dict):
+        raise ValueError(f"{path} should be a mapping")
+
+    unknown = set(settings) - set(CONFIG_KEYS)
+    if unknown:
+        raise ValueError(f"unknown keys in {path}: {', '.join(unknown)}")
+    for key in ("cache_seconds", "cache_refresh_interval"):
+        if key in settings and not (
+            isinstance(settings[key], (int, float)) and settings[key] > 0
+        ):
+            raise ValueError(f"{key} should be a positive number")
+    weights = settings.get("tenant_weights")
+    if isinstance(weights, dict):
+        weights = [f"{tenant}={w}" for tenant, w in weights.items()]
+    if "tenant_weights" in settings:
+        settings["tenant_weights"] = parse_weights(weights)
+    limits = settings.get("tenant_concurrency")
+    if isinstance(limits, dict):
+        limits = [f"{tenant}={n}" for tenant, n in limits.items()]
+    if "tenant_concurrency" in settings:
+        settings["tenant_concurrency"] = parse_concurrency(limits)
+    if settings.get("undeclared_params", "drop") not in (
+        UNDECLARED_PARAMS_POLICIES
+    ):
+        raise ValueError(
+            "undeclared_params should be one of"
+            f" {', '.join(UNDECLARED_PARAMS_POLICIES)}"
+        )
+    if "metrics_path_label" in settings:
+        # raises ValueError if not valid
+        PathLabeler(settings["metrics_path_label"])
+    return settings
+
+
+def apply_settings(dispatcher, settings: dict):
+    if "cache_seconds" in settings:
+        dispatcher.cache_expire_seconds = settings["cache_seconds"]
+        config.cache_expire_seconds = settings["cache_seconds"]
+    if "cache_refresh_interval" in settings:
+        dispatcher.interval = settings["cache_refresh_interval"]
+    if "tenant_weights" in settings:
+        dispatcher.queue.weights = settings["tenant_weights"]
+        config.tenant_weights = settings["tenant_weights"]
+    if "tenant_concurrency" in settings:
+        dispatcher.queue.concurrency = settings["tenant_concurrency"]
+    if "partial_results" in settings:
+        dispatcher.partial_results = bool(settings["partial_results"])
+        config.partial_results = dispatcher.partial_results
+    if "undeclared_params" in settings:
+        config.undeclared_params = settings["undeclared_params"]
+    if "metrics_path_label" in settings:
+        path_labeler.configure(settings["metrics_path_label"])
+
+
+def invalidate_module_caches(
+    root_dir: str, module_prefixes: Optional[List[str]] = None
+) -> List[str]:
+    """Forget the modules under ``root_dir`` and the ones named by
+    ``module_prefixes``, return their names."""
+    importlib.invalidate_caches()
+    root = os.path.realpath(root_dir) + os.sep
+    prefixes = tuple(module_prefixes or ())
+    dropped = []
+    for name, module in list(sys.modules.items()):
+        module_file = getattr(module, "__file__", None) or ""
+        if (
+            module_file and os.path.realpath(module_file).startswith(root)
+        ) or any(
+            name == prefix or name.startswith(prefix + ".")
+            for prefix in prefixes
+        ):
+            sys.modules.pop(name, None)
+            dropped.append(name)
+    return dropped
+
+
+class Reloader:
+    def __init__(self, dispatcher, config_file: Optional[str] = None):
+        self.dispatcher = dispatcher
+        self.config_file = config_file
+        self.settings = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Apply the config file, at start, a broken file fails the start
+        instead of being ignored like on reload."""
+        if self.config_file:
+            self.settings = load_config_file(self.config_file)
+            apply_settings(self.dispatcher, self.settings)
+
+    def reload(self):
+        with self.lock:
+            logger.info("Reloading...")
+            if self.config_file:
+                try:
+                    self.settings = load_config_file(self.config_file)
+                except ValueError as e:
+                    logger.error("Keep the current config: %s", e)
+                else:
+                    apply_settings(self.dispatcher, self.settings)
+
+            dropped = []
+            for root in roots():
+                dropped += invalidate_module_caches(
+                    root, self.settings.get("reload_modules")
+                )
+            params_index.clear()
+            self.dispatcher.index.rescan()
+
+            # regenerate everything with the new code, the current results
+            # are served until then
+            with self.dispatcher.tasks_lock:
+                tasks = list(self.dispatcher.tasks.values())
+            for task in tasks:
+                task.need_update = True
+                task.last_queued = 0.0
+            self.dispatcher.wakeup.set()
+            logger.info(
+                "Reloaded, %d modules dropped, %d tasks to refresh",
+                len(dropped),
+                len(tasks),
+            )
+
+    def handle_signal(self, signum, frame):
+        # do not block the thread the signal interrupted
+        threading.Thread(target=self.reload, daemon=True).start()
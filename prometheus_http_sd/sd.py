@@ -1,13 +1,18 @@
 from concurrent.futures import ThreadPoolExecutor, as_completed
+import cProfile
 import importlib
 import importlib.machinery
 import importlib.util
+import io
 import json
 import logging
 import os
 from pathlib import Path
+import pstats
+import threading
 import time
-from typing import Dict, List
+import tracemalloc
+from typing import Dict, List, Optional, Tuple
 
 from prometheus_client import Counter, Gauge, Histogram
 import yaml
@@ -34,6 +39,7 @@ generator_last_generated_targets = Gauge(
     "httpsd_generator_last_generated_targets",
     "The target count that this generator gets during its last execution",
     ["generator"],
+    multiprocess_mode="max",
 )
 
 generator_run_duration_seconds = Histogram(
@@ -43,8 +49,19 @@ generator_run_duration_seconds = Histogram(
     buckets=[0.5, 1, 2.5, 5, 7.5, 10, 30, 60, 120, 240],
 )
 
+generator_fallback_total = Counter(
+    "httpsd_generator_fallback_total",
+    "The total count that a failed generator was replaced by its last good"
+    " result (last-good) or left out (omitted) in partial result mode",
+    ["generator", "action"],
+)
+
 generator_executor = ThreadPoolExecutor(max_workers=400)
 
+# tracemalloc traces the whole process, one generator is profiled at a time
+# so that two profiles do not clear the traces of each other
+profile_lock = threading.Lock()
+
 
 def should_ignore(full_path, ignore_dirs):
     if ignore_dirs:
@@ -120,6 +137,74 @@ def generate(root: str, path: str = "", **extra_args) -> TargetList:
     return all_targets
 
 
+def generate_partial(
+    root: str,
+    path: str = "",
+    extra_args: Optional[dict] = None,
+    last_good: Optional[Dict[str, TargetList]] = None,
+) -> Tuple[TargetList, Dict[str, TargetList], Dict[str, str]]:
+    """
+    Like ``generate``, but a failed generator does not fail the whole path,
+    its result from ``last_good`` is used instead, or it is left out if it
+    has never succeeded. If all of the generators failed without a last good
+    result, the error is raised as ``generate`` does.
+
+    Returns the targets, the result of every generator (to be used as the
+    ``last_good`` of the next run) and the error of every failed generator.
+    """
+    extra_args = extra_args or {}
+    last_good = last_good or {}
+    generators = get_generator_list(root, path)
+
+    futures = {}
+    for generator in generators:
+        future = generator_executor.submit(
+            run_generator, generator, **extra_args
+        )
+        futures[future] = generator
+
+    results = {}
+    failures = {}
+    first_error = None
+    for future in as_completed(futures):
+        generator = futures[future]
+        try:
+            results[generator] = future.result()
+        except Exception as e:
+            logger.exception("Generator %s failed", generator)
+            failures[generator] = f"{type(e).__name__}: {e}"
+            first_error = first_error or e
+            if generator in last_good:
+                results[generator] = last_good[generator]
+                action = "last-good"
+            else:
+                action = "omitted"
+            generator_fallback_total.labels(
+                generator=generator, action=action
+            ).inc()
+
+    if first_error is not None and not results:
+        raise first_error
+
+    all_targets = []
+    for generator in generators:
+        if generator not in results:
+            continue
+        target_list = results[generator]
+        if isinstance(target_list, list):
+            all_targets.extend(target_list)
+        else:
+            all_targets.append(target_list)
+
+    return all_targets, results, failures
+
+
+def generate_scrape_configs(root: str, path: str, **extra_args):
+    """Run the scrape config generator ``<root>/<path>.py``, only python
+    generators are supported."""
+    return run_generator(str(Path(root) / (path + ".py")), **extra_args)
+
+
 def _timed_wrapper(*args, **kwargs):
     start = time.time()
     run_generator(*args, **kwargs)
@@ -142,6 +227,82 @@ def generate_perf(root: str, path: str = "", **extra_args) -> Dict[str, float]:
     return {"generator_run_seconds": result}
 
 
+def profile_generator(
+    generator_path: str, extra_args: dict, profile_top: int = 0
+) -> dict:
+    """Run one generator and measure it: wall and CPU time, the time to
+    import a python generator, the peak of memory allocated by python while
+    it runs and the size of its json output. With ``profile_top``, the
+    top functions by cumulative time from cProfile are included too.
+
+    The peak of memory is of the whole process, the requests served
+    meanwhile are counted too, and every allocation is slower while it is
+    traced. Generators are profiled one at a time."""
+    with profile_lock:
+        return _profile_generator(generator_path, extra_args, profile_top)
+
+
+def _profile_generator(
+    generator_path: str, extra_args: dict, profile_top: int
+) -> dict:
+    stats = {}
+    profiler = cProfile.Profile() if profile_top else None
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    else:
+        tracemalloc.clear_traces()
+
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        if profiler:
+            profiler.enable()
+        if generator_path.endswith(".py"):
+            func = load_python(generator_path)
+            stats["import_seconds"] = time.perf_counter() - wall_start
+            result = func(**extra_args)
+        else:
+            stats["import_seconds"] = 0.0
+            result = run_generator(generator_path, **extra_args)
+    except Exception as e:
+        result = None
+        stats["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if profiler:
+            profiler.disable()
+        stats["cpu_seconds"] = time.thread_time() - cpu_start
+        stats["wall_seconds"] = time.perf_counter() - wall_start
+        stats["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+
+    if result is not None:
+        stats["output_bytes"] = len(json.dumps(result, default=str))
+    if profiler:
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats(
+            "cumulative"
+        ).print_stats(profile_top)
+        stats["profile"] = output.getvalue()
+    return stats
+
+
+def profile_generators(
+    root: str,
+    path: str = "",
+    extra_args: Optional[dict] = None,
+    profile_top: int = 0,
+) -> Dict[str, dict]:
+    """Like ``generate_perf``, but the generators are run one by one so that
+    their CPU time, memory and profile are not mixed up with each other."""
+    extra_args = extra_args or {}
+    return {
+        generator: profile_generator(generator, extra_args, profile_top)
+        for generator in get_generator_list(root, path)
+    }
+
+
 def run_generator(generator_path: str, **extra_args) -> TargetList:
     if generator_path.endswith(".json"):
         executor = run_json
@@ -191,7 +352,8 @@ def run_json(file_path: str) -> TargetList:
         return json.load(jsonf)
 
 
-def run_python(generator_path, **extra_args) -> TargetList:
+def load_python(generator_path):
+    """Import the generator module, return its ``generate_targets``."""
     logger.debug(f"start to import module {generator_path}...")
 
     loader = importlib.machinery.SourceFileLoader("mymodule", generator_path)
@@ -210,7 +372,11 @@ def run_python(generator_path, **extra_args) -> TargetList:
             pass
         else:
             func = test_func
-    return func(**extra_args)
+    return func
+
+
+def run_python(generator_path, **extra_args) -> TargetList:
+    return load_python(generator_path)(**extra_args)
 
 
 def run_yaml(file_path: str):
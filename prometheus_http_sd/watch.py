@@ -0,0 +1,83 @@
+"""Long polling for ``/targets``: ``?watch=<etag>&timeout=<seconds>`` holds
+the request until the targets of the path have an etag different from the
+given one, or the timeout expires."""
+
+import hashlib
+import threading
+from typing import Callable, Optional, Tuple
+
+# the longest a watch request can be held
+MAX_WATCH_SECONDS = 300
+DEFAULT_WATCH_SECONDS = 60
+
+# a watcher checks the cache again at least this often, in case the change
+# is not notified in this process, e.g. another replica wrote the cache
+WATCH_POLL_SECONDS = 5
+
+# under a WSGI server a watch holds a server thread while it waits, at most
+# this share of the threads wait for watches, the others serve the rest
+WATCH_THREADS_RATIO = 0.25
+
+
+def compute_etag(payload: bytes) -> str:
+    return hashlib.md5(payload).hexdigest()
+
+
+def max_watchers(threads: int) -> int:
+    return max(1, int(threads * WATCH_THREADS_RATIO))
+
+
+def parse_watch_args(args: dict) -> Tuple[dict, Optional[str], float]:
+    """Split the ``watch`` and ``timeout`` parameters from the parameters
+    for the generators. Raise ValueError if timeout is not a number."""
+    args = dict(args)
+    etag = args.pop("watch", None)
+    timeout = args.pop("timeout", None) if etag is not None else None
+    if etag is None:
+        return args, None, 0
+    timeout = float(timeout) if timeout else DEFAULT_WATCH_SECONDS
+    if timeout < 0:
+        raise ValueError("timeout should not be negative")
+    # the ETag header is quoted, the value can be copied as it is
+    return args, etag.strip('"'), min(timeout, MAX_WATCH_SECONDS)
+
+
+class ChangeNotifier:
+    """Wake up the watchers of a key when it changes.
+
+    A watcher takes ``event(key)`` before checking the current version of
+    the key, then waits on it, so that a change between the check and the
+    wait is not missed. A watcher that does not wait in a thread, e.g. on an
+    event loop, adds a callback instead, which is called on every change
+    until it is removed.
+    """
+
+    def __init__(self) -> None:
+        self._events = {}
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+    def event(self, key: str) -> threading.Event:
+        with self._lock:
+            return self._events.setdefault(key, threading.Event())
+
+    def add_callback(self, key: str, callback: Callable[[], None]):
+        with self._lock:
+            self._callbacks.setdefault(key, set()).add(callback)
+
+    def remove_callback(self, key: str, callback: Callable[[], None]):
+        with self._lock:
+            callbacks = self._callbacks.get(key)
+            if callbacks is not None:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self._callbacks[key]
+
+    def notify(self, key: str):
+        with self._lock:
+            event = self._events.pop(key, None)
+            callbacks = list(self._callbacks.get(key, ()))
+        if event is not None:
+            event.set()
+        for callback in callbacks:
+            callback()
@@ -1,11 +1,11 @@
 import pytest
 from prometheus_http_sd.app import create_app
-from pathlib import Path
+from prometheus_http_sd.dispather import Dispatcher
 
 
 @pytest.fixture()
-def app():
-    cache_dir = str(Path(__file__).parent)
+def app(tmp_path):
+    cache_dir = str(tmp_path)
     app = create_app("/", cache_dir, 300, 1, 1024)
     app.config.update(
         {
@@ -19,3 +19,38 @@ def app():
 @pytest.fixture()
 def client(app):
     return app.test_client()
+
+
+@pytest.fixture()
+def dispatcher(tmp_path):
+    return Dispatcher(
+        interval=1,
+        max_workers=1,
+        cache_location=tmp_path,
+        cache_expire_seconds=300,
+    )
+
+
+@pytest.fixture()
+def redis_server(monkeypatch):
+    """Every Redis client of the process talks to a new in-memory server."""
+    fakeredis = pytest.importorskip("fakeredis")
+    from prometheus_http_sd.redis import pool
+
+    server = fakeredis.FakeServer()
+
+    def from_url(url, **kwargs):
+        # not supported by the fake connection
+        kwargs.pop("socket_keepalive", None)
+        kwargs.pop("health_check_interval", None)
+        return pool.InstrumentedConnectionPool(
+            connection_class=fakeredis.FakeRedisConnection,
+            server=server,
+            **kwargs,
+        )
+
+    monkeypatch.setattr(
+        pool.InstrumentedConnectionPool, "from_url", staticmethod(from_url)
+    )
+    monkeypatch.setattr(pool, "_pools", {})
+    return server
@@ -0,0 +1,87 @@
+import asyncio
+import json
+from pathlib import Path
+
+import pytest
+
+from prometheus_http_sd.asgi import create_asgi_app
+from prometheus_http_sd.config import config
+from prometheus_http_sd.handler import cache_key, scrape_configs_key
+
+
+@pytest.fixture(autouse=True)
+def app_root(monkeypatch):
+    monkeypatch.setattr(
+        config, "root_dir", str(Path(__file__).parent.parent / "app_root")
+    )
+
+
+def request(app, path, query_string=b""):
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "query_string": query_string,
+        "headers": [],
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    status = messages[0]["status"]
+    headers = dict(messages[0]["headers"])
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return status, headers, body
+
+
+def test_targets(dispatcher):
+    app = create_asgi_app("", dispatcher)
+
+    status, _, body = request(app, "/targets/echo_target", b"domain=foo")
+    assert status == 500
+    assert json.loads(body) == {"error": "cache miss"}
+    assert "/targets/echo_target?domain=foo" in dispatcher.tasks
+
+    targets = [{"targets": ["127.0.0.1:8080"], "labels": {"domain": "foo"}}]
+    dispatcher.write_cache("/targets/echo_target?domain=foo", targets)
+    status, headers, body = request(app, "/targets/echo_target", b"domain=foo")
+    assert status == 200
+    assert headers[b"content-type"] == b"application/json"
+    assert int(headers[b"content-length"]) == len(body)
+    assert json.loads(body) == targets
+
+
+def test_targets_without_a_root(dispatcher, monkeypatch):
+    monkeypatch.setattr(config, "root_dir", "")
+    monkeypatch.setattr(config, "mounts", {"a": "/srv/a"})
+    app = create_asgi_app("", dispatcher)
+
+    status, _, body = request(app, "/targets/", b"watch=abc")
+    assert status == 404
+    assert "error" in json.loads(body)
+
+
+def test_prefix_and_other_routes(dispatcher):
+    app = create_asgi_app("/sd", dispatcher)
+    dispatcher.write_cache(cache_key("", {}), [])
+
+    assert request(app, "/sd/targets")[2] == b"[]"
+    status, _, body = request(app, "/sd/")
+    assert status == 200
+    assert b"echo_target" in body
+    status, _, body = request(app, "/sd/metrics")
+    assert status == 200
+    assert b"httpsd_path_requests_total" in body
+    assert request(app, "/targets")[0] == 404
+
+
+def test_repeated_parameter_keeps_the_first_value(dispatcher):
+    app = create_asgi_app("", dispatcher)
+    request(app, "/scrape_configs/node", b"job=a&job=b")
+    # the same key as the WSGI app
+    assert scrape_configs_key("node", {"job": "a"}) in dispatcher.tasks
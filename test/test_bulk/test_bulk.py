@@ -0,0 +1,83 @@
+import asyncio
+import json
+
+import pytest
+
+from prometheus_http_sd.asgi import create_asgi_app
+from prometheus_http_sd.handler import (
+    bulk_targets,
+    cache_key,
+    parse_bulk_request,
+)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        None,
+        [],
+        {"requests": "foo"},
+        {"requests": [{"args": {}}]},
+        {"requests": [{"path": "foo", "args": {"a": 1}}]},
+        {"requests": [{"path": "foo"}] * 1001},
+    ],
+)
+def test_parse_bulk_request_invalid(body):
+    with pytest.raises(ValueError):
+        parse_bulk_request(body)
+
+
+def test_parse_bulk_request():
+    assert parse_bulk_request(
+        {"requests": [{"path": "/foo/"}, {"path": "bar", "args": {"a": "1"}}]}
+    ) == [("foo", {}), ("bar", {"a": "1"})]
+
+
+def test_bulk_targets(dispatcher):
+    targets = [{"targets": ["127.0.0.1:8080"], "labels": {"foo": "bar"}}]
+    dispatcher.write_cache(cache_key("foo", {"a": "1", "b": "2"}), targets)
+
+    body = bulk_targets(
+        dispatcher, [("foo", {"b": "2", "a": "1"}), ("missing", {})]
+    )
+    hit, miss = json.loads(body)["results"]
+    assert hit["status"] == 200
+    assert hit["path"] == "foo"
+    assert hit["targets"] == targets
+    assert hit["version"] == 1
+    assert miss == {
+        "path": "missing",
+        "args": {},
+        "status": 500,
+        "error": "cache miss",
+    }
+    # both paths are refreshed from now on
+    assert set(dispatcher.tasks) == {
+        cache_key("foo", {"a": "1", "b": "2"}),
+        cache_key("missing", {}),
+    }
+
+
+def test_bulk_asgi(dispatcher):
+    app = create_asgi_app("/sd", dispatcher)
+    dispatcher.write_cache(cache_key("foo", {}), [])
+    messages = []
+    body = json.dumps({"requests": [{"path": "foo"}]}).encode()
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/sd/targets/_bulk",
+        "query_string": b"",
+        "headers": [],
+    }
+    asyncio.run(app(scope, receive, send))
+    assert messages[0]["status"] == 200
+    results = json.loads(messages[1]["body"])["results"]
+    assert results[0]["targets"] == []
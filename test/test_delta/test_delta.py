@@ -0,0 +1,94 @@
+from prometheus_http_sd import delta
+from prometheus_http_sd.delta import delta_since, update_history
+from prometheus_http_sd.handler import cache_key, serve_targets
+
+
+def groups(*hosts):
+    return [{"targets": [f"{host}:9100"]} for host in hosts]
+
+
+def history_of(*versions):
+    history = None
+    for i, targets in enumerate(versions):
+        previous = versions[i - 1] if i else []
+        updated = update_history(
+            history, targets, str(targets), lambda: previous
+        )
+        history = updated or history
+    return history
+
+
+def test_update_history():
+    history = history_of(groups("a", "b"), groups("b", "c"))
+    assert history["version"] == 2
+    (diff,) = history["diffs"]
+    assert diff.pop("bytes") > 0
+    assert diff == {"version": 2, "added": groups("c"), "removed": groups("a")}
+
+    # same targets, or only a different order, keep the version
+    assert (
+        update_history(history, groups("b", "c"), history["etag"], list)
+        is None
+    )
+    assert update_history(history, groups("c", "b"), "x", list)["version"] == 2
+
+
+def test_delta_since():
+    history = history_of(
+        groups("a", "b"), groups("b", "c"), groups("a", "b", "c", "d")
+    )
+    assert delta_since(history, 1) == {
+        "version": 3,
+        "full": False,
+        "added": groups("c", "d"),
+        "removed": [],
+    }
+    assert delta_since(history, 2)["added"] == groups("a", "d")
+    assert delta_since(history, 3)["added"] == []
+    # the future and before the first version
+    assert delta_since(history, 4) is None
+    assert delta_since(history, 0) is None
+    assert delta_since(None, 1) is None
+
+
+def test_history_is_trimmed(monkeypatch):
+    monkeypatch.setattr(delta, "MAX_HISTORY", 2)
+    history = history_of(*(groups(str(i)) for i in range(5)))
+    assert [d["version"] for d in history["diffs"]] == [4, 5]
+    assert delta_since(history, 2) is None
+    assert delta_since(history, 3)["added"] == groups("4")
+
+
+def test_history_is_trimmed_by_bytes(monkeypatch):
+    history = history_of(*(groups(str(i)) for i in range(5)))
+    monkeypatch.setattr(delta, "MAX_HISTORY_BYTES", 2 * 100)
+    history = update_history(history, groups("x" * 100), "x", list)
+    # only the latest diff fits
+    assert [d["version"] for d in history["diffs"]] == [6]
+    assert delta_since(history, 5)["added"] == groups("x" * 100)
+    assert delta_since(history, 4) is None
+
+
+def test_serve_since(dispatcher):
+    key = cache_key("foo", {})
+    dispatcher.write_cache(key, groups("a", "b"))
+    dispatcher.write_cache(key, groups("a", "b"))
+    dispatcher.write_cache(key, groups("b", "c"))
+    assert dispatcher.open_cache(key).version == 2
+
+    result = serve_targets(dispatcher, "foo", {"since": "1"})
+    assert result.body == {
+        "version": 2,
+        "full": False,
+        "added": groups("c"),
+        "removed": groups("a"),
+    }
+
+    result = serve_targets(dispatcher, "foo", {"since": "0"})
+    assert result.body == {
+        "version": 2,
+        "full": True,
+        "targets": groups("b", "c"),
+    }
+
+    assert serve_targets(dispatcher, "foo", {"since": "x"}).status == 400
@@ -0,0 +1,189 @@
+import time
+
+import pytest
+
+from prometheus_http_sd.cache_store import SQLiteCacheStore
+from prometheus_http_sd.dispather import (
+    CacheExpired,
+    CacheNotExist,
+    CacheNotValidJson,
+    Dispatcher,
+)
+
+
+def test_cache_passthrough(dispatcher):
+    targets = [{"targets": ["127.0.0.1:8080"], "labels": {"foo": "bar"}}]
+    dispatcher.write_cache("/targets/foo?", targets)
+
+    entry = dispatcher.get_targets_entry("foo", "/targets/foo?")
+    assert entry.target_count == 1
+    payload = entry.read()
+    assert len(payload) == entry.size
+    assert payload == (
+        b'[{"targets":["127.0.0.1:8080"],"labels":{"foo":"bar"}}]'
+    )
+
+    assert dispatcher.get_targets("foo", "/targets/foo?") == targets
+
+
+def test_cache_not_exist(dispatcher):
+    with pytest.raises(CacheNotExist):
+        dispatcher.get_targets("foo", "/targets/foo?")
+
+
+def test_cache_expired(dispatcher):
+    dispatcher.write_cache("/targets/foo?", [])
+    dispatcher.cache_expire_seconds = 0
+    time.sleep(0.01)
+    with pytest.raises(CacheExpired):
+        dispatcher.get_targets("foo", "/targets/foo?")
+
+
+def test_cache_not_valid(dispatcher):
+    cache_file = dispatcher.cache_store.location("/targets/foo?")
+    cache_file.write_text('{"updated_timestamp": 1, "results": []}')
+    with pytest.raises(CacheNotValidJson):
+        dispatcher.get_targets("foo", "/targets/foo?")
+    assert not cache_file.exists()
+
+
+def test_sqlite_cache_store(tmp_path):
+    store = SQLiteCacheStore(tmp_path / "cache.sqlite3")
+    dispatcher = Dispatcher(
+        interval=1,
+        max_workers=1,
+        cache_location=tmp_path,
+        cache_expire_seconds=300,
+        cache_store=store,
+    )
+    with pytest.raises(CacheNotExist):
+        dispatcher.get_targets("foo", "/targets/foo?")
+
+    dispatcher.write_cache("/targets/foo?", [{"targets": ["a:1"]}])
+    dispatcher.write_cache("/targets/bar?", [])
+    dispatcher.write_cache("/targets/foo?", [{"targets": ["b:1"]}])
+
+    # another store instance, like another process, sees the same data
+    other = SQLiteCacheStore(tmp_path / "cache.sqlite3")
+    entry = other.open("/targets/foo?")
+    assert entry.target_count == 1
+    assert entry.read() == b'[{"targets":["b:1"]}]'
+    assert other.open("/targets/bar?").read() == b"[]"
+
+
+def test_partial_results(tmp_path):
+    from prometheus_http_sd.config import config
+    from prometheus_http_sd.dispather import Task
+
+    root = tmp_path / "root"
+    root.mkdir()
+    (root / "good.json").write_text('[{"targets": ["a:1"]}]')
+    (root / "flaky.py").write_text(
+        "def generate_targets(**kwargs):\n    return [{'targets': ['b:1']}]\n"
+    )
+    config.root_dir = str(root)
+
+    dispatcher = Dispatcher(
+        interval=1,
+        max_workers=1,
+        cache_location=tmp_path,
+        cache_expire_seconds=300,
+        partial_results=True,
+    )
+    task = Task("/targets/?", "", {})
+    dispatcher.update(task)
+    assert len(dispatcher.get_targets("", task.full_path)) == 2
+    assert dispatcher.get_generator_failures(task.full_path) == {}
+
+    (root / "flaky.py").write_text(
+        "def generate_targets(**kwargs):\n    raise ValueError('down')\n"
+    )
+    dispatcher.update(task)
+    assert len(dispatcher.get_targets("", task.full_path)) == 2
+    assert dispatcher.get_generator_failures(task.full_path) == {
+        str(root / "flaky.py"): "ValueError: down"
+    }
+
+
+def test_partial_results_many_failures(tmp_path, monkeypatch):
+    from prometheus_http_sd.config import config
+    from prometheus_http_sd.dispather import Task
+
+    root = tmp_path / "root"
+    root.mkdir()
+    generators = [root / f"gen{i}.py" for i in range(40)]
+    for generator in generators:
+        generator.write_text(
+            "def generate_targets(**kwargs):\n"
+            "    return [{'targets': ['a:1']}]\n"
+        )
+    monkeypatch.setattr(config, "root_dir", str(root))
+
+    dispatcher = Dispatcher(
+        interval=1,
+        max_workers=1,
+        cache_location=tmp_path,
+        cache_expire_seconds=300,
+        partial_results=True,
+    )
+    task = Task("/targets/?", "", {})
+    dispatcher.update(task)
+    assert len(dispatcher.get_targets("", task.full_path)) == 40
+
+    for generator in generators:
+        generator.write_text(
+            "def generate_targets(**kwargs):\n"
+            f"    raise ValueError('{'x' * 140}')\n"
+        )
+    # the errors do not fit in a cache header, the last good results must
+    # still be there for the runs after
+    for _ in range(3):
+        dispatcher.update(task)
+        assert len(dispatcher.get_targets("", task.full_path)) == 40
+        failures = dispatcher.get_generator_failures(task.full_path)
+        assert len(failures) == 40
+
+
+@pytest.mark.parametrize(
+    "source, content_type, payload",
+    [
+        (
+            "return {'job_name': kwargs['job']}",
+            "application/json",
+            b'{"job_name":"node"}',
+        ),
+        (
+            "return 'job_name: ' + kwargs['job']",
+            "text/html; charset=utf-8",
+            b"job_name: node",
+        ),
+    ],
+)
+def test_scrape_configs(tmp_path, source, content_type, payload):
+    from prometheus_http_sd.config import config
+    from prometheus_http_sd.dispather import SCRAPE_CONFIGS
+
+    root = tmp_path / "root"
+    root.mkdir()
+    (root / "node.py").write_text(
+        f"def generate_targets(**kwargs):\n    {source}\n"
+    )
+    config.root_dir = str(root)
+
+    dispatcher = Dispatcher(
+        interval=1,
+        max_workers=1,
+        cache_location=tmp_path,
+        cache_expire_seconds=300,
+    )
+    full_path = "/scrape_configs/node?job=node"
+    with pytest.raises(CacheNotExist):
+        dispatcher.get_scrape_configs_entry("node", full_path, job="node")
+
+    task = dispatcher.tasks[full_path]
+    assert task.kind == SCRAPE_CONFIGS
+    dispatcher.update(task)
+
+    entry = dispatcher.get_scrape_configs_entry("node", full_path, job="node")
+    assert entry.content_type == content_type
+    assert entry.read() == payload
@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+
+from prometheus_http_sd.cache_store import FileCacheStore, SQLiteCacheStore
+from prometheus_http_sd.dispather import Dispatcher, Task
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def store_factory(request, tmp_path):
+    if request.param == "file":
+        return lambda: FileCacheStore(tmp_path)
+    return lambda: SQLiteCacheStore(tmp_path / "cache.sqlite3")
+
+
+def make_replica(tmp_path, store):
+    return Dispatcher(
+        interval=60,
+        max_workers=1,
+        cache_location=tmp_path,
+        cache_expire_seconds=300,
+        cache_store=store,
+        shared_cache=True,
+    )
+
+
+def test_lease(store_factory):
+    first, second = store_factory(), store_factory()
+    assert first.acquire_lease("/targets/foo?", "a", 60)
+    assert not second.acquire_lease("/targets/foo?", "b", 60)
+    # someone else can not release my lease
+    second.release_lease("/targets/foo?", "b")
+    assert not second.acquire_lease("/targets/foo?", "b", 60)
+
+    first.release_lease("/targets/foo?", "a")
+    assert second.acquire_lease("/targets/foo?", "b", 60)
+
+
+def test_expired_lease_is_taken_over(store_factory):
+    first, second = store_factory(), store_factory()
+    assert first.acquire_lease("/targets/foo?", "a", -1)
+    assert second.acquire_lease("/targets/foo?", "b", 60)
+
+
+def test_only_one_replica_refresh(tmp_path, store_factory):
+    first = make_replica(tmp_path, store_factory())
+    second = make_replica(tmp_path, store_factory())
+    task = Task("/targets/foo?", "foo", {})
+
+    assert first.claim(task)
+    # first is still running
+    assert not second.claim(task)
+
+    first.write_cache(task.full_path, [])
+    first.release(task)
+    # first has refreshed it in this interval
+    assert not second.claim(task)
+    assert second.get_targets("foo", task.full_path) == []
+
+
+def test_renew_lease(store_factory):
+    first, second = store_factory(), store_factory()
+    assert first.acquire_lease("/targets/foo?", "a", -1)
+    assert first.renew_lease("/targets/foo?", "a", 60)
+    assert not second.acquire_lease("/targets/foo?", "b", 60)
+    # a lease taken over can not be renewed by its old owner
+    first.release_lease("/targets/foo?", "a")
+    assert second.acquire_lease("/targets/foo?", "b", -1)
+    assert first.acquire_lease("/targets/foo?", "a", 60)
+    assert not second.renew_lease("/targets/foo?", "b", 60)
+
+
+@pytest.mark.parametrize("expired", [True, False])
+def test_racing_acquires_have_one_winner(tmp_path, expired):
+    stores = [FileCacheStore(tmp_path) for _ in range(8)]
+    if expired:
+        assert stores[0].acquire_lease("/targets/foo?", "dead", -1)
+    barrier = threading.Barrier(len(stores))
+    won = []
+
+    def acquire(i, store):
+        barrier.wait()
+        if store.acquire_lease("/targets/foo?", str(i), 60):
+            won.append(i)
+
+    threads = [
+        threading.Thread(target=acquire, args=(i, store))
+        for i, store in enumerate(stores)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(won) == 1
+
+
+def test_released_leases_leave_no_files(tmp_path):
+    store = FileCacheStore(tmp_path)
+    for i in range(10):
+        assert store.acquire_lease(f"/targets/{i}?", "a", 60)
+        assert store.renew_lease(f"/targets/{i}?", "a", 60)
+        store.release_lease(f"/targets/{i}?", "a")
+    assert [p.name for p in tmp_path.iterdir()] == ["leases.lock"]
+
+
+def test_lease_lasts_about_a_refresh_interval(tmp_path, store_factory):
+    replica = make_replica(tmp_path, store_factory())
+    task = Task("/targets/foo?", "foo", {})
+    assert replica.lease_seconds(task) == 60
+    replica.index.record_refresh_interval(task.full_path, task.path, 15)
+    assert replica.lease_seconds(task) == 15
@@ -0,0 +1,113 @@
+from prometheus_client import REGISTRY
+import pytest
+
+from prometheus_http_sd.fair_queue import (
+    FairQueue,
+    parse_concurrency,
+    parse_weights,
+    tenant_label,
+    top_level_dir,
+)
+
+
+def test_top_level_dir():
+    assert top_level_dir("") == ""
+    assert top_level_dir("gateway") == "gateway"
+    assert top_level_dir("gateway/nginx/") == "gateway"
+
+
+def test_tenant_label(tmp_path, monkeypatch):
+    from prometheus_http_sd.config import config
+
+    (tmp_path / "gateway").mkdir()
+    (tmp_path / "node.py").write_text("")
+    monkeypatch.setattr(config, "root_dir", str(tmp_path))
+    monkeypatch.setattr(config, "mounts", {"team-a": "/srv/team-a"})
+
+    assert tenant_label("") == ""
+    assert tenant_label("gateway") == "gateway"
+    assert tenant_label("node") == "node"
+    assert tenant_label("team-a") == "team-a"
+    assert tenant_label("random-1") == "other"
+
+
+def test_unknown_tenants_share_a_label(tmp_path, monkeypatch):
+    from prometheus_http_sd.config import config
+
+    monkeypatch.setattr(config, "root_dir", str(tmp_path))
+
+    def sample(name):
+        return REGISTRY.get_sample_value(name, {"tenant": "other"}) or 0
+
+    depth = sample("httpsd_tenant_queue_depth")
+    running = sample("httpsd_tenant_running_jobs")
+
+    queue = FairQueue()
+    queue.put("random-1", "a")
+    queue.put("random-2", "b")
+    assert sample("httpsd_tenant_queue_depth") == depth + 2
+
+    queue.get()
+    assert sample("httpsd_tenant_queue_depth") == depth + 1
+    assert sample("httpsd_tenant_running_jobs") == running + 1
+    queue.done("random-1")
+    assert sample("httpsd_tenant_running_jobs") == running
+
+
+def test_parse_weights():
+    assert parse_weights(("a=2", "b=0.5")) == {"a": 2.0, "b": 0.5}
+    with pytest.raises(ValueError):
+        parse_weights(("a",))
+    with pytest.raises(ValueError):
+        parse_weights(("a=0",))
+
+
+def test_flood_tenant_does_not_starve_others():
+    queue = FairQueue()
+    for i in range(100):
+        queue.put("flood", f"flood-{i}")
+    queue.put("small", "small-0")
+    queue.put("small", "small-1")
+
+    served = [queue.get() for _ in range(4)]
+    assert sorted(served) == ["flood-0", "flood-1", "small-0", "small-1"]
+    assert len(queue) == 98
+
+
+def test_weights():
+    queue = FairQueue({"heavy": 3})
+    for i in range(30):
+        queue.put("heavy", "heavy")
+        queue.put("light", "light")
+
+    served = [queue.get() for _ in range(20)]
+    assert served.count("heavy") == 15
+    assert served.count("light") == 5
+
+
+def test_empty():
+    queue = FairQueue()
+    assert queue.get() is None
+    queue.put("a", 1)
+    assert queue.get() == 1
+    assert queue.get() is None
+
+
+def test_parse_concurrency():
+    assert parse_concurrency(("a=2",)) == {"a": 2}
+    with pytest.raises(ValueError):
+        parse_concurrency(("a=0",))
+
+
+def test_concurrency():
+    queue = FairQueue(concurrency={"limited": 1})
+    queue.put("limited", "limited-0")
+    queue.put("limited", "limited-1")
+    queue.put("other", "other-0")
+
+    assert queue.get() == "limited-0"
+    # limited is at its limit until its job is done
+    assert queue.get() == "other-0"
+    assert queue.get() is None
+    queue.done("limited")
+    assert queue.get() == "limited-1"
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from prometheus_http_sd.fastpath import TargetsFastPath
+from prometheus_http_sd.handler import cache_key
+
+
+def fallback_app(environ, start_response):
+    return Response("fallback", status=404)(environ, start_response)
+
+
+@pytest.fixture()
+def client(dispatcher):
+    return Client(TargetsFastPath(fallback_app, "/sd/", dispatcher))
+
+
+def test_cache_key_is_canonical():
+    assert cache_key("foo", {"b": "2", "a": "1"}) == cache_key(
+        "foo", {"a": "1", "b": "2"}
+    )
+    assert cache_key("foo", {}) == "/targets/foo?"
+
+
+def test_fast_path_hit(dispatcher, client):
+    targets = [{"targets": ["127.0.0.1:8080"], "labels": {"foo": "bar"}}]
+    dispatcher.write_cache(cache_key("foo", {"a": "1", "b": "2"}), targets)
+
+    response = client.get("/sd/targets/foo?b=2&a=1")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/json"
+    assert (
+        response.headers["ETag"].strip('"')
+        == dispatcher.open_cache(cache_key("foo", {"a": "1", "b": "2"})).etag
+    )
+    assert json.loads(response.data) == targets
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "/sd/targets/foo",
+        "/sd/targets/foo?a=1",
+        "/sd/targets/bar?debug=true",
+        "/sd/targets/bar?watch=abc",
+        "/sd/",
+        "/metrics",
+    ],
+)
+def test_fast_path_fallback(dispatcher, client, url):
+    dispatcher.write_cache(cache_key("bar", {}), [])
+
+    response = client.get(url)
+    assert response.status_code == 404
+    assert response.data == b"fallback"
+
+
+def test_fast_path_falls_back_on_a_path_not_utf8(client):
+    response = client.get(environ_overrides={"PATH_INFO": "/sd/targets/\xff"})
+    assert response.status_code == 404
+    assert response.data == b"fallback"
+
+
+def test_fast_path_counts_only_the_requests_it_serves(dispatcher, client):
+    def requests(full_path):
+        stats = dispatcher.index.keys.get(full_path)
+        return stats.requests.count if stats else 0
+
+    # a miss is counted by the app it falls back to
+    client.get("/sd/targets/foo")
+    assert requests(cache_key("foo", {})) == 0
+
+    dispatcher.write_cache(cache_key("bar", {}), [])
+    client.get("/sd/targets/bar")
+    assert requests(cache_key("bar", {})) == 1
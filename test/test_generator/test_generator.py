@@ -1,5 +1,5 @@
 import pytest
-from prometheus_http_sd.sd import generate
+from prometheus_http_sd.sd import generate, generate_partial
 from pathlib import Path
 
 
@@ -46,3 +46,32 @@ def test_non_exist():
 def test_empty():
     targets = generate(root, "empty")
     assert targets == []
+
+
+def test_generate_partial(tmp_path):
+    (tmp_path / "good.json").write_text('[{"targets": ["a:1"]}]')
+    (tmp_path / "bad.py").write_text(
+        "def generate_targets(**kwargs):\n    return 1 / 0\n"
+    )
+
+    targets, results, failures = generate_partial(str(tmp_path))
+    assert targets == [{"targets": ["a:1"]}]
+    bad = str(tmp_path / "bad.py")
+    assert list(failures) == [bad]
+    assert "ZeroDivisionError" in failures[bad]
+    assert bad not in results
+
+    last_good = {bad: [{"targets": ["b:1"]}]}
+    targets, results, failures = generate_partial(
+        str(tmp_path), last_good=last_good
+    )
+    assert sorted(t["targets"][0] for t in targets) == ["a:1", "b:1"]
+    assert results[bad] == last_good[bad]
+
+
+def test_generate_partial_all_failed(tmp_path):
+    (tmp_path / "bad.py").write_text(
+        "def generate_targets(**kwargs):\n    return 1 / 0\n"
+    )
+    with pytest.raises(ZeroDivisionError):
+        generate_partial(str(tmp_path))
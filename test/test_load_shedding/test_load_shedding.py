@@ -0,0 +1,131 @@
+import http.client
+import threading
+import time
+
+from waitress import wasyncore
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from prometheus_http_sd.load_shedding import (
+    AIMDLimiter,
+    LoadShedding,
+    create_server,
+    is_limited,
+)
+
+
+def test_limit_decreases_and_recovers():
+    limiter = AIMDLimiter(target_latency=0.1, max_limit=10)
+    assert limiter.acquire()
+    limiter.release(1.0)
+    assert limiter.limit == 9
+
+    # at most one decrease per target latency
+    assert limiter.acquire()
+    limiter.release(1.0)
+    assert limiter.limit == 9
+
+    for _ in range(100):
+        assert limiter.acquire()
+        limiter.release(0.01)
+    assert limiter.limit == 10
+
+
+def test_limit_sheds_beyond_inflight():
+    limiter = AIMDLimiter(target_latency=1, max_limit=2)
+    assert limiter.acquire()
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    limiter.release(0.01)
+    assert limiter.acquire()
+
+
+def test_is_limited():
+    assert is_limited("/sd/targets", "", "/sd/targets")
+    assert is_limited("/sd/targets/foo", "a=1", "/sd/targets")
+    assert not is_limited("/sd/targets/foo", "watch=abc", "/sd/targets")
+    assert not is_limited("/sd/targetsfoo", "", "/sd/targets")
+    assert not is_limited("/metrics", "", "/sd/targets")
+
+
+def test_middleware_sheds_with_retry_after():
+    entered = threading.Event()
+    proceed = threading.Event()
+
+    def app(environ, start_response):
+        if environ["PATH_INFO"] == "/targets/slow":
+            entered.set()
+            proceed.wait(5)
+        return Response("ok")(environ, start_response)
+
+    client = Client(LoadShedding(app, "", AIMDLimiter(1, max_limit=1)))
+    thread = threading.Thread(target=client.get, args=("/targets/slow",))
+    thread.start()
+    entered.wait(5)
+
+    response = client.get("/targets/foo")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    # not limited
+    assert client.get("/").status_code == 200
+    assert client.get("/targets/foo?watch=abc").status_code == 200
+
+    proceed.set()
+    thread.join()
+    assert client.get("/targets/foo").status_code == 200
+
+
+def test_limit_sheds_queued_requests():
+    limiter = AIMDLimiter(target_latency=0.1, max_limit=10)
+    assert limiter.acquire(queued=0.05)
+    assert not limiter.acquire(queued=0.5)
+    assert limiter.limit == 9
+    assert limiter.inflight == 1
+
+
+def get(port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def test_server_sheds_once_the_queue_builds_up():
+    def app(environ, start_response):
+        # fast enough by itself, but one thread can not keep up
+        time.sleep(0.05)
+        return Response("ok")(environ, start_response)
+
+    server = create_server(
+        LoadShedding(app, "", AIMDLimiter(0.2, max_limit=1)),
+        host="127.0.0.1",
+        port=0,
+        threads=1,
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    try:
+        statuses = []
+        clients = [
+            threading.Thread(
+                target=lambda: statuses.append(
+                    get(server.effective_port, "/targets/foo")
+                )
+            )
+            for _ in range(20)
+        ]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        # the requests waiting in the queue for too long were shed
+        assert 200 in statuses
+        assert 503 in statuses
+    finally:
+        # closed by the thread of the loop, which then returns
+        server.trigger.pull_trigger(lambda: wasyncore.close_all(server._map))
+        thread.join(5)
@@ -0,0 +1,75 @@
+from prometheus_http_sd.redis.local_cache import LocalCache
+
+
+def subscribed_cache(max_size=2, max_bytes=1024):
+    cache = LocalCache(max_size, max_bytes)
+    cache.subscribed()
+    return cache
+
+
+def test_read_through():
+    cache = subscribed_cache()
+    assert cache.get("a") is None
+    cache.put("a", {"results": []}, cache.generation)
+    assert cache.get("a") == {"results": []}
+    cache.invalidate("a")
+    assert cache.get("a") is None
+
+
+def test_not_used_until_subscribed():
+    cache = LocalCache()
+    cache.put("a", 1, cache.generation)
+    assert cache.get("a") is None
+
+    cache.subscribed()
+    cache.put("a", 1, cache.generation)
+    cache.unsubscribed()
+    assert cache.get("a") is None
+
+
+def test_value_read_before_an_invalidation_is_not_put():
+    cache = subscribed_cache()
+    generation = cache.generation
+    # a worker writes the key while it is read from Redis
+    cache.invalidate("a")
+    cache.put("a", "outdated", generation)
+    assert cache.get("a") is None
+
+
+def test_least_recently_used_is_dropped():
+    cache = subscribed_cache(max_size=2)
+    for key in ("a", "b"):
+        cache.put(key, key, cache.generation)
+    cache.get("a")
+    cache.put("c", "c", cache.generation)
+    assert cache.get("b") is None
+    assert cache.get("a") == "a"
+    assert cache.get("c") == "c"
+
+
+def entry(size):
+    return {"etag": "x", "payload": b"x" * size}
+
+
+def test_bounded_by_payload_bytes():
+    cache = subscribed_cache(max_size=10, max_bytes=100)
+    for key in ("a", "b", "c"):
+        cache.put(key, entry(40), cache.generation)
+    # 120 bytes, the least recently used is dropped
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    assert cache.bytes == 80
+
+    # replacing a key counts its new payload only
+    cache.put("b", entry(10), cache.generation)
+    assert cache.bytes == 50
+
+    # bigger than the whole cache, not kept and nothing dropped for it
+    cache.put("d", entry(101), cache.generation)
+    assert cache.get("d") is None
+    assert cache.get("c") is not None
+
+    cache.invalidate("c")
+    assert cache.bytes == 10
+    cache.unsubscribed()
+    assert cache.bytes == 0
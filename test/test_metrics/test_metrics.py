@@ -0,0 +1,80 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from prometheus_http_sd.metrics import OTHER_PATHS, PathLabeler
+
+
+@pytest.mark.parametrize(
+    "strategy, expected",
+    [
+        ("full", ["a/b/c", "a/b/d", "e", "a/x/y"]),
+        ("l1", ["a", "a", "e", "a"]),
+        ("l2", ["a/b", "a/b", "e", "a/x"]),
+        ("depth:3", ["a/b/c", "a/b/d", "e", "a/x/y"]),
+        ("first:2", ["a/b/c", "a/b/d", OTHER_PATHS, OTHER_PATHS]),
+    ],
+)
+def test_path_labeler(strategy, expected):
+    labeler = PathLabeler(strategy)
+    paths = ["a/b/c", "a/b/d", "e", "a/x/y"]
+    assert [labeler.label(p) for p in paths] == expected
+    # a known path keeps its label
+    assert labeler.label(paths[0]) == expected[0]
+
+
+def test_full_path_label():
+    assert (
+        PathLabeler("full").full_path_label("/targets/a/b?x=1", "a/b")
+        == "/targets/a/b?x=1"
+    )
+    assert PathLabeler("l1").full_path_label("/targets/a/b?x=1", "a/b") == "a"
+
+
+@pytest.mark.parametrize(
+    "strategy", ["", "l3", "depth:0", "first:x", "top:2", "full:1"]
+)
+def test_invalid_strategy(strategy):
+    with pytest.raises(ValueError):
+        PathLabeler(strategy)
+
+
+def test_exposition_metrics(client):
+    first = client.get("/metrics").data
+    assert REGISTRY.get_sample_value("httpsd_metrics_exposition_bytes") == len(
+        first
+    )
+    assert REGISTRY.get_sample_value("httpsd_metrics_render_seconds_count")
+
+
+def test_dir_labels_of_unknown_paths(tmp_path, monkeypatch):
+    from prometheus_http_sd.config import config
+    from prometheus_http_sd.handler import split_dirs
+
+    (tmp_path / "gateway" / "nginx").mkdir(parents=True)
+    monkeypatch.setattr(config, "root_dir", str(tmp_path))
+
+    assert split_dirs("gateway/nginx/a") == ("gateway", "nginx")
+    assert split_dirs("gateway") == ("gateway", "")
+    assert split_dirs("gateway/random-1") == ("gateway", OTHER_PATHS)
+    assert split_dirs("random-1/random-2") == (OTHER_PATHS, "")
+
+
+def test_requests_of_unknown_paths_share_a_label(
+    client, tmp_path, monkeypatch
+):
+    from prometheus_http_sd.config import config
+
+    monkeypatch.setattr(config, "root_dir", str(tmp_path))
+
+    def sample(l1_dir, l2_dir):
+        labels = {
+            "path": "random-1/x",
+            "status": "cache-not-exist",
+            "l1_dir": l1_dir,
+            "l2_dir": l2_dir,
+        }
+        return REGISTRY.get_sample_value("httpsd_path_requests_total", labels)
+
+    client.get("/targets/random-1/x")
+    assert sample(OTHER_PATHS, "") == 1
+    assert sample("random-1", "x") is None
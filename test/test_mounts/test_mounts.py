@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from prometheus_http_sd.config import config
+from prometheus_http_sd.dispather import Dispatcher
+from prometheus_http_sd.handler import cache_key
+from prometheus_http_sd.mounts import locate, parse_mounts
+
+
+@pytest.fixture()
+def mounts(tmp_path, monkeypatch):
+    for team in ("team-a", "team-b"):
+        (tmp_path / team / "nginx").mkdir(parents=True)
+        (tmp_path / team / "nginx" / "targets.json").write_text(
+            json.dumps([{"targets": [f"{team}:80"]}])
+        )
+    monkeypatch.setattr(config, "root_dir", "")
+    monkeypatch.setattr(
+        config,
+        "mounts",
+        parse_mounts(
+            (f"a={tmp_path / 'team-a'}", f"/b/={tmp_path / 'team-b'}")
+        ),
+    )
+    return tmp_path
+
+
+def test_parse_mounts(tmp_path):
+    assert parse_mounts((f"a={tmp_path}/",)) == {"a": str(tmp_path)}
+    for mount in ("a", f"a/b={tmp_path}", f"={tmp_path}", "a=/not-exist"):
+        with pytest.raises(ValueError):
+            parse_mounts((mount,))
+
+
+def test_locate(mounts, monkeypatch):
+    assert locate("a/nginx") == (str(mounts / "team-a"), "nginx")
+    assert locate("b") == (str(mounts / "team-b"), "")
+    with pytest.raises(FileNotFoundError):
+        locate("c/nginx")
+
+    monkeypatch.setattr(config, "root_dir", "/srv/targets")
+    assert locate("c/nginx") == ("/srv/targets", "c/nginx")
+
+
+def test_mounts_share_a_dispatcher(mounts):
+    dispatcher = Dispatcher(
+        interval=1,
+        max_workers=2,
+        cache_location=mounts,
+        cache_expire_seconds=300,
+        tenant_concurrency={"a": 1},
+    )
+    for path in ("a/nginx", "b"):
+        dispatcher.append_task(cache_key(path, {}), path, {})
+        task = dispatcher.tasks[cache_key(path, {})]
+        dispatcher.queue.put(path.split("/")[0], task)
+        dispatcher.update_next()
+
+    for path, target in (("a/nginx", "team-a:80"), ("b", "team-b:80")):
+        entry = dispatcher.cache_store.open(cache_key(path, {}))
+        assert json.loads(entry.read()) == [{"targets": [target]}]
+    assert dispatcher.index.paths("") == ["a", "a/nginx", "b", "b/nginx"]
+
+
+@pytest.mark.parametrize("path", ["", "c/nginx"])
+def test_path_without_a_root_is_not_found(mounts, app, path):
+    response = app.test_client().get(f"/targets/{path}")
+    assert response.status_code == 404
+    assert "error" in response.get_json()
+    # no refresh that can never succeed
+    assert not app.extensions["dispatcher"].tasks
@@ -0,0 +1,123 @@
+import time
+
+import pytest
+
+from prometheus_http_sd.config import config
+from prometheus_http_sd.dispather import Dispatcher
+from prometheus_http_sd.handler import cache_key, serve_targets
+from prometheus_http_sd import params
+from prometheus_http_sd.params import ParamsIndex, UndeclaredParams
+
+
+@pytest.fixture()
+def root(tmp_path, monkeypatch):
+    root = tmp_path / "root"
+    (root / "static").mkdir(parents=True)
+    (root / "static" / "a.json").write_text("[]")
+    (root / "declared").mkdir()
+    (root / "declared" / "a.py").write_text(
+        "QUERY_PARAMS = ['domain']\n"
+        "def generate_targets(**kwargs):\n    return []\n"
+    )
+    (root / "declared" / "b.py").write_text(
+        "def generate_targets(env, *, zone='a'):\n    return []\n"
+    )
+    (root / "any").mkdir()
+    (root / "any" / "a.py").write_text(
+        "def generate_targets(**kwargs):\n    return []\n"
+    )
+    monkeypatch.setattr(config, "root_dir", str(root))
+    monkeypatch.setattr(config, "undeclared_params", "drop")
+    return root
+
+
+def test_accepted(root):
+    index = ParamsIndex()
+    assert index.accepted(str(root), "static") == frozenset()
+    assert index.accepted(str(root), "declared") == {"domain", "env", "zone"}
+    assert index.accepted(str(root), "any") is None
+    # a generator accepting anything makes the whole path accept anything
+    assert index.accepted(str(root), "") is None
+    assert index.accepted(str(root), "not-exist") is None
+    assert index.accepted(str(root), "declared/a", scrape_configs=True) == {
+        "domain"
+    }
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        ("QUERY_PARAMS = ['a']\n", {"a"}),
+        ("QUERY_PARAMS: list = ['a']\n", {"a"}),
+        ("QUERY_PARAMS: typing.List[str] = ('a', 'b')\n", {"a", "b"}),
+        # only annotated, the signature declares them
+        ("QUERY_PARAMS: list\ndef generate_targets(b):\n    pass\n", {"b"}),
+    ],
+)
+def test_python_params(source, expected):
+    assert params._python_params(source) == expected
+
+
+def test_paths_are_bounded(root):
+    index = ParamsIndex(max_paths=2)
+    for i in range(10):
+        assert index.accepted(str(root), f"not-exist-{i}") is None
+    # a path that does not exist is not kept
+    assert len(index._paths) == 0
+
+    index.accepted(str(root), "static")
+    index.accepted(str(root), "declared")
+    index.accepted(str(root), "static")
+    index.accepted(str(root), "any")
+    assert list(index._paths) == [
+        f"False:{root}:static",
+        f"False:{root}:any",
+    ]
+
+
+def test_check_again_in_background(root, monkeypatch):
+    index = ParamsIndex()
+    assert index.accepted(str(root), "static") == frozenset()
+
+    monkeypatch.setattr(params, "PARAMS_CHECK_INTERVAL", 0)
+    (root / "static" / "b.py").write_text(
+        "def generate_targets(domain):\n    return []\n"
+    )
+    # the request does not wait for the scan, it gets the kept result
+    assert index.accepted(str(root), "static") == frozenset()
+    deadline = time.time() + 5
+    while index.accepted(str(root), "static") != {"domain"}:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_filter(root, monkeypatch):
+    index = ParamsIndex()
+    args = {"domain": "foo", "ts": "1"}
+    assert index.filter("declared", args) == {"domain": "foo"}
+    assert index.filter("static", args) == {}
+    assert index.filter("any", args) == args
+
+    monkeypatch.setattr(config, "undeclared_params", "reject")
+    with pytest.raises(UndeclaredParams, match="ts"):
+        index.filter("declared", args)
+
+    monkeypatch.setattr(config, "undeclared_params", "keep")
+    assert index.filter("static", args) == args
+
+
+def test_query_variants_share_the_cache(root, tmp_path):
+    (tmp_path / "cache").mkdir()
+    dispatcher = Dispatcher(
+        interval=1,
+        max_workers=1,
+        cache_location=tmp_path / "cache",
+        cache_expire_seconds=300,
+    )
+    dispatcher.write_cache(cache_key("static", {}), [{"targets": ["a:1"]}])
+
+    for ts in range(3):
+        result = serve_targets(dispatcher, "static", {"ts": str(ts)})
+        assert result.status == 200
+        result.entry.close()
+    assert list(dispatcher.tasks) == [cache_key("static", {})]
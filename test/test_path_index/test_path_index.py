@@ -0,0 +1,82 @@
+from pathlib import Path
+
+import pytest
+
+from prometheus_http_sd import path_index
+from prometheus_http_sd.config import config
+from prometheus_http_sd.dispather import CacheNotExist, Dispatcher, Task
+from prometheus_http_sd.path_index import PathIndex, RateCounter
+
+root = str(Path(__file__).parent.parent / "app_root")
+
+
+def test_rate_counter(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(path_index.time, "time", lambda: now[0])
+    counter = RateCounter()
+    for _ in range(30):
+        counter.inc()
+    # the current window is not complete yet
+    assert counter.rate() == 0
+
+    now[0] += path_index.RATE_WINDOW
+    assert counter.rate() == 30 / path_index.RATE_WINDOW
+
+    now[0] += 2 * path_index.RATE_WINDOW
+    assert counter.rate() == 0
+
+
+def test_paths_are_scanned_once():
+    index = PathIndex()
+    paths = index.paths(root)
+    assert "echo_target" in paths
+    assert index.paths(root) is paths
+
+
+def test_max_keys():
+    index = PathIndex(max_keys=2)
+    index.record_request("/targets/a?", "a")
+    index.record_request("/targets/b?", "b")
+    index.record_request("/targets/a?", "a")
+    index.record_request("/targets/c?", "c")
+    # b is the least recently used
+    assert [row["full_path"] for row in index.rows()] == [
+        "/targets/a?",
+        "/targets/c?",
+    ]
+
+
+def test_dispatcher_index(tmp_path):
+    config.root_dir = root
+    dispatcher = Dispatcher(
+        interval=1,
+        max_workers=1,
+        cache_location=tmp_path,
+        cache_expire_seconds=300,
+    )
+    full_path = "/targets/cached_target?"
+    with pytest.raises(CacheNotExist):
+        dispatcher.get_targets("cached_target", full_path)
+    (row,) = dispatcher.index.rows()
+    assert row["status"] == "unknown"
+    assert row["cache_age_seconds"] is None
+
+    dispatcher.update(Task(full_path, "cached_target", {}))
+    dispatcher.get_targets("cached_target", full_path)
+    (row,) = dispatcher.index.rows()
+    assert row["status"] == "success"
+    assert row["target_count"] == 1
+    assert row["size"] > 0
+    assert row["cache_age_seconds"] < 60
+    assert row["last_duration_seconds"] >= 0
+
+    dispatcher.update(Task("/targets/error?", "error", {}))
+    assert dispatcher.index.rows()[1]["status"] == "failed"
+
+
+def test_admin_page(client):
+    config.root_dir = root
+    client.get("/targets/echo_target")
+    html = client.get("/").data.decode()
+    assert "/targets/error" in html
+    assert "<td>/targets/echo_target?</td>" in html
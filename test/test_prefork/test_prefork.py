@@ -0,0 +1,127 @@
+import os
+import queue
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from prometheus_http_sd import dispather
+from prometheus_http_sd.dispather import Dispatcher
+from prometheus_http_sd.handler import cache_key
+from prometheus_http_sd.metrics import MULTIPROC_DIR_ENV
+from prometheus_http_sd.prefork import (
+    OWNED_MULTIPROC_DIR_ENV,
+    remove_multiprocess_dir,
+)
+
+
+@pytest.fixture()
+def dispatchers(tmp_path, monkeypatch):
+    monkeypatch.setattr(dispather, "FORWARD_INTERVAL", 0.01)
+
+    def create():
+        return Dispatcher(
+            interval=1,
+            max_workers=1,
+            cache_location=tmp_path,
+            cache_expire_seconds=300,
+        )
+
+    return create(), create()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_tasks_are_forwarded_to_the_scheduler(dispatchers):
+    server, scheduler = dispatchers
+    task_queue = queue.Queue()
+    server.start_forwarder(task_queue)
+    scheduler.start_receiver(task_queue)
+
+    full_path = cache_key("foo", {"a": "1"})
+    server.index.record_refresh_interval(full_path, "foo", 30)
+    server.append_task(full_path, "foo", {"a": "1"})
+
+    wait_for(lambda: full_path in scheduler.tasks)
+    task = scheduler.tasks[full_path]
+    assert task.extra_args == {"a": "1"}
+    assert task.need_update
+    assert scheduler.index.refresh_interval(full_path) == 30
+    assert not server.tasks[full_path].need_update
+
+
+def test_profile_job_from_another_process(dispatchers):
+    server, other = dispatchers
+    server.start_forwarder(queue.Queue())
+    other.start_forwarder(queue.Queue())
+
+    job = server.profile_jobs.submit("not-exist", {})
+    assert other.profile_jobs.get(job.job_id) is None
+    wait_for(
+        lambda: (other.profile_jobs.get_dict(job.job_id) or {}).get(
+            "finished_at"
+        )
+    )
+    # the path does not exist
+    assert other.profile_jobs.get_dict(job.job_id)["status"] == "failed"
+
+
+@pytest.mark.parametrize("started", [False, True])
+def test_multiprocess_dir_is_removed_on_sigterm(tmp_path, started):
+    root_dir, cache_dir, tmp_dir = (
+        tmp_path / name for name in ("root", "cache", "tmp")
+    )
+    for path in (root_dir, cache_dir, tmp_dir):
+        path.mkdir()
+    env = dict(os.environ, TMPDIR=str(tmp_dir))
+    env.pop(MULTIPROC_DIR_ENV, None)
+    env.pop(OWNED_MULTIPROC_DIR_ENV, None)
+    log = tmp_path / "serve.log"
+    with open(log, "w") as f:
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "prometheus_http_sd.cli",
+                "serve",
+                "--processes",
+                "2",
+                "--port",
+                "0",
+                "--cache-dir",
+                str(cache_dir),
+                str(root_dir),
+            ],
+            env=env,
+            stdout=f,
+            stderr=subprocess.STDOUT,
+        )
+    try:
+        if started:
+            wait_for(
+                lambda: log.read_text().count("Started the server process")
+                == 2,
+                timeout=30,
+            )
+        else:
+            # while it starts again with the new dir
+            wait_for(lambda: any(tmp_dir.iterdir()), timeout=30)
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=30) == 0
+    finally:
+        process.kill()
+    assert not any(tmp_dir.iterdir())
+
+
+def test_user_multiprocess_dir_is_kept(tmp_path, monkeypatch):
+    monkeypatch.setenv(MULTIPROC_DIR_ENV, str(tmp_path))
+    monkeypatch.delenv(OWNED_MULTIPROC_DIR_ENV, raising=False)
+    remove_multiprocess_dir()
+    assert tmp_path.exists()
@@ -0,0 +1,108 @@
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from prometheus_http_sd.cache_store import FileCacheStore
+from prometheus_http_sd.config import config
+from prometheus_http_sd.profiling import ProfileJobs, TooManyJobs
+from prometheus_http_sd.sd import profile_generators
+
+root = str(Path(__file__).parent.parent / "app_root")
+
+
+def wait_finished(jobs, job_id, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = jobs.get(job_id)
+        if job.finished:
+            return job
+        time.sleep(0.05)
+    raise TimeoutError(job_id)
+
+
+def test_profile_generators():
+    result = profile_generators(root, "echo_target", {"a": "1"}, 5)
+    stats = result[str(Path(root) / "echo_target" / "target.py")]
+    assert stats["wall_seconds"] >= stats["import_seconds"] > 0
+    assert stats["cpu_seconds"] >= 0
+    assert stats["peak_memory_bytes"] > 0
+    assert stats["output_bytes"] == len(
+        '[{"labels": {"a": "1"}, "targets": ["127.0.0.1:8080"]}]'
+    )
+    assert "cumulative" in stats["profile"]
+
+
+def test_profile_generator_error():
+    result = profile_generators(root, "error")
+    (stats,) = result.values()
+    assert stats["error"].startswith("ZeroDivisionError")
+    assert "output_bytes" not in stats
+    assert "profile" not in stats
+
+
+def test_profile_jobs():
+    config.root_dir = root
+    jobs = ProfileJobs()
+    job = jobs.submit("echo_target", {"a": "1"})
+    # the same job while it is not finished yet
+    assert jobs.submit("echo_target", {"a": "1"}) is job
+
+    job = wait_finished(jobs, job.job_id)
+    assert job.status == "done"
+    assert len(job.to_dict()["generators"]) == 3
+    assert jobs.submit("echo_target", {"a": "1"}) is not job
+
+
+def test_pending_jobs_are_bounded():
+    config.root_dir = root
+    jobs = ProfileJobs(max_pending=2)
+    # keep the only worker busy
+    started = threading.Event()
+    release = threading.Event()
+    jobs.threadpool.submit(lambda: (started.set(), release.wait(30)))
+    started.wait(30)
+
+    jobs.submit("error", {"a": "1"})
+    jobs.submit("error", {"a": "2"})
+    # the same job is still returned
+    jobs.submit("error", {"a": "2"})
+    with pytest.raises(TooManyJobs):
+        jobs.submit("error", {"a": "3"})
+    release.set()
+
+
+def test_evicted_jobs_are_deleted_from_the_store(tmp_path):
+    config.root_dir = root
+    store = FileCacheStore(tmp_path)
+    jobs = ProfileJobs(max_jobs=1, store=store)
+    first = wait_finished(jobs, jobs.submit("error", {}).job_id)
+    # polled from another process
+    assert ProfileJobs(store=store).get_dict(first.job_id) is not None
+
+    wait_finished(jobs, jobs.submit("error", {"a": "1"}).job_id)
+    jobs.submit("error", {"a": "2"})
+    assert jobs.get(first.job_id) is None
+    assert ProfileJobs(store=store).get_dict(first.job_id) is None
+
+
+def test_debug_route(client):
+    config.root_dir = root
+    response = client.get("/targets/echo_target?debug=true&profile=3")
+    assert response.status_code == 202
+    result_url = response.json["result_url"]
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        job = client.get(result_url).json
+        if job["status"] == "done":
+            break
+        time.sleep(0.05)
+    assert job["extra_args"] == {}
+    assert job["profile_top"] == 3
+    assert len(job["generators"]) == 3
+
+    assert client.get("/debug/jobs/not-exist").status_code == 404
+    response = client.get("/targets/echo_target?debug=true&profile=x")
+    assert response.status_code == 400
@@ -0,0 +1,72 @@
+import json
+
+from prometheus_http_sd.config import config
+from prometheus_http_sd.handler import cache_key
+from prometheus_http_sd.redis.cache import RedisCache
+from prometheus_http_sd.redis.queue import RedisJobQueue
+from prometheus_http_sd.redis.server import create_server_app
+
+
+def test_entry_round_trip(redis_server):
+    cache = RedisCache()
+    payload = b'[{"targets":["a:1"]}]'
+    header = {
+        "updated_timestamp": 1700000000.5,
+        "duration": 0.25,
+        "size": len(payload),
+        "target_count": 1,
+        "etag": "abc",
+        "version": 3,
+        "content_type": "application/json",
+        # not a header field, not stored
+        "status": "success",
+        "error": None,
+    }
+    assert cache.set_entry("a", header, payload)
+
+    del header["status"], header["error"]
+    assert cache.read_entries(["a", "missing"]) == [
+        dict(header, payload=payload),
+        None,
+    ]
+    assert cache.read_entry("a") == dict(header, payload=payload)
+    assert cache.read_header("a") == header
+    assert cache.read_entries([]) == []
+
+    # the previous fields are not left behind
+    cache.set_entry("a", {"updated_timestamp": 1.0}, b"[]")
+    assert cache.read_entry("a") == {
+        "updated_timestamp": 1.0,
+        "payload": b"[]",
+    }
+
+
+def test_old_string_value_is_a_miss(redis_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "root_dir", str(tmp_path))
+    (tmp_path / "foo").mkdir()
+    cache = RedisCache()
+    key = cache_key("foo", {})
+    # written by a worker from before the hash entries
+    cache.set(key, {"status": "success", "targets": []})
+    cache.set_entry("new", {"updated_timestamp": 1.0}, b"[]")
+
+    assert cache.read_entries([key, "new"]) == [
+        None,
+        {"updated_timestamp": 1.0, "payload": b"[]"},
+    ]
+    assert cache.read_entry(key) is None
+    assert cache.read_header(key) is None
+
+    client = create_server_app("", 300).test_client()
+    response = client.get("/targets/foo")
+    assert response.status_code == 200
+    assert response.get_json() == {"error": "cache miss"}
+    # a miss, the path is generated again
+    assert RedisJobQueue().is_job_queued_or_processing(key)
+
+    response = client.post(
+        "/targets/_bulk", json={"requests": [{"path": "foo"}]}
+    )
+    assert response.status_code == 200
+    (item,) = json.loads(response.data)["results"]
+    assert item["error"] == "cache miss"
@@ -0,0 +1,51 @@
+import pytest
+
+from prometheus_http_sd.config import config
+from prometheus_http_sd.redis import pool
+from prometheus_http_sd.redis.server import ServerDispatcher
+from prometheus_http_sd.redis.worker import Worker
+
+
+def test_pool_is_created_once_per_process(redis_server, monkeypatch):
+    created = []
+    from_url = pool.InstrumentedConnectionPool.from_url
+
+    def counting_from_url(url, **kwargs):
+        created.append((url, kwargs["decode_responses"]))
+        return from_url(url, **kwargs)
+
+    monkeypatch.setattr(
+        pool.InstrumentedConnectionPool,
+        "from_url",
+        staticmethod(counting_from_url),
+    )
+
+    server = ServerDispatcher(300)
+    workers = [Worker(f"worker-{i}") for i in range(3)]
+
+    # one pool for the decoded clients, one for the raw ones
+    assert sorted(created) == [
+        (config.redis_url, False),
+        (config.redis_url, True),
+    ]
+    decoded = {
+        id(client.connection_pool)
+        for owner in [server] + workers
+        for client in (owner.cache._redis_client, owner.queue._redis_client)
+    }
+    raw = {
+        id(owner.cache._raw_client.connection_pool)
+        for owner in [server] + workers
+    }
+    assert len(decoded) == 1
+    assert len(raw) == 1
+    assert decoded != raw
+
+
+def test_worker_max_connections():
+    assert pool.worker_max_connections(4) == pool.MAX_CONNECTIONS
+    # one connection waits for a job, one renews the lease
+    assert pool.worker_max_connections(100) == 204
+    assert pool.worker_max_connections(100, 300) == 300
+    with pytest.raises(ValueError):
+        pool.worker_max_connections(100, 128)
@@ -0,0 +1,121 @@
+import pytest
+
+from prometheus_http_sd.redis.queue import RedisJobQueue
+
+
+@pytest.fixture()
+def queue(redis_server):
+    # every lease is expired as soon as it is given
+    return RedisJobQueue(visibility_timeout=0, max_deliveries=2)
+
+
+def job(full_path="/targets/foo?"):
+    return {"full_path": full_path, "path": "foo", "extra_args": {}}
+
+
+def test_expired_lease_is_redelivered(queue):
+    assert queue.enqueue_job(job())
+    first = queue.dequeue_job()
+    assert first["delivery"] == 1
+    assert queue.dequeue_job(timeout=0.1) is None
+
+    assert queue.requeue_expired() == 1
+    second = queue.dequeue_job()
+    assert second["job_id"] == first["job_id"]
+    assert second["delivery"] == 2
+    assert second["lease"] != first["lease"]
+
+
+def test_renewed_lease_is_not_redelivered(redis_server):
+    queue = RedisJobQueue(visibility_timeout=60)
+    assert queue.enqueue_job(job())
+    leased = queue.dequeue_job()
+    assert queue.extend_lease(leased)
+    assert queue.requeue_expired() == 0
+    assert queue.finish_job(leased)
+    # the lease is gone with the ack
+    assert not queue.extend_lease(leased)
+
+
+def test_job_is_dropped_after_max_deliveries(queue):
+    assert queue.enqueue_job(job())
+    queue.dequeue_job()
+    assert queue.requeue_expired() == 1
+    queue.dequeue_job()
+    # delivered twice already, dropped instead of queued again
+    assert queue.requeue_expired() == 0
+
+    client = queue._redis_client
+    assert client.zcard(queue.processing_key) == 0
+    assert client.hlen(queue.jobs_key) == 0
+    assert client.hlen(queue.deliveries_key) == 0
+    assert client.zcard(queue.tenants_key) == 0
+
+
+def test_stale_ack_does_not_remove_the_next_lease(queue):
+    assert queue.enqueue_job(job())
+    first = queue.dequeue_job()
+    queue.requeue_expired()
+    second = queue.dequeue_job()
+
+    # the first worker finishes late, after its job was redelivered
+    assert not queue.finish_job(first)
+    assert not queue.extend_lease(first)
+    assert queue._redis_client.zscore(queue.processing_key, second["lease"])
+    assert queue.is_job_queued_or_processing(job()["full_path"])
+
+    assert queue.finish_job(second)
+    assert queue._redis_client.zcard(queue.processing_key) == 0
+
+
+def test_same_path_is_enqueued_once(queue):
+    assert queue.enqueue_job(job())
+    assert not queue.enqueue_job(job())
+    assert queue.enqueue_job(job("/targets/bar?"))
+    assert queue._redis_client.llen(queue._tenant_queue("foo")) == 2
+
+    # still deduped while the job is processing
+    queue.dequeue_job()
+    assert not queue.enqueue_job(job())
+
+
+def test_marker_is_cleared_on_finish(queue):
+    assert queue.enqueue_job(job())
+    assert queue.finish_job(queue.dequeue_job())
+    assert not queue.is_job_queued_or_processing(job()["full_path"])
+    assert queue.enqueue_job(job())
+
+
+def test_marker_is_kept_on_requeue_and_cleared_on_drop(queue):
+    assert queue.enqueue_job(job())
+    queue.dequeue_job()
+    assert queue.requeue_expired() == 1
+    # queued again, a new job of the path is still a duplicate
+    assert not queue.enqueue_job(job())
+    assert queue._redis_client.ttl(queue._inflight_key(job()["full_path"])) > 0
+
+    queue.dequeue_job()
+    assert queue.requeue_expired() == 0
+    assert not queue.is_job_queued_or_processing(job()["full_path"])
+    assert queue.enqueue_job(job())
+
+
+def test_job_is_dequeued_when_its_signal_is_lost(queue):
+    assert queue.enqueue_job(job())
+    # a worker popped the signal and died before taking the job
+    assert queue._redis_client.rpop(queue.signal_key)
+
+    leased = queue.dequeue_job(timeout=0.1)
+    assert leased["full_path"] == job()["full_path"]
+    assert queue._redis_client.llen(queue._tenant_queue("foo")) == 0
+
+
+def test_tenants_share_by_weight(redis_server):
+    queue = RedisJobQueue(tenant_weights={"a": 2})
+    for i in range(6):
+        assert queue.enqueue_job(dict(job(f"/targets/a/{i}?"), path="a"))
+        assert queue.enqueue_job(dict(job(f"/targets/b/{i}?"), path="b"))
+
+    served = [queue.dequeue_job()["path"] for _ in range(6)]
+    assert served.count("a") == 4
+    assert served.count("b") == 2
@@ -0,0 +1,95 @@
+import json
+import time
+
+import pytest
+
+from prometheus_http_sd.config import config
+from prometheus_http_sd.dispather import CacheNotExist
+from prometheus_http_sd.handler import cache_key
+from prometheus_http_sd.redis.cache import RedisCache
+from prometheus_http_sd.redis.queue import RedisJobQueue
+from prometheus_http_sd.redis.server import ServerDispatcher, create_server_app
+from prometheus_http_sd.redis.worker import Worker
+
+
+def test_bulk_and_get_share_the_cache_key(redis_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "root_dir", str(tmp_path))
+    payload = b'[{"targets":["a:1"]}]'
+    RedisCache().set_entry(
+        cache_key("foo", {"b": "2", "a": "1"}),
+        {"updated_timestamp": time.time(), "size": len(payload)},
+        payload,
+    )
+    client = create_server_app("/sd", 300).test_client()
+
+    response = client.get("/sd/targets/foo?b=2&a=1")
+    assert response.status_code == 200
+    assert response.data == payload
+
+    response = client.post(
+        "/sd/targets/_bulk",
+        json={"requests": [{"path": "foo", "args": {"a": "1", "b": "2"}}]},
+    )
+    (item,) = json.loads(response.data)["results"]
+    assert item["status"] == 200
+    assert item["targets"] == [{"targets": ["a:1"]}]
+
+    # a hit, no job was enqueued
+    assert not RedisJobQueue().is_job_queued_or_processing(
+        cache_key("foo", {"a": "1", "b": "2"})
+    )
+
+
+def test_refresh_is_enqueued_once_until_it_lands(
+    redis_server, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(config, "root_dir", str(tmp_path))
+    dispatcher = ServerDispatcher(300)
+    full_path = cache_key("foo", {})
+    RedisCache().set_entry(
+        full_path, {"updated_timestamp": time.time() - 60, "size": 2}, b"[]"
+    )
+    dispatcher.index.record_refresh_interval(full_path, "foo", 30)
+
+    enqueued = []
+    enqueue_job = dispatcher.queue.enqueue_job
+    monkeypatch.setattr(
+        dispatcher.queue,
+        "enqueue_job",
+        lambda job: enqueued.append(job) or enqueue_job(job),
+    )
+    for _ in range(3):
+        assert dispatcher.get_targets("foo", full_path) == []
+    assert len(enqueued) == 1
+
+    # a worker wrote the key
+    dispatcher._on_change(full_path)
+    dispatcher.get_targets("foo", full_path)
+    assert len(enqueued) == 2
+
+
+def test_failed_refresh_is_retried_by_the_next_request(
+    redis_server, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(config, "root_dir", str(tmp_path))
+    (tmp_path / "foo.py").write_text(
+        "def generate_targets(**args):\n    return 1 / 0\n"
+    )
+    dispatcher = ServerDispatcher(300)
+    full_path = cache_key("foo", {})
+    deadline = time.time() + 5
+    while not dispatcher.local_cache.enabled and time.time() < deadline:
+        time.sleep(0.01)
+
+    with pytest.raises(CacheNotExist):
+        dispatcher.get_targets("foo", full_path)
+    worker = Worker("test")
+    worker._process_leased_job(worker.queue.dequeue_job(timeout=1))
+    assert RedisCache().get(f"error:{full_path}")["status"] == "error"
+
+    # the failure is published, the server forgets the job it enqueued
+    while full_path in dispatcher._enqueued and time.time() < deadline:
+        time.sleep(0.01)
+    with pytest.raises(CacheNotExist):
+        dispatcher.get_targets("foo", full_path)
+    assert dispatcher.queue.is_job_queued_or_processing(full_path)
@@ -0,0 +1,115 @@
+import time
+
+import pytest
+
+from prometheus_http_sd.dispather import Dispatcher
+from prometheus_http_sd.handler import cache_key, serve_targets
+from prometheus_http_sd.refresh_interval import (
+    RefreshIntervals,
+    parse_refresh_interval,
+)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (None, None),
+        ("", None),
+        ("abc", None),
+        ("0", None),
+        ("-30", None),
+        ("nan", None),
+        ("60", 60),
+        ("30.5", 30),
+        ("1", 5),
+        ("86400", 3600),
+    ],
+)
+def test_parse_refresh_interval(value, expected):
+    assert parse_refresh_interval(value) == expected
+
+
+def test_smallest_active_interval(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, "time", lambda: now)
+    intervals = RefreshIntervals()
+    assert intervals.current() is None
+
+    intervals.record(300)
+    intervals.record(30)
+    assert intervals.current() == 30
+
+    # the 30s client stopped polling, the 300s one is still active
+    now += 100
+    assert intervals.current() == 300
+    now += 900
+    assert intervals.current() is None
+
+
+def test_dispatcher_uses_refresh_interval(tmp_path):
+    dispatcher = Dispatcher(
+        interval=60,
+        max_workers=1,
+        cache_location=tmp_path,
+        cache_expire_seconds=300,
+    )
+    full_path = cache_key("foo", {})
+    dispatcher.write_cache(full_path, [])
+    result = serve_targets(dispatcher, "foo", {}, refresh_interval=120)
+    result.entry.close()
+
+    task = dispatcher.tasks[full_path]
+    assert dispatcher.task_interval(task) == 120
+    assert dispatcher.expire_seconds(full_path) == 600
+    assert dispatcher.index.rows()[0]["refresh_interval_seconds"] == 120
+    assert dispatcher.expire_seconds(cache_key("bar", {})) == 300
+
+
+def test_tasks_are_due_at_their_own_interval(tmp_path, monkeypatch):
+    dispatcher = Dispatcher(
+        interval=60,
+        max_workers=1,
+        cache_location=tmp_path,
+        cache_expire_seconds=300,
+    )
+    monkeypatch.setattr(dispatcher, "update_next", lambda: None)
+    for name, interval in (("fast", 45), ("slow", 60)):
+        full_path = cache_key(name, {})
+        dispatcher.index.record_refresh_interval(full_path, name, interval)
+        dispatcher.append_task(full_path, name, {})
+    fast, slow = dispatcher.tasks.values()
+
+    def check(now):
+        counter, sleep_seconds = dispatcher.check_tasks(now)
+        for task in (fast, slow):
+            # the refresh is done, the clients poll again
+            task.running = False
+            dispatcher.append_task(task.full_path, task.path, {})
+        return counter, sleep_seconds
+
+    assert check(1000) == (2, 45)
+    assert check(1045) == (1, 15)
+    assert fast.last_queued == 1045
+    # not the next wake up of the fast task, at 1090
+    assert check(1060) == (1, 30)
+    assert slow.last_queued == 1060
+
+
+def test_due_task_wakes_up_the_dispatcher(tmp_path, monkeypatch):
+    dispatcher = Dispatcher(
+        interval=60,
+        max_workers=1,
+        cache_location=tmp_path,
+        cache_expire_seconds=300,
+    )
+    monkeypatch.setattr(dispatcher, "update_next", lambda: None)
+    full_path = cache_key("foo", {})
+    dispatcher.append_task(full_path, "foo", {})
+    assert dispatcher.wakeup.is_set()
+
+    dispatcher.wakeup.clear()
+    dispatcher.check_tasks()
+    dispatcher.tasks[full_path].running = False
+    # requested again before it is due
+    dispatcher.append_task(full_path, "foo", {})
+    assert not dispatcher.wakeup.is_set()
@@ -0,0 +1,99 @@
+import sys
+
+import pytest
+
+from prometheus_http_sd.config import config
+from prometheus_http_sd.dispather import Dispatcher
+from prometheus_http_sd.handler import cache_key
+from prometheus_http_sd.reload import (
+    Reloader,
+    invalidate_module_caches,
+    load_config_file,
+)
+
+
+@pytest.fixture()
+def dispatcher(tmp_path, monkeypatch):
+    root = tmp_path / "root"
+    (root / "foo").mkdir(parents=True)
+    monkeypatch.setattr(config, "root_dir", str(root))
+    monkeypatch.setattr(config, "undeclared_params", "drop")
+    return Dispatcher(
+        interval=60,
+        max_workers=1,
+        cache_location=tmp_path,
+        cache_expire_seconds=300,
+    )
+
+
+def write(path, content):
+    path.write_text(content)
+    return str(path)
+
+
+def test_load_config_file(tmp_path):
+    settings = load_config_file(
+        write(
+            tmp_path / "config.yaml",
+            "cache_seconds: 600\ntenant_weights:\n  team-a: 3\n",
+        )
+    )
+    assert settings["cache_seconds"] == 600
+    assert settings["tenant_weights"] == {"team-a": 3}
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "- a list\n",
+        "cache_secondz: 600\n",
+        "cache_seconds: -1\n",
+        "undeclared_params: ignore\n",
+        "metrics_path_label: depth:x\n",
+        "cache_seconds: [\n",
+    ],
+)
+def test_load_config_file_invalid(tmp_path, content):
+    with pytest.raises(ValueError):
+        load_config_file(write(tmp_path / "config.yaml", content))
+
+
+def test_invalidate_module_caches(tmp_path, monkeypatch):
+    for dir, name in (("root", "in_root"), ("lib", "by_prefix")):
+        (tmp_path / dir).mkdir()
+        (tmp_path / dir / f"{name}.py").write_text("VALUE = 1\n")
+        monkeypatch.syspath_prepend(str(tmp_path / dir))
+    import by_prefix  # noqa: F401
+    import in_root  # noqa: F401
+
+    dropped = invalidate_module_caches(str(tmp_path / "root"), ["by_prefix"])
+    assert sorted(dropped) == ["by_prefix", "in_root"]
+    assert "in_root" not in sys.modules
+    assert "by_prefix" not in sys.modules
+
+
+def test_reload_keeps_tasks(tmp_path, dispatcher):
+    config_file = tmp_path / "config.yaml"
+    write(config_file, "cache_refresh_interval: 30\n")
+    reloader = Reloader(dispatcher, str(config_file))
+    reloader.load()
+    assert dispatcher.interval == 30
+
+    full_path = cache_key("foo", {})
+    dispatcher.append_task(full_path, "foo", {})
+    task = dispatcher.tasks[full_path]
+    task.need_update = False
+    task.last_queued = 100.0
+
+    write(config_file, "cache_refresh_interval: 10\nundeclared_params: keep\n")
+    reloader.reload()
+    assert dispatcher.interval == 10
+    assert config.undeclared_params == "keep"
+    assert dispatcher.tasks[full_path] is task
+    assert task.need_update
+    assert task.last_queued == 0
+
+    # a broken file keeps the current settings
+    write(config_file, "cache_refresh_interval: zero\n")
+    reloader.reload()
+    assert dispatcher.interval == 10
@@ -0,0 +1,183 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import threading
+import time
+
+import pytest
+import waitress
+
+from prometheus_http_sd.app import create_app
+from prometheus_http_sd.asgi import create_asgi_app
+from prometheus_http_sd.config import config
+from prometheus_http_sd.handler import cache_key, serve_targets
+from prometheus_http_sd.watch import (
+    MAX_WATCH_SECONDS,
+    max_watchers,
+    parse_watch_args,
+)
+
+
+def test_parse_watch_args():
+    assert parse_watch_args({"a": "1"}) == ({"a": "1"}, None, 0)
+    assert parse_watch_args({"a": "1", "watch": '"abc"', "timeout": "5"}) == (
+        {"a": "1"},
+        "abc",
+        5,
+    )
+    assert parse_watch_args({"watch": "abc", "timeout": "9999"})[2] == (
+        MAX_WATCH_SECONDS
+    )
+    with pytest.raises(ValueError):
+        parse_watch_args({"watch": "abc", "timeout": "soon"})
+
+
+def test_watch_timeout(dispatcher):
+    dispatcher.write_cache(cache_key("foo", {}), [])
+    result = serve_targets(dispatcher, "foo", {})
+    etag = result.entry.etag
+    result.entry.close()
+
+    start = time.time()
+    result = serve_targets(
+        dispatcher, "foo", {"watch": etag, "timeout": "0.2"}
+    )
+    assert result.status == 304
+    assert result.etag == etag
+    assert time.time() - start >= 0.2
+
+
+def test_watch_returns_on_change(dispatcher):
+    key = cache_key("foo", {"a": "1"})
+    dispatcher.write_cache(key, [])
+    etag = dispatcher.open_cache(key).etag
+
+    # the same targets do not change the etag
+    dispatcher.write_cache(key, [])
+    assert dispatcher.open_cache(key).etag == etag
+
+    def change():
+        time.sleep(0.2)
+        dispatcher.write_cache(key, [{"targets": ["a:1"]}])
+
+    threading.Thread(target=change).start()
+    start = time.time()
+    result = serve_targets(
+        dispatcher, "foo", {"a": "1", "watch": etag, "timeout": "10"}
+    )
+    assert time.time() - start < 5
+    assert result.status == 200
+    assert result.entry.etag != etag
+    assert result.entry.read() == b'[{"targets":["a:1"]}]'
+
+
+def get(port, path, timeout=10):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def test_watchers_do_not_take_every_thread(tmp_path):
+    config.root_dir = str(tmp_path)
+    app = create_app("", str(tmp_path), 300, 1, 1, max_concurrency=4)
+    dispatcher = app.extensions["dispatcher"]
+    dispatcher.write_cache(cache_key("foo", {}), [])
+    etag = dispatcher.open_cache(cache_key("foo", {})).etag
+
+    server = waitress.create_server(app, host="127.0.0.1", port=0, threads=4)
+    port = server.effective_port
+    threading.Thread(target=server.run, daemon=True).start()
+    try:
+        statuses = []
+        watchers = [
+            threading.Thread(
+                target=lambda: statuses.append(
+                    get(port, f"/targets/foo?watch={etag}&timeout=3")
+                )
+            )
+            for _ in range(8)
+        ]
+        for watcher in watchers:
+            watcher.start()
+        time.sleep(0.5)
+
+        # more watchers than threads, the plain requests are still served
+        start = time.time()
+        assert get(port, "/targets/foo") == 200
+        assert time.time() - start < 1
+        # the watchers beyond the limit were answered at once
+        assert statuses.count(304) >= 8 - max_watchers(4)
+        for watcher in watchers:
+            watcher.join()
+        assert statuses == [304] * 8
+    finally:
+        server.close()
+
+
+def test_asgi_watchers_wait_on_the_loop(dispatcher):
+    key = cache_key("foo", {})
+    dispatcher.write_cache(key, [])
+    etag = dispatcher.open_cache(key).etag
+    app = create_asgi_app("", dispatcher)
+
+    async def main():
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=2)
+        )
+        watchers = [
+            asyncio.create_task(
+                asgi_request(app, "/targets/foo", f"watch={etag}&timeout=10")
+            )
+            for _ in range(8)
+        ]
+        await asyncio.sleep(0.2)
+
+        # more watchers than executor threads, a plain request is served
+        status, _ = await asyncio.wait_for(
+            asgi_request(app, "/targets/foo"), 1
+        )
+        assert status == 200
+
+        # a change wakes up the watchers
+        threading.Thread(
+            target=dispatcher.write_cache, args=(key, [{"targets": ["a:1"]}])
+        ).start()
+        results = await asyncio.wait_for(asyncio.gather(*watchers), 5)
+        assert results == [(200, b'[{"targets":["a:1"]}]')] * 8
+
+        status, _ = await asgi_request(
+            app, "/targets/foo", "watch=other&timeout=0"
+        )
+        assert status == 200
+        status, _ = await asgi_request(
+            app, "/targets/foo", "watch=x&timeout=soon"
+        )
+        assert status == 400
+
+    asyncio.run(main())
+
+
+async def asgi_request(app, path, query_string=""):
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "query_string": query_string.encode(),
+        "headers": [],
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return messages[0]["status"], body